@@ -1,53 +1,101 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g
 from flask_cors import CORS
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from flask_jwt_extended import JWTManager
 from config import Config
-from models import User, Message, Dashboard
-from email_utils import send_admin_reply_email
+from models import (User, Message, Dashboard, Readings, ChangesUnavailable, parse_dashboard,
+                    parse_reading, parse_timestamp, on_backend_change, RESOURCES, GRANULARITIES)
+from email_queue import EmailOutbox, queue_admin_reply_email, queue_admin_reply_emails
+from response_cache import ResponseCache, FragmentCache
+from auth import create_token, current_identity, role_required, verify_token
+from passwords import VerificationBusy
+import events
+import json_codec
+import greenscore
+import metrics
+import logs
+import startup
+from bson import ObjectId
 from functools import wraps
+from datetime import datetime
 import os
-import json
+import time
+import uuid
+import threading
+
+logger = logs.get_logger(__name__)
 
 app = Flask(__name__)
+# orjson when installed: compact bodies, ISO datetimes, string ObjectIds
+app.json = json_codec.FastJSONProvider(app)
 CORS(app, origins=['http://localhost:5173', 'http://localhost:5174', 'http://localhost:5175'])
 
 # Configuration
 app.config['JWT_SECRET_KEY'] = Config.JWT_SECRET_KEY
 jwt = JWTManager(app)
 
-# Track if we've initialized default users
-_initialized = False
+# Precomputed bodies for hot public responses (GET /api/dashboard, /api/greenscore)
+response_cache = ResponseCache(ttl=Config.RESPONSE_CACHE_TTL)
+# The other backend holds different data; don't serve the old one's copy
+on_backend_change(lambda use_mongodb: response_cache.invalidate('dashboard'))
+# Serialized messages, reused by list responses until each one's next write
+message_fragments = FragmentCache(json_codec.dumps, size=Config.MESSAGE_FRAGMENT_CACHE_SIZE,
+                                  name='message_fragments')
+on_backend_change(lambda use_mongodb: message_fragments.clear())
+# Dashboard changes announced by other workers (MongoDB change streams)
+events.bus.listen(lambda event_type: event_type == 'dashboard' and response_cache.invalidate('dashboard'))
 
-def init_default_users():
-    """Create admin and a sample user if they don't exist"""
-    global _initialized
-    if _initialized:
-        return
-    
-    try:
-        admin = User.find_by_email(Config.ADMIN_EMAIL)
-        if not admin:
-            User.create_user(Config.ADMIN_EMAIL, Config.ADMIN_PASSWORD, role='admin')
 
-        sample_user = User.find_by_email(Config.SAMPLE_USER_EMAIL)
-        if not sample_user:
-            User.create_user(Config.SAMPLE_USER_EMAIL, Config.SAMPLE_USER_PASSWORD, role='user')
-        
-        _initialized = True
-    except Exception as e:
-        # Log but don't prevent app from starting
-        print(f"Error initializing default users: {e}")
+# ==================== Instrumentation ====================
 
-
-# Initialize before the first request
 @app.before_request
-def before_first_request():
-    """Called before each request"""
-    init_default_users()
-
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # Correlation id: the caller's X-Request-ID (e.g. from a proxy) or a new one
+    g.request_id = request.headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex
+    logs.begin_request(g.request_id)
+    if Config.PROFILER_ENABLED and request.args.get('profile') == '1':
+        g.profiler = metrics.SamplingProfiler(
+            threading.get_ident(), Config.PROFILER_INTERVAL_MS / 1000.0
+        ).start()
+
+
+@app.after_request
+def record_request(response):
+    """Record latency and sizes per route; swap in the profile if one ran"""
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.request_started,
+                                    method=request.method, route=route,
+                                    status=response.status_code)
+    metrics.REQUEST_BYTES.observe(request.content_length or 0, method=request.method, route=route)
+    # Measuring a streamed body would buffer all of it (see /api/stream)
+    if not response.is_streamed:
+        metrics.RESPONSE_BYTES.observe(response.calculate_content_length() or 0,
+                                       method=request.method, route=route)
+    response.headers['X-Request-ID'] = g.request_id
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        stacks = profiler.stop()
+        profiled = Response(stacks, status=200, mimetype='text/plain')
+        profiled.headers['X-Profiled-Status'] = str(response.status_code)
+        profiled.headers['X-Profile-Samples'] = str(profiler.samples)
+        profiled.headers['X-Request-ID'] = g.request_id
+        return profiled
+    return response
+
+
+@app.teardown_request
+def end_request(error):
+    logs.end_request()
 
 # ==================== Authentication Routes ====================
 
+def _busy():
+    """503 for when the password pool is saturated (login storms)"""
+    response = jsonify({'message': 'Too many login attempts, please retry shortly'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+
 @app.route('/api/auth/register', methods=['POST'])
 def register():
     """Register a new user"""
@@ -64,12 +112,13 @@ def register():
         return jsonify({'message': 'User already exists'}), 409
     
     # Create new user
-    user_id = User.create_user(email, password, role='user')
+    try:
+        user_id = User.create_user(email, password, role='user')
+    except VerificationBusy:
+        return _busy()
     
     if user_id:
-        # Create JWT with user info as JSON string
-        identity_data = json.dumps({'email': email, 'role': 'user'})
-        access_token = create_access_token(identity=identity_data)
+        access_token = create_token(email, 'user')
         return jsonify({
             'message': 'User registered successfully',
             'access_token': access_token,
@@ -93,12 +142,13 @@ def login():
     email = data['email']
     password = data['password']
     
-    user = User.verify_credentials(email, password)
+    try:
+        user = User.verify_credentials(email, password)
+    except VerificationBusy:
+        return _busy()
     
     if user:
-        # Create JWT with user info as JSON string
-        identity_data = json.dumps({'email': email, 'role': user['role']})
-        access_token = create_access_token(identity=identity_data)
+        access_token = create_token(email, user['role'])
         return jsonify({
             'message': 'Login successful',
             'access_token': access_token,
@@ -135,109 +185,300 @@ def send_message():
     }), 201
 
 
+# Default structure matching frontend, served until an admin saves data
+DEFAULT_DASHBOARD = {
+    'energyData': [
+        { 'week': 'Week 1', 'current': 120, 'previous': 100 },
+        { 'week': 'Week 2', 'current': 130, 'previous': 110 },
+        { 'week': 'Week 3', 'current': 115, 'previous': 105 },
+        { 'week': 'Week 4', 'current': 140, 'previous': 120 },
+    ],
+    'waterData': [
+        { 'week': 'Week 1', 'current': 200, 'previous': 180 },
+        { 'week': 'Week 2', 'current': 210, 'previous': 190 },
+        { 'week': 'Week 3', 'current': 195, 'previous': 175 },
+        { 'week': 'Week 4', 'current': 220, 'previous': 200 },
+    ],
+    'wasteData': [
+        { 'week': 'Week 1', 'current': 80, 'previous': 75 },
+        { 'week': 'Week 2', 'current': 85, 'previous': 80 },
+        { 'week': 'Week 3', 'current': 78, 'previous': 72 },
+        { 'week': 'Week 4', 'current': 90, 'previous': 85 },
+    ]
+}
+
+
+def build_dashboard_body():
+    """Serialize the dashboard response once for the response cache.
+
+    Resources fed by meter readings come from the weekly rollups; the
+    rest fall back to the admin-entered (or default) values.
+    """
+    data = dict(Dashboard.get_dashboard() or DEFAULT_DASHBOARD)
+    data.update(Readings.dashboard_series())
+    return json_codec.dumps({'dashboard': data})
+
+
 @app.route('/api/dashboard', methods=['GET'])
 def get_dashboard():
-    """Return dashboard data (energy, water, waste). Public endpoint."""
+    """Return dashboard data (energy, water, waste). Public endpoint.
+
+    Served from the response cache with a strong ETag; a matching
+    If-None-Match gets 304 Not Modified.
+    """
     try:
-        data = Dashboard.get_dashboard()
-        if not data:
-            # Return default structure matching frontend
-            data = {
-                'energyData': [
-                    { 'week': 'Week 1', 'current': 120, 'previous': 100 },
-                    { 'week': 'Week 2', 'current': 130, 'previous': 110 },
-                    { 'week': 'Week 3', 'current': 115, 'previous': 105 },
-                    { 'week': 'Week 4', 'current': 140, 'previous': 120 },
-                ],
-                'waterData': [
-                    { 'week': 'Week 1', 'current': 200, 'previous': 180 },
-                    { 'week': 'Week 2', 'current': 210, 'previous': 190 },
-                    { 'week': 'Week 3', 'current': 195, 'previous': 175 },
-                    { 'week': 'Week 4', 'current': 220, 'previous': 200 },
-                ],
-                'wasteData': [
-                    { 'week': 'Week 1', 'current': 80, 'previous': 75 },
-                    { 'week': 'Week 2', 'current': 85, 'previous': 80 },
-                    { 'week': 'Week 3', 'current': 78, 'previous': 72 },
-                    { 'week': 'Week 4', 'current': 90, 'previous': 85 },
-                ]
-            }
-        return jsonify({'dashboard': data}), 200
-    except Exception as e:
-        print(f"[ERROR] Getting dashboard: {e}")
+        entry = response_cache.get('dashboard', build_dashboard_body)
+    except Exception:
+        logger.exception("Error getting dashboard")
         return jsonify({'message': 'Error retrieving dashboard'}), 500
 
+    if request.if_none_match.contains(entry.etag):
+        response = Response(status=304)
+    else:
+        response = Response(entry.body, status=200, mimetype='application/json')
+    response.set_etag(entry.etag)
+    response.headers['Cache-Control'] = f'public, max-age={Config.DASHBOARD_MAX_AGE}, must-revalidate'
+    return response
+
 
 @app.route('/api/dashboard', methods=['PUT'])
-@jwt_required()
+@role_required('admin')
 def update_dashboard():
     """Update dashboard data (admin only)"""
     try:
-        identity_str = get_jwt_identity()
-        identity = json.loads(identity_str)
-        if identity.get('role') != 'admin':
-            return jsonify({'message': 'Unauthorized - Admin only'}), 403
-
         data = request.json
         if not data:
             return jsonify({'message': 'No data provided'}), 400
 
-        # Validate expected keys
-        dashboard = {
-            'energyData': data.get('energyData', []),
-            'waterData': data.get('waterData', []),
-            'wasteData': data.get('wasteData', [])
-        }
+        try:
+            dashboard = parse_dashboard(data)
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
 
         Dashboard.save_dashboard(dashboard)
+        response_cache.invalidate('dashboard')
         return jsonify({'message': 'Dashboard updated successfully'}), 200
-    except Exception as e:
-        print(f"[ERROR] Updating dashboard: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Error updating dashboard")
         return jsonify({'message': 'Error updating dashboard'}), 500
 
 
+def build_greenscore_body(dashboard_entry):
+    """Score the campus from the served dashboard and each building from
+    its weekly rollups, serialized once per dashboard version."""
+    dashboard = json_codec.loads(dashboard_entry.body)['dashboard']
+    campus = greenscore.score_entities(['campus'], greenscore.dashboard_series(dashboard))
+    names, series = Readings.building_weekly_series()
+    body = {
+        'campus': campus[0] if campus else None,
+        'buildings': greenscore.score_entities(names, series),
+        'version': dashboard_entry.etag
+    }
+    return json_codec.dumps(body)
+
+
+@app.route('/api/greenscore', methods=['GET'])
+def get_greenscore():
+    """Return campus and per-building green scores. Public endpoint.
+
+    Cached per dashboard version, so every client gets the same numbers
+    as the dashboard it is looking at.
+    """
+    try:
+        dashboard_entry = response_cache.get('dashboard', build_dashboard_body)
+        entry = response_cache.get('greenscore', lambda: build_greenscore_body(dashboard_entry),
+                                   depends_on=dashboard_entry.etag)
+    except Exception:
+        logger.exception("Error computing green score")
+        return jsonify({'message': 'Error computing green score'}), 500
+
+    if request.if_none_match.contains(entry.etag):
+        response = Response(status=304)
+    else:
+        response = Response(entry.body, status=200, mimetype='application/json')
+    response.set_etag(entry.etag)
+    response.headers['Cache-Control'] = f'public, max-age={Config.DASHBOARD_MAX_AGE}, must-revalidate'
+    return response
+
+
+def messages_response(messages, fields):
+    """200 response of ``fields`` plus the ``messages`` list, assembled
+    from each message's cached JSON instead of serializing them again"""
+    body = {'messages': json_codec.Array(message_fragments.get_many(messages)), **fields}
+    return Response(json_codec.dumps_object(body), status=200, mimetype='application/json')
+
+
 @app.route('/api/messages', methods=['GET'])
-@jwt_required()
+@role_required('admin', 'user')
 def get_messages():
-    """Get all messages (admin only) or user's messages"""
+    """Get all messages (admin) or the user's own messages, newest first.
+
+    Optional query parameters: limit, cursor (next_cursor of the previous
+    page), status, user_email (admin only), since and until (ISO dates).
+    The first page also carries ``sync_token`` for /api/messages/changes.
+    """
     try:
-        identity_str = get_jwt_identity()
-        identity = json.loads(identity_str)  # Parse JSON string back to dict
-        print(f"[DEBUG] Getting messages for identity: {identity}")
+        identity = current_identity()
+        logger.debug("Getting messages for %s (%s)", identity.email, identity.role)
         
-        if identity.get('role') == 'admin':
-            # Admin gets all messages
-            messages = Message.get_all_messages()
-            print(f"[DEBUG] Retrieved {len(messages)} messages for admin")
-        elif identity.get('role') == 'user':
-            # User gets only their own messages
-            user_email = identity.get('email')
-            all_messages = Message.get_all_messages()
-            messages = [msg for msg in all_messages if msg.get('user_email') == user_email]
-            print(f"[DEBUG] Retrieved {len(messages)} messages for user: {user_email}")
+        if identity.role == 'admin':
+            # Admin sees all messages, optionally narrowed to one sender
+            user_email = request.args.get('user_email')
         else:
-            return jsonify({'message': 'Unauthorized - Invalid role'}), 403
-        
-        # Convert any datetime objects to strings for JSON serialization
-        for msg in messages:
-            if isinstance(msg.get('created_at'), str):
-                msg['created_at'] = msg['created_at']
-            for reply in msg.get('replies', []):
-                if isinstance(reply.get('timestamp'), str):
-                    reply['timestamp'] = reply['timestamp']
-        
-        return jsonify({'messages': messages}), 200
+            # User gets only their own messages
+            user_email = identity.email
+
+        try:
+            limit = request.args.get('limit', type=int)
+            if limit is not None and not 1 <= limit <= Config.MESSAGES_MAX_PAGE_SIZE:
+                raise ValueError(f'limit must be between 1 and {Config.MESSAGES_MAX_PAGE_SIZE}')
+            status = request.args.get('status')
+            if status and status not in ('unread', 'read', 'replied'):
+                raise ValueError('status must be unread, read or replied')
+            since = request.args.get('since')
+            until = request.args.get('until')
+            # Taken before the query, so changes racing it are sent again
+            sync_token = None if request.args.get('cursor') else Message.current_revision()
+            filters = {
+                'limit': limit,
+                'cursor': request.args.get('cursor'),
+                'status': status,
+                'since': datetime.fromisoformat(since) if since else None,
+                'until': datetime.fromisoformat(until) if until else None
+            }
+            if identity.role == 'user':
+                messages, next_cursor = Message.get_messages_for_user(user_email, **filters)
+            else:
+                messages, next_cursor = Message.query_messages(user_email=user_email, **filters)
+        except ValueError as e:
+            return jsonify({'message': f'Invalid query: {e}'}), 400
+        logger.debug("Retrieved %d messages for %s: %s", len(messages), identity.role,
+                     user_email or 'all')
+
+        body = {'next_cursor': next_cursor}
+        if sync_token:
+            body['sync_token'] = sync_token
+        return messages_response(messages, body)
     except Exception as e:
-        print(f"[ERROR] Getting messages: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error getting messages")
         return jsonify({'message': f'Error retrieving messages: {str(e)}'}), 500
 
 
+@app.route('/api/messages/changes', methods=['GET'])
+@role_required('admin', 'user')
+def get_message_changes():
+    """Messages changed after ?since=<sync_token>, so a client holding the
+    inbox only downloads what changed.
+
+    Returns the inserted and updated messages in their current state, the
+    ids of deleted ones, and the token to pass next time; call again while
+    has_more. Users only see their own messages. 410 means the token can
+    no longer be answered (e.g. the backend changed): reload the inbox.
+    """
+    identity = current_identity()
+    user_email = identity.email if identity.role == 'user' else None
+    limit = request.args.get('limit', Config.MESSAGES_MAX_PAGE_SIZE, type=int)
+    if not 1 <= limit <= Config.MESSAGES_MAX_PAGE_SIZE:
+        return jsonify({'message': f'limit must be between 1 and {Config.MESSAGES_MAX_PAGE_SIZE}'}), 400
+    try:
+        messages, deleted, sync_token, has_more = Message.changes_since(
+            request.args.get('since'), user_email=user_email, limit=limit
+        )
+    except ValueError as e:
+        return jsonify({'message': f'Invalid query: {e}'}), 400
+    except ChangesUnavailable:
+        return jsonify({'message': 'Changes are not available for this token; reload the inbox'}), 410
+    return messages_response(messages, {
+        'deleted': deleted,
+        'sync_token': sync_token,
+        'has_more': has_more
+    })
+
+
+@app.route('/api/messages/search', methods=['GET'])
+@role_required('admin', 'user')
+def search_messages():
+    """Full-text search of message subjects, bodies and replies.
+
+    ?q= holds the words to find (the last may be unfinished) and ?limit=
+    caps the results (default 20). Best matches come first, each with a
+    ``score``; users only search their own messages.
+    """
+    identity = current_identity()
+    query = request.args.get('q', '').strip()
+    if not query or len(query) > 256:
+        return jsonify({'message': 'q must be between 1 and 256 characters'}), 400
+    limit = request.args.get('limit', 20, type=int)
+    if not 1 <= limit <= Config.MESSAGES_MAX_PAGE_SIZE:
+        return jsonify({'message': f'limit must be between 1 and {Config.MESSAGES_MAX_PAGE_SIZE}'}), 400
+    user_email = identity.email if identity.role == 'user' else None
+    messages = Message.search(request.args['q'], user_email=user_email, limit=limit)
+    return jsonify({'messages': messages, 'query': query}), 200
+
+
+BULK_OPERATIONS = ('mark_read', 'delete', 'reply')
+
+
+@app.route('/api/messages/bulk', methods=['POST'])
+@role_required('admin')
+def bulk_update_messages():
+    """Apply one operation to many messages in a single storage write.
+
+    Body: ``{"operation": "mark_read" | "delete" | "reply", "ids": [...],
+    "reply_text": "..."}`` (reply_text for replies only). Returns a
+    result per id, ``ok`` false with an error for messages that do not
+    exist; replies also carry the delivery_id of their queued email.
+    """
+    data = request.get_json(silent=True) or {}
+    operation = data.get('operation')
+    message_ids = data.get('ids')
+    if operation not in BULK_OPERATIONS:
+        return jsonify({'message': f"operation must be one of {', '.join(BULK_OPERATIONS)}"}), 400
+    if (not isinstance(message_ids, list) or not message_ids
+            or not all(isinstance(message_id, str) for message_id in message_ids)):
+        return jsonify({'message': 'ids must be a non-empty list of message ids'}), 400
+    if len(message_ids) > Config.MESSAGES_BULK_MAX:
+        return jsonify({'message': f'At most {Config.MESSAGES_BULK_MAX} ids per request'}), 400
+    reply_text = data.get('reply_text')
+    if operation == 'reply' and not reply_text:
+        return jsonify({'message': 'Reply text required'}), 400
+
+    delivery_ids = {}
+    if operation == 'mark_read':
+        found = Message.mark_many_as_read(message_ids)
+    elif operation == 'delete':
+        found = Message.delete_messages(message_ids)
+        message_fragments.discard(message_ids)
+    else:
+        messages = Message.get_messages_by_ids(message_ids)
+        delivery_ids = {message_id: str(ObjectId()) for message_id in messages}
+        found = Message.add_replies(message_ids, reply_text, delivery_ids=delivery_ids)
+        # One outbox write for all the notification emails
+        queue_admin_reply_emails([
+            (delivery_ids[message_id], messages[message_id], reply_text)
+            for message_id in messages if found.get(message_id)
+        ])
+
+    results = []
+    for message_id, ok in found.items():
+        result = {'_id': message_id, 'ok': ok}
+        if not ok:
+            result['error'] = 'Message not found'
+        elif message_id in delivery_ids:
+            result['delivery_id'] = delivery_ids[message_id]
+        results.append(result)
+    succeeded = sum(result['ok'] for result in results)
+    logger.info("Bulk %s on %d message(s): %d done", operation, len(results), succeeded)
+    return jsonify({
+        'operation': operation,
+        'results': results,
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded
+    }), 200
+
+
 @app.route('/api/messages/<message_id>', methods=['GET'])
-@jwt_required()
+@role_required()
 def get_message(message_id):
     """Get a specific message"""
     message = Message.get_message_by_id(message_id)
@@ -249,16 +490,13 @@ def get_message(message_id):
 
 
 @app.route('/api/messages/<message_id>/reply', methods=['POST'])
-@jwt_required()
+@role_required('admin')
 def reply_to_message(message_id):
-    """Add admin reply to message and send email"""
-    identity_str = get_jwt_identity()
-    identity = json.loads(identity_str)  # Parse JSON string back to dict
-    
-    # Only admin can reply
-    if identity.get('role') != 'admin':
-        return jsonify({'message': 'Unauthorized'}), 403
-    
+    """Add admin reply to message and queue the notification email.
+
+    Returns as soon as the email is queued; poll
+    /api/deliveries/<delivery_id> for its delivery state.
+    """
     data = request.json
     
     if not data or not data.get('reply_text'):
@@ -270,46 +508,207 @@ def reply_to_message(message_id):
         return jsonify({'message': 'Message not found'}), 404
     
     # Add reply to database
-    Message.add_reply(message_id, data['reply_text'])
+    delivery_id = str(ObjectId())
+    Message.add_reply(message_id, data['reply_text'], delivery_id=delivery_id)
     
-    # Send email to user
-    email_sent = send_admin_reply_email(
+    # Queue email to user; background workers deliver it
+    queue_admin_reply_email(
+        message_id,
         message['user_email'],
         message['user_name'],
         message['subject'],
-        data['reply_text']
+        data['reply_text'],
+        delivery_id=delivery_id
     )
     
     return jsonify({
         'message': 'Reply sent successfully',
-        'email_sent': email_sent
+        'delivery_id': delivery_id,
+        'delivery_status': 'queued'
     }), 200
 
 
+@app.route('/api/deliveries/<delivery_id>', methods=['GET'])
+@role_required('admin')
+def get_delivery(delivery_id):
+    """Get the delivery state of a reply email (admin only)"""
+    delivery = EmailOutbox.get(delivery_id)
+    if not delivery:
+        return jsonify({'message': 'Delivery not found'}), 404
+
+    return jsonify({'delivery': delivery}), 200
+
+
 @app.route('/api/messages/<message_id>', methods=['DELETE'])
-@jwt_required()
+@role_required('admin')
 def delete_message(message_id):
     """Delete a message (admin only)"""
-    identity_str = get_jwt_identity()
-    identity = json.loads(identity_str)  # Parse JSON string back to dict
-    
-    if identity.get('role') != 'admin':
-        return jsonify({'message': 'Unauthorized'}), 403
-    
     if Message.delete_message(message_id):
+        message_fragments.discard([message_id])
         return jsonify({'message': 'Message deleted successfully'}), 200
     
     return jsonify({'message': 'Message not found'}), 404
 
 
 @app.route('/api/messages/<message_id>/read', methods=['PUT'])
-@jwt_required()
+@role_required()
 def mark_message_read(message_id):
     """Mark message as read"""
     Message.mark_as_read(message_id)
     return jsonify({'message': 'Message marked as read'}), 200
 
 
+# ==================== Live Updates ====================
+
+@app.route('/api/stream', methods=['GET'])
+def stream_events():
+    """Server-Sent Events stream of changes, so clients hold one idle
+    connection instead of re-fetching messages and the dashboard.
+
+    Events: message (new or replaced message), message_status,
+    message_reply, message_deleted, dashboard (refetch /api/dashboard)
+    and resync (refetch everything: events were missed). Admins get every
+    message event, users those for their own messages, and anonymous
+    clients only dashboard events. EventSource cannot send headers, so
+    the access token may be passed as ?token=; the stream ends when it
+    expires. Resumes after the Last-Event-ID header.
+    """
+    token = request.args.get('token') or request.headers.get('Authorization', '').partition('Bearer ')[2]
+    identity, expires_at = verify_token(token) if token else (None, None)
+    try:
+        subscription = events.bus.subscribe(
+            email=identity.email if identity else None,
+            role=identity.role if identity else None,
+            last_event_id=request.headers.get('Last-Event-ID')
+        )
+    except events.TooManySubscribers:
+        response = jsonify({'message': 'Too many stream clients, please retry shortly'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+
+    def generate():
+        try:
+            # Reconnect delay for the browser, in milliseconds
+            yield b'retry: 3000\n\n'
+            while expires_at is None or time.time() < expires_at:
+                wait = Config.STREAM_HEARTBEAT_SECONDS
+                if expires_at is not None:
+                    wait = max(0.0, min(wait, expires_at - time.time()))
+                yield subscription.next_frame(wait)
+        finally:
+            subscription.close()
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Don't let a reverse proxy buffer the events
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# ==================== Meter Reading Routes ====================
+
+def _can_ingest():
+    """Meters authenticate with X-API-Key; admins may also post readings"""
+    if Config.INGEST_API_KEY and request.headers.get('X-API-Key') == Config.INGEST_API_KEY:
+        return True
+    try:
+        identity = current_identity(optional=True)
+    except Exception:
+        return False
+    return identity is not None and identity.role == 'admin'
+
+
+@app.route('/api/readings', methods=['POST'])
+def ingest_readings():
+    """Bulk-ingest meter readings and update the rollups.
+
+    Body: {"readings": [{"meter_id", "resource", "timestamp", "value",
+    "building"?}, ...]}. The batch is rejected as a whole if any reading
+    is invalid.
+    """
+    if not _can_ingest():
+        return jsonify({'message': 'Unauthorized'}), 401
+
+    data = request.get_json(silent=True) or {}
+    raw_readings = data.get('readings')
+    if not isinstance(raw_readings, list) or not raw_readings:
+        return jsonify({'message': 'readings must be a non-empty list'}), 400
+    if len(raw_readings) > Config.READINGS_MAX_BATCH:
+        return jsonify({'message': f'At most {Config.READINGS_MAX_BATCH} readings per request'}), 413
+
+    readings = []
+    errors = []
+    for i, raw in enumerate(raw_readings):
+        try:
+            readings.append(parse_reading(raw))
+        except ValueError as e:
+            errors.append({'index': i, 'error': str(e)})
+    if errors:
+        return jsonify({'message': 'Invalid readings', 'errors': errors[:20]}), 400
+
+    try:
+        stored = Readings.ingest(readings)
+    except Exception:
+        logger.exception("Error ingesting readings")
+        return jsonify({'message': 'Error storing readings'}), 500
+
+    response_cache.invalidate('dashboard')
+    return jsonify({'message': 'Readings stored', 'accepted': stored}), 202
+
+
+@app.route('/api/readings/rollups', methods=['GET'])
+def get_rollups():
+    """Rollup buckets (sum/min/max/count) of one series. Public endpoint.
+
+    Query: resource, granularity (hour/day/week), scope (campus, building
+    or meter; default campus), key (building name or meter id), since and
+    until (ISO bucket starts).
+    """
+    resource = request.args.get('resource')
+    granularity = request.args.get('granularity', 'day')
+    scope = request.args.get('scope', 'campus')
+    if resource not in RESOURCES or granularity not in GRANULARITIES:
+        return jsonify({'message': 'Invalid resource or granularity'}), 400
+    if scope not in ('campus', 'building', 'meter'):
+        return jsonify({'message': 'Invalid scope'}), 400
+    key = '*' if scope == 'campus' else request.args.get('key')
+    if not key:
+        return jsonify({'message': 'key is required for building and meter scopes'}), 400
+
+    rollups = Readings.get_rollups(resource, granularity, scope, key,
+                                   since=request.args.get('since'),
+                                   until=request.args.get('until'))
+    return jsonify({'rollups': rollups}), 200
+
+
+@app.route('/api/readings/aggregate', methods=['GET'])
+def aggregate_readings():
+    """Aggregate raw readings of one resource over a time range. Public.
+
+    Query: resource, since and until (ISO), optional meter_id and interval
+    (hour or day) to get a bucketed series instead of one total.
+    """
+    resource = request.args.get('resource')
+    if resource not in RESOURCES:
+        return jsonify({'message': 'Invalid resource'}), 400
+    interval = request.args.get('interval')
+    if interval not in (None, 'hour', 'day'):
+        return jsonify({'message': 'interval must be hour or day'}), 400
+    try:
+        since = parse_timestamp(request.args['since'])
+        until = parse_timestamp(request.args['until'])
+    except (KeyError, ValueError):
+        return jsonify({'message': 'since and until must be ISO timestamps'}), 400
+    step = {'hour': 3600, 'day': 86400}.get(interval)
+    if step and (until - since) / step > Config.READINGS_MAX_BUCKETS:
+        return jsonify({'message': f'At most {Config.READINGS_MAX_BUCKETS} buckets per query'}), 400
+
+    result = Readings.aggregate_range(resource, since, until,
+                                      meter_id=request.args.get('meter_id'), interval=step)
+    key = 'buckets' if step else 'aggregate'
+    return jsonify({key: result}), 200
+
+
 # ==================== Health Check ====================
 
 @app.route('/api/health', methods=['GET'])
@@ -318,16 +717,35 @@ def health_check():
     return jsonify({'status': 'ok'}), 200
 
 
+def _can_read_metrics():
+    """Scrapers authenticate with METRICS_TOKEN; admins may always read
+    the metrics, and only they when no token is set"""
+    if Config.METRICS_TOKEN and request.headers.get('Authorization') == f'Bearer {Config.METRICS_TOKEN}':
+        return True
+    try:
+        identity = current_identity(optional=True)
+    except Exception:
+        return False
+    return identity is not None and identity.role == 'admin'
+
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text exposition of request, storage, cache and email metrics"""
+    if not _can_read_metrics():
+        return jsonify({'message': 'Unauthorized'}), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/api/test-jwt', methods=['GET'])
-@jwt_required()
+@role_required()
 def test_jwt():
     """Test JWT identity"""
     try:
-        identity_str = get_jwt_identity()
-        identity = json.loads(identity_str)  # Parse JSON string back to dict
+        identity = current_identity()
         return jsonify({
             'status': 'ok',
-            'identity': identity,
+            'identity': identity._asdict(),
             'type': type(identity).__name__
         }), 200
     except Exception as e:
@@ -346,5 +764,12 @@ def internal_error(error):
     return jsonify({'message': 'Internal server error'}), 500
 
 
+# ==================== Startup ====================
+
+# Runs once per process at import, before the first request; a failure
+# raises StartupError and stops the process
+startup.run(warmers=[lambda: response_cache.get('dashboard', build_dashboard_body)])
+
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,141 @@
+import hmac
+import json
+import time
+import threading
+from collections import OrderedDict, namedtuple
+from functools import wraps
+from flask import g, request, jsonify
+from flask_jwt_extended import create_access_token, decode_token, get_jwt, verify_jwt_in_request
+from config import Config
+
+ROLES = ('admin', 'user')
+
+# Who a request is authenticated as, decoded once per request
+Identity = namedtuple('Identity', ('email', 'role'))
+
+
+def create_token(email, role):
+    """Access token whose subject is the email and whose role is a claim"""
+    return create_access_token(identity=email, additional_claims={'role': role})
+
+
+def _identity_from_claims(claims):
+    role = claims.get('role')
+    if role is not None:
+        return Identity(claims['sub'], role)
+    # Tokens issued before roles became a claim carry
+    # {"email": ..., "role": ...} as a JSON string in sub
+    try:
+        legacy = json.loads(claims['sub'])
+        return Identity(legacy.get('email'), legacy.get('role'))
+    except (TypeError, ValueError, AttributeError):
+        return Identity(claims.get('sub'), None)
+
+
+class VerifiedTokenCache:
+    """LRU of recently verified tokens, keyed by their signature.
+
+    A hit skips decoding and the HMAC check, but only for the exact same
+    token (compared in full) and only until the token's own expiry, so
+    the cache never accepts anything a fresh verification would reject
+    for signature or lifetime reasons.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _signature(token):
+        return token.rpartition('.')[2]
+
+    def get(self, token):
+        """(identity, expires_at) cached for ``token``, or None"""
+        key = self._signature(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            cached_token, identity, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        if not hmac.compare_digest(cached_token, token):
+            return None
+        return identity, expires_at
+
+    def put(self, token, identity, expires_at):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries[self._signature(token)] = (token, identity, expires_at)
+            self._entries.move_to_end(self._signature(token))
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+_verified_tokens = VerifiedTokenCache(Config.JWT_VERIFIED_CACHE_SIZE)
+
+
+def _bearer_token():
+    header = request.headers.get('Authorization', '')
+    scheme, _, token = header.partition(' ')
+    return token.strip() if scheme == 'Bearer' and token.strip() else None
+
+
+def current_identity(optional=False):
+    """Identity of this request's access token, verified once per request.
+
+    Raises the usual flask_jwt_extended errors (answered as 401/422 by
+    its handlers) for a missing or invalid token; with ``optional`` a
+    request without a token gets None instead.
+    """
+    if 'identity' in g:
+        return g.identity
+    token = _bearer_token()
+    cached = _verified_tokens.get(token) if token else None
+    if cached is not None:
+        identity = cached[0]
+    else:
+        if verify_jwt_in_request(optional=optional) is None:
+            g.identity = None
+            return None
+        claims = get_jwt()
+        identity = _identity_from_claims(claims)
+        if token:
+            _verified_tokens.put(token, identity, claims.get('exp'))
+    g.identity = identity
+    return identity
+
+
+def verify_token(token):
+    """(identity, expires_at) of an access token passed some other way
+    than the Authorization header, e.g. as the ?token= of an EventSource,
+    which cannot send headers. Raises the flask_jwt_extended / PyJWT
+    errors its handlers answer as 401/422."""
+    cached = _verified_tokens.get(token)
+    if cached is not None:
+        return cached
+    claims = decode_token(token)
+    identity = _identity_from_claims(claims)
+    _verified_tokens.put(token, identity, claims.get('exp'))
+    return identity, claims.get('exp')
+
+
+def role_required(*roles):
+    """Require a valid access token whose role is one of ``roles`` (any
+    known role when none are given); the identity is then available
+    through current_identity()"""
+    allowed = roles or ROLES
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            identity = current_identity()
+            if identity is None or identity.role not in allowed:
+                return jsonify({'message': 'Unauthorized'}), 403
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
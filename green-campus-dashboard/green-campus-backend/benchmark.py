@@ -0,0 +1,388 @@
+"""Load-test and benchmark the REST API.
+
+Drives the Flask app in-process (test client) or over a local socket
+(werkzeug server on 127.0.0.1) with a thread pool, against a fresh store
+seeded with ``--messages`` messages, and reports p50/p95/p99 latency and
+throughput per scenario and concurrency level. Results can be saved as a
+JSON baseline and later runs compared against it:
+
+    python benchmark.py --backend file --messages 10000 --save baselines/file-10k.json
+    python benchmark.py --backend file --messages 10000 --compare baselines/file-10k.json
+
+``--backend mongodb`` uses ``--mongo-uri`` (database green_campus_benchmark,
+whose messages and dashboard are dropped first) or, without it, an
+in-memory mongomock database (pip install mongomock). Nothing touches the
+real data/ directory or green_campus database. Exits with status 1 when
+``--compare`` finds a regression beyond ``--tolerance``.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import itertools
+import contextlib
+import http.client
+from datetime import datetime, timedelta
+
+SCENARIOS = ('login', 'dashboard_get', 'dashboard_put', 'message_send', 'message_list',
+             'message_list_user', 'message_reply', 'message_read')
+BACKENDS = ('file', 'sqlite', 'memory', 'mongodb')
+
+BENCHMARK_DB_NAME = 'green_campus_benchmark'
+ADMIN = ('admin@greencampus.com', 'admin123')
+USER = ('user@greencampus.com', 'user123')
+SEED_BATCH = 5000
+
+
+def configure(args, data_dir):
+    """Point the app at a throwaway store; must run before importing it"""
+    os.environ['DATA_DIR'] = data_dir
+    os.environ['EMAIL_WORKERS'] = '0'
+    os.environ['ADMIN_EMAIL'], os.environ['ADMIN_PASSWORD'] = ADMIN
+    os.environ['SAMPLE_USER_EMAIL'], os.environ['SAMPLE_USER_PASSWORD'] = USER
+    os.environ['MONGO_DB_NAME'] = BENCHMARK_DB_NAME
+    if args.backend == 'mongodb':
+        os.environ['STORAGE_BACKEND'] = 'mongodb'
+        os.environ['LOCAL_STORAGE_BACKEND'] = 'memory'
+        os.environ['MONGODB_URI'] = args.mongo_uri or ''
+    else:
+        os.environ['STORAGE_BACKEND'] = args.backend
+        os.environ['MONGODB_URI'] = ''
+
+
+def use_mongodb(args, models):
+    """Switch the app to the benchmark MongoDB (or a mongomock one)"""
+    if args.mongo_uri:
+        if not models.start_mongo_monitor(wait=args.mongo_wait):
+            sys.exit(f'MongoDB at {args.mongo_uri} did not come up')
+        for collection in ('messages', 'dashboard', 'email_outbox'):
+            models.db[collection].drop()
+        models.ensure_indexes()
+        return
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit('--backend mongodb needs --mongo-uri or the mongomock package')
+    models._use_mongodb(mongomock.MongoClient()[BENCHMARK_DB_NAME])
+
+
+def seed(models, count, users):
+    """Insert ``count`` messages spread over ``users`` senders and the past year"""
+    backend = models.storage()
+    messages = getattr(backend, 'messages', None)
+    compact_every = getattr(messages, 'compact_every', None)
+    if compact_every:
+        # One snapshot at the end instead of one per compact_every records
+        messages.compact_every = float('inf')
+    start = datetime.now() - timedelta(days=365)
+    step = timedelta(days=365) / max(count, 1)
+    try:
+        for offset in range(0, count, SEED_BATCH):
+            backend.create_messages([
+                {
+                    'user_name': f'User {i % users}',
+                    'user_email': USER[0] if i % users == 0 else f'user{i % users}@example.com',
+                    'subject': f'Seeded message {i}',
+                    'message': 'Benchmark message body ' * 4,
+                    'status': ('unread', 'read', 'replied')[i % 3],
+                    'created_at': start + step * i,
+                    'replies': []
+                }
+                for i in range(offset, min(offset + SEED_BATCH, count))
+            ])
+    finally:
+        if compact_every:
+            messages.compact_every = compact_every
+            messages.compact()
+
+
+class InProcessClient:
+    """Requests through Flask's test client (no sockets, no HTTP parsing)"""
+
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def request(self, method, path, body=None, headers=None):
+        response = self._client.open(path, method=method, json=body, headers=headers)
+        return response.status_code, response.get_data()
+
+
+class SocketClient:
+    """Requests over a keep-alive HTTP connection to the local server"""
+
+    def __init__(self, port):
+        self.port = port
+        self._conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        for attempt in (1, 2):
+            if self._conn is None:
+                self._conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+            try:
+                self._conn.request(method, path, body=data, headers=headers)
+                response = self._conn.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                # Server closed the idle connection; reconnect once
+                self._conn.close()
+                self._conn = None
+                if attempt == 2:
+                    raise
+
+
+def serve(app):
+    """Start a threaded werkzeug server on a free local port"""
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class KeepAliveHandler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, name='benchmark-server', daemon=True).start()
+    return server
+
+
+class Context:
+    """Tokens and message ids the scenarios need, prepared once"""
+
+    def __init__(self, client, models):
+        self.admin = self._auth(client, *ADMIN)
+        self.user = self._auth(client, *USER)
+        self.message_ids = [m['_id'] for m in models.storage().query_messages(limit=1000)]
+        self.dashboard = json.loads(client.request('GET', '/api/dashboard')[1])['dashboard']
+
+    @staticmethod
+    def _auth(client, email, password):
+        status, body = client.request('POST', '/api/auth/login',
+                                      {'email': email, 'password': password})
+        if status != 200:
+            sys.exit(f'Login as {email} failed ({status}): {body[:200]!r}')
+        return {'Authorization': 'Bearer ' + json.loads(body)['access_token']}
+
+    def message_id(self, i):
+        return self.message_ids[i % len(self.message_ids)]
+
+
+def build_request(name, ctx, i):
+    """(method, path, body, headers) of request ``i`` of scenario ``name``"""
+    if name == 'login':
+        return 'POST', '/api/auth/login', {'email': USER[0], 'password': USER[1]}, None
+    if name == 'dashboard_get':
+        return 'GET', '/api/dashboard', None, None
+    if name == 'dashboard_put':
+        return 'PUT', '/api/dashboard', ctx.dashboard, ctx.admin
+    if name == 'message_send':
+        return 'POST', '/api/messages/send', {
+            'user_name': 'Benchmark', 'user_email': f'sender{i % 100}@example.com',
+            'subject': f'Benchmark {i}', 'message': 'Benchmark message body'
+        }, None
+    if name == 'message_list':
+        return 'GET', '/api/messages?limit=50', None, ctx.admin
+    if name == 'message_list_user':
+        return 'GET', '/api/messages?limit=50', None, ctx.user
+    if name == 'message_reply':
+        return 'POST', f'/api/messages/{ctx.message_id(i)}/reply', {'reply_text': f'Reply {i}'}, ctx.admin
+    if name == 'message_read':
+        return 'PUT', f'/api/messages/{ctx.message_id(i)}/read', None, ctx.admin
+    raise ValueError(f'Unknown scenario {name!r}')
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def run_scenario(name, make_client, ctx, requests, concurrency, warmup):
+    """Issue ``requests`` requests from ``concurrency`` threads; returns stats"""
+    clients = [make_client() for _ in range(concurrency)]
+    for i in range(warmup):
+        clients[0].request(*build_request(name, ctx, i))
+
+    counter = itertools.count(warmup)
+    end = warmup + requests
+    latencies = [[] for _ in clients]
+    errors = [0] * concurrency
+
+    def worker(n):
+        client, own = clients[n], latencies[n]
+        while True:
+            i = next(counter)
+            if i >= end:
+                return
+            method, path, body, headers = build_request(name, ctx, i)
+            started = time.perf_counter()
+            status, _ = client.request(method, path, body, headers)
+            own.append(time.perf_counter() - started)
+            if status >= 400:
+                errors[n] += 1
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    values = sorted(itertools.chain.from_iterable(latencies))
+    return {
+        'scenario': name,
+        'concurrency': concurrency,
+        'requests': len(values),
+        'errors': sum(errors),
+        'seconds': round(elapsed, 4),
+        'throughput': round(len(values) / elapsed, 2) if elapsed else 0.0,
+        'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3)
+    }
+
+
+def result_key(result):
+    return f"{result['scenario']}@{result['concurrency']}"
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of ``results`` against a saved baseline, as strings"""
+    previous = {result_key(r): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        base = previous.get(result_key(result))
+        if base is None:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{result_key(result)}: p95 {base['p95_ms']}ms -> {result['p95_ms']}ms")
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(f"{result_key(result)}: throughput {base['throughput']}/s -> "
+                               f"{result['throughput']}/s")
+        if result['errors'] > base['errors']:
+            regressions.append(f"{result_key(result)}: errors {base['errors']} -> {result['errors']}")
+    return regressions
+
+
+def print_table(results, out):
+    header = ('scenario', 'conc', 'reqs', 'err', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')
+    rows = [(r['scenario'], r['concurrency'], r['requests'], r['errors'], r['throughput'],
+             r['p50_ms'], r['p95_ms'], r['p99_ms']) for r in results]
+    widths = [max(len(str(v)) for v in column) for column in zip(header, *rows)]
+    for row in (header, *rows):
+        out.write('  '.join(str(v).rjust(w) for v, w in zip(row, widths)) + '\n')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Green Campus REST API')
+    parser.add_argument('--backend', choices=BACKENDS, default='file')
+    parser.add_argument('--mode', choices=('inprocess', 'socket'), default='inprocess')
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='messages seeded before the run (e.g. 1000 to 1000000)')
+    parser.add_argument('--users', type=int, default=100, help='distinct seeded senders')
+    parser.add_argument('--concurrency', default='1,8,32',
+                        help='comma-separated client thread counts')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per scenario and concurrency level')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'comma-separated subset of {", ".join(SCENARIOS)}')
+    parser.add_argument('--mongo-uri', default='',
+                        help='MongoDB server for --backend mongodb (default: mongomock)')
+    parser.add_argument('--mongo-wait', type=float, default=10.0)
+    parser.add_argument('--data-dir', help='directory for the local store (default: a temp dir)')
+    parser.add_argument('--save', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', help='baseline JSON to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative p95/throughput change before --compare fails')
+    args = parser.parse_args(argv)
+    args.concurrency = [int(c) for c in args.concurrency.split(',') if c]
+    args.scenarios = [s for s in args.scenarios.split(',') if s]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    out = sys.stdout
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='green-campus-benchmark-')
+    configure(args, data_dir)
+    quiet = contextlib.redirect_stdout(open(os.devnull, 'w'))
+    server = None
+    try:
+        with quiet:
+            import models
+            from app import app
+            if args.backend == 'mongodb':
+                use_mongodb(args, models)
+            started = time.perf_counter()
+            seed(models, args.messages, args.users)
+            out.write(f'Seeded {args.messages} messages into {models.storage().name} '
+                      f'in {time.perf_counter() - started:.2f}s\n')
+            if args.mode == 'socket':
+                server = serve(app)
+                make_client = lambda: SocketClient(server.server_port)
+            else:
+                make_client = lambda: InProcessClient(app)
+            ctx = Context(make_client(), models)
+            results = []
+            for name in args.scenarios:
+                for concurrency in args.concurrency:
+                    results.append(run_scenario(name, make_client, ctx, args.requests,
+                                                concurrency, args.warmup))
+                    out.write(f"  {result_key(results[-1])}: {results[-1]['throughput']} req/s\n")
+    finally:
+        if server is not None:
+            server.shutdown()
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    print_table(results, out)
+    report = {
+        'backend': args.backend,
+        'mode': args.mode,
+        'messages': args.messages,
+        'users': args.users,
+        'requests': args.requests,
+        'python': sys.version.split()[0],
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'results': results
+    }
+    if args.save:
+        directory = os.path.dirname(args.save)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        out.write(f'✓ Saved baseline to {args.save}\n')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if (baseline['backend'], baseline['mode'], baseline['messages']) != \
+                (args.backend, args.mode, args.messages):
+            out.write('⚠ Baseline was taken with a different backend, mode or dataset size\n')
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            out.write(f'✗ Regression {regression}\n')
+        if regressions:
+            return 1
+        out.write(f'✓ No regressions against {args.compare}\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,9 +6,97 @@ load_dotenv()
 class Config:
     """Base configuration"""
     MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/green_campus')
-    MONGO_DB_NAME = 'green_campus'
+    MONGO_DB_NAME = os.getenv('MONGO_DB_NAME', 'green_campus')
     JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY', 'your-secret-key-change-in-production')
+    # Password hashing (scrypt cost: N must be a power of two; raising it
+    # rehashes each password at its next login) and the verification pool:
+    # threads per process, checks queued before logins get 503, and seconds
+    # a login waits for its check
+    PASSWORD_SCRYPT_N = int(os.getenv('PASSWORD_SCRYPT_N', 2 ** 14))
+    PASSWORD_SCRYPT_R = int(os.getenv('PASSWORD_SCRYPT_R', 8))
+    PASSWORD_SCRYPT_P = int(os.getenv('PASSWORD_SCRYPT_P', 1))
+    PASSWORD_VERIFY_WORKERS = int(os.getenv('PASSWORD_VERIFY_WORKERS', 2))
+    PASSWORD_VERIFY_MAX_PENDING = int(os.getenv('PASSWORD_VERIFY_MAX_PENDING', 64))
+    PASSWORD_VERIFY_TIMEOUT = float(os.getenv('PASSWORD_VERIFY_TIMEOUT', 10))
+    # Recently verified access tokens kept per process so hot tokens skip
+    # signature verification until they expire (0 disables)
+    JWT_VERIFIED_CACHE_SIZE = int(os.getenv('JWT_VERIFIED_CACHE_SIZE', 1024))
+
+    # Storage for users, messages and the dashboard: 'mongodb' (falling back
+    # to LOCAL_STORAGE_BACKEND while the server is unreachable), or a
+    # single-node 'sqlite', 'file' or 'memory' backend; DATA_DIR (the local
+    # files) defaults to data/ next to the code and SQLITE_PATH to
+    # DATA_DIR/green_campus.db
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'mongodb').lower()
+    LOCAL_STORAGE_BACKEND = os.getenv('LOCAL_STORAGE_BACKEND', 'file').lower()
+    SQLITE_PATH = os.getenv('SQLITE_PATH', '')
+    DATA_DIR = os.getenv('DATA_DIR', '')
+
+    # MongoDB health probe: milliseconds before an unreachable server counts
+    # as down, and seconds between pings (an empty MONGODB_URI disables
+    # MongoDB and keeps the local store)
+    MONGO_TIMEOUT_MS = int(os.getenv('MONGO_TIMEOUT_MS', 5000))
+    MONGO_PROBE_INTERVAL = float(os.getenv('MONGO_PROBE_INTERVAL', 5))
     
+    # File-based storage: records appended to the message log before it is
+    # folded into a fresh messages.json snapshot
+    MESSAGE_LOG_COMPACT_EVERY = int(os.getenv('MESSAGE_LOG_COMPACT_EVERY', 1000))
+
+    # Group commit of new messages: most messages written together, and
+    # milliseconds the writer waits for more to join a batch (a max of 1
+    # writes each message on its own)
+    MESSAGE_BATCH_MAX = int(os.getenv('MESSAGE_BATCH_MAX', 256))
+    MESSAGE_BATCH_WINDOW_MS = float(os.getenv('MESSAGE_BATCH_WINDOW_MS', 2))
+
+    # Largest page GET /api/messages will return for ?limit=
+    MESSAGES_MAX_PAGE_SIZE = int(os.getenv('MESSAGES_MAX_PAGE_SIZE', 500))
+
+    # Most message ids one POST /api/messages/bulk may name
+    MESSAGES_BULK_MAX = int(os.getenv('MESSAGES_BULK_MAX', 5000))
+
+    # Seconds a MongoDB write may take to land after drawing its revision:
+    # /api/messages/changes holds back a newer change behind a missing
+    # revision for this long, so no sync token skips the slower write
+    MESSAGE_SYNC_SETTLE_SECONDS = float(os.getenv('MESSAGE_SYNC_SETTLE_SECONDS', 5))
+
+    # Seconds a cached response body (GET /api/dashboard) is reused before it
+    # is rebuilt, which bounds staleness after a write in another worker, and
+    # the max-age browsers may reuse the dashboard without revalidating
+    RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 5))
+    DASHBOARD_MAX_AGE = int(os.getenv('DASHBOARD_MAX_AGE', 0))
+
+    # Messages whose serialized JSON is kept per process for list responses
+    # (each entry is valid until the message's next write; 0 disables)
+    MESSAGE_FRAGMENT_CACHE_SIZE = int(os.getenv('MESSAGE_FRAGMENT_CACHE_SIZE', 50000))
+
+    # GET /api/stream (Server-Sent Events): most open connections per
+    # process, recent events kept for clients resuming with Last-Event-ID
+    # (also each client's queue length before it is told to resync), and
+    # seconds between keepalive comments on an idle connection
+    STREAM_MAX_CLIENTS = int(os.getenv('STREAM_MAX_CLIENTS', 200))
+    STREAM_BACKLOG = int(os.getenv('STREAM_BACKLOG', 256))
+    STREAM_HEARTBEAT_SECONDS = float(os.getenv('STREAM_HEARTBEAT_SECONDS', 15))
+
+    # Logging: minimum level, 'text' or 'json' lines, and the share of
+    # requests whose DEBUG records are kept when LOG_LEVEL is DEBUG
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+    LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', 0.1))
+
+    # GET /api/metrics: bearer token scrapers send (empty: admins only), and
+    # the per-request sampling profiler (?profile=1 returns the request's
+    # folded stacks instead of its body; keep it off in production) with its
+    # sampling interval
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+    PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', 'false').lower() == 'true'
+    PROFILER_INTERVAL_MS = float(os.getenv('PROFILER_INTERVAL_MS', 5))
+
+    # Meter reading ingestion: shared key meters send as X-API-Key (empty:
+    # admins only) and the largest batch accepted per request
+    INGEST_API_KEY = os.getenv('INGEST_API_KEY', '')
+    READINGS_MAX_BATCH = int(os.getenv('READINGS_MAX_BATCH', 10000))
+    READINGS_MAX_BUCKETS = int(os.getenv('READINGS_MAX_BUCKETS', 10000))
+
     # Admin credentials
     ADMIN_EMAIL = os.getenv('ADMIN_EMAIL', 'admin@greencampus.com')
     ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'admin123')
@@ -22,3 +110,19 @@ class Config:
     SMTP_PORT = int(os.getenv('SMTP_PORT', 587))
     EMAIL_ADDRESS = os.getenv('EMAIL_ADDRESS', 'your-email@gmail.com')
     EMAIL_PASSWORD = os.getenv('EMAIL_PASSWORD', 'your-app-password')
+    SMTP_USE_TLS = os.getenv('SMTP_USE_TLS', 'true').lower() == 'true'
+    SMTP_TIMEOUT = float(os.getenv('SMTP_TIMEOUT', 30))
+    # Pooled SMTP sessions: concurrent sessions per process, seconds an idle
+    # session is kept, and messages sent before a session is recycled
+    SMTP_POOL_SIZE = int(os.getenv('SMTP_POOL_SIZE', 2))
+    SMTP_MAX_IDLE_SECONDS = float(os.getenv('SMTP_MAX_IDLE_SECONDS', 60))
+    SMTP_MAX_MESSAGES_PER_SESSION = int(os.getenv('SMTP_MAX_MESSAGES_PER_SESSION', 100))
+
+    # Outbound email queue: worker threads per process, delivery attempts
+    # before a reply email is dead-lettered, emails a worker sends per
+    # SMTP session, and the retry backoff window
+    EMAIL_WORKERS = int(os.getenv('EMAIL_WORKERS', 2))
+    EMAIL_MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', 5))
+    EMAIL_BATCH_SIZE = int(os.getenv('EMAIL_BATCH_SIZE', 20))
+    EMAIL_RETRY_BASE_SECONDS = float(os.getenv('EMAIL_RETRY_BASE_SECONDS', 30))
+    EMAIL_RETRY_MAX_SECONDS = float(os.getenv('EMAIL_RETRY_MAX_SECONDS', 3600))
@@ -0,0 +1,98 @@
+"""Fixtures shared by the test modules."""
+import socketserver
+import threading
+import pytest
+
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    """Just enough of an SMTP server to deliver to, on a free local port.
+
+    Keeps the messages it accepted and counts connections. ``faults`` maps
+    a command (EHLO, MAIL, RCPT, DATA, or END for the end of the message
+    data) to a list of actions for its next occurrences: 'drop' closes
+    the connection (at END, after accepting the message), anything else
+    is sent as the reply, e.g. '451 Try again later'.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _StubSMTPHandler)
+        self.messages = []
+        self.connections = 0
+        self.faults = {}
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def fail(self, command, *actions):
+        with self.lock:
+            self.faults.setdefault(command, []).extend(actions)
+
+    def take_fault(self, command):
+        with self.lock:
+            actions = self.faults.get(command)
+            return actions.pop(0) if actions else None
+
+
+class _StubSMTPHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 stub ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.split(b' ', 1)[0].split(b':', 1)[0].strip().upper().decode()
+            fault = server.take_fault(command)
+            if fault == 'drop':
+                return
+            if fault:
+                self.reply(fault)
+            elif command in ('EHLO', 'HELO'):
+                self.reply('250 stub')
+            elif command in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    if line == b'.\r\n':
+                        break
+                    lines.append(line)
+                fault = server.take_fault('END')
+                if fault and fault != 'drop':
+                    self.reply(fault)
+                    continue
+                with server.lock:
+                    server.messages.append(b''.join(lines))
+                if fault == 'drop':
+                    return
+                self.reply('250 OK queued')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+@pytest.fixture
+def smtp_server():
+    server = StubSMTPServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
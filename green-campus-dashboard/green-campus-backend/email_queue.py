@@ -0,0 +1,344 @@
+import os
+import time
+import random
+import sqlite3
+import threading
+from datetime import datetime
+from bson import ObjectId
+from pymongo import ReturnDocument
+from config import Config
+import models
+import metrics
+from models import DATA_DIR
+from email_utils import build_admin_reply_email, deliver_emails
+from logs import get_logger
+
+OUTBOX_DB_FILE = os.path.join(DATA_DIR, 'outbox.db')
+
+logger = get_logger(__name__)
+
+# How long a claimed email stays owned by a worker before another worker
+# may pick it up again (covers a process dying mid-send)
+LEASE_SECONDS = 300
+
+# Delivery states exposed through the status endpoint
+QUEUED, SENDING, RETRYING, SENT, DEAD = 'queued', 'sending', 'retrying', 'sent', 'dead'
+
+_PUBLIC_FIELDS = ('_id', 'message_id', 'to', 'status', 'attempts', 'last_error',
+                  'created_at', 'updated_at', 'sent_at')
+
+_local = threading.local()
+
+
+def _sqlite():
+    """Per-thread connection to the local outbox database"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        if not os.path.exists(DATA_DIR):
+            os.makedirs(DATA_DIR, exist_ok=True)
+        conn = sqlite3.connect(OUTBOX_DB_FILE, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS email_outbox (
+                _id TEXT PRIMARY KEY,
+                message_id TEXT,
+                "to" TEXT NOT NULL,
+                user_name TEXT,
+                subject TEXT,
+                reply_text TEXT,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                lease_until REAL,
+                last_error TEXT,
+                created_at TEXT,
+                updated_at TEXT,
+                sent_at TEXT
+            )''')
+        conn.execute('CREATE INDEX IF NOT EXISTS outbox_due '
+                     'ON email_outbox (status, next_attempt_at)')
+        _local.conn = conn
+    return conn
+
+
+def _backoff(attempts):
+    """Seconds to wait before retry number ``attempts`` (1-based), with jitter"""
+    delay = min(Config.EMAIL_RETRY_MAX_SECONDS,
+                Config.EMAIL_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+    return delay + random.uniform(0, delay * 0.1)
+
+
+class EmailOutbox:
+    """Persistent queue of outbound reply emails.
+
+    Stored in the ``email_outbox`` Mongo collection when MongoDB is in use,
+    otherwise in a local SQLite file, so queued emails survive restarts
+    and can be claimed by workers in any process.
+    """
+
+    @staticmethod
+    def enqueue(delivery_id, message_id, to, user_name, subject, reply_text):
+        """Queue a reply email for delivery and return its delivery id"""
+        return EmailOutbox.enqueue_many([(delivery_id, message_id, to, user_name, subject,
+                                          reply_text)])[0]
+
+    @staticmethod
+    def enqueue_many(emails):
+        """Queue several reply emails in one write; ``emails`` are tuples of
+        enqueue's arguments. Returns their delivery ids."""
+        now = datetime.now().isoformat()
+        jobs = [{
+            '_id': delivery_id,
+            'message_id': message_id,
+            'to': to,
+            'user_name': user_name,
+            'subject': subject,
+            'reply_text': reply_text,
+            'status': QUEUED,
+            'attempts': 0,
+            'next_attempt_at': time.time(),
+            'lease_until': None,
+            'last_error': None,
+            'created_at': now,
+            'updated_at': now,
+            'sent_at': None
+        } for delivery_id, message_id, to, user_name, subject, reply_text in emails]
+        if not jobs:
+            return []
+        if models.USE_MONGODB:
+            models.db['email_outbox'].insert_many(jobs)
+        else:
+            columns = ', '.join(f'"{k}"' for k in jobs[0])
+            placeholders = ', '.join('?' for _ in jobs[0])
+            conn = _sqlite()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany(f'INSERT INTO email_outbox ({columns}) VALUES ({placeholders})',
+                                 [tuple(job.values()) for job in jobs])
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        _wakeup.set()
+        return [job['_id'] for job in jobs]
+
+    @staticmethod
+    def claim(limit=1):
+        """Atomically take up to ``limit`` due emails for sending.
+
+        Each job's ``outbox`` ('mongodb' or 'sqlite') records where it was
+        claimed, so mark_sent and mark_failed update that copy even if the
+        backend switches while it is being sent.
+        """
+        now = time.time()
+        due = [
+            {'status': {'$in': [QUEUED, RETRYING]}, 'next_attempt_at': {'$lte': now}},
+            {'status': SENDING, 'lease_until': {'$lte': now}}
+        ]
+        if models.USE_MONGODB:
+            jobs = []
+            for _ in range(limit):
+                job = models.db['email_outbox'].find_one_and_update(
+                    {'$or': due},
+                    {'$set': {'status': SENDING, 'lease_until': now + LEASE_SECONDS},
+                     '$inc': {'attempts': 1}},
+                    sort=[('next_attempt_at', 1)],
+                    return_document=ReturnDocument.AFTER
+                )
+                if job is None:
+                    break
+                jobs.append(dict(job, outbox='mongodb'))
+            return jobs
+
+        conn = _sqlite()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                'SELECT _id FROM email_outbox '
+                'WHERE (status IN (?, ?) AND next_attempt_at <= ?) '
+                'OR (status = ? AND lease_until <= ?) '
+                'ORDER BY next_attempt_at LIMIT ?',
+                (QUEUED, RETRYING, now, SENDING, now, limit)
+            ).fetchall()
+            ids = [row['_id'] for row in rows]
+            if ids:
+                marks = ', '.join('?' for _ in ids)
+                conn.execute(
+                    f'UPDATE email_outbox SET status = ?, lease_until = ?, attempts = attempts + 1 '
+                    f'WHERE _id IN ({marks})',
+                    (SENDING, now + LEASE_SECONDS, *ids)
+                )
+                rows = conn.execute(f'SELECT * FROM email_outbox WHERE _id IN ({marks})', ids).fetchall()
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return [dict(row, outbox='sqlite') for row in rows] if ids else []
+
+    @staticmethod
+    def _update(job, fields):
+        """Set ``fields`` on a claimed job in the outbox it was claimed from"""
+        fields['updated_at'] = datetime.now().isoformat()
+        if job['outbox'] == 'sqlite':
+            assignments = ', '.join(f'"{k}" = ?' for k in fields)
+            cursor = _sqlite().execute(f'UPDATE email_outbox SET {assignments} WHERE _id = ?',
+                                       (*fields.values(), job['_id']))
+            if cursor.rowcount or not models.USE_MONGODB:
+                return
+            # Moved to the MongoDB outbox while it was being sent
+            # (see _move_outbox_to_mongodb)
+        models.db['email_outbox'].update_one({'_id': job['_id']}, {'$set': fields})
+
+    @staticmethod
+    def mark_sent(job):
+        EmailOutbox._update(job, {
+            'status': SENT,
+            'lease_until': None,
+            'last_error': None,
+            'sent_at': datetime.now().isoformat()
+        })
+
+    @staticmethod
+    def mark_failed(job, error):
+        """Schedule a retry with exponential backoff, or dead-letter the email"""
+        if job['attempts'] >= Config.EMAIL_MAX_ATTEMPTS:
+            EmailOutbox._update(job, {'status': DEAD, 'lease_until': None,
+                                             'last_error': str(error)})
+            logger.error("Email %s to %s dead-lettered after %d attempts: %s",
+                         job['_id'], job['to'], job['attempts'], error)
+            return
+        EmailOutbox._update(job, {
+            'status': RETRYING,
+            'lease_until': None,
+            'last_error': str(error),
+            'next_attempt_at': time.time() + _backoff(job['attempts'])
+        })
+
+    @staticmethod
+    def get(delivery_id):
+        """Return the public delivery state of one email, or None"""
+        if models.USE_MONGODB:
+            job = models.db['email_outbox'].find_one({'_id': delivery_id})
+        else:
+            row = _sqlite().execute('SELECT * FROM email_outbox WHERE _id = ?',
+                                    (delivery_id,)).fetchone()
+            job = dict(row) if row else None
+        if not job:
+            return None
+        return {field: job.get(field) for field in _PUBLIC_FIELDS}
+
+    @staticmethod
+    def depth():
+        """Number of emails waiting to be sent"""
+        if models.USE_MONGODB:
+            return models.db['email_outbox'].count_documents({'status': {'$in': [QUEUED, RETRYING, SENDING]}})
+        row = _sqlite().execute('SELECT COUNT(*) FROM email_outbox WHERE status IN (?, ?, ?)',
+                                (QUEUED, RETRYING, SENDING)).fetchone()
+        return row[0]
+
+
+metrics.Gauge('email_outbox_depth', 'Reply emails waiting to be sent', callback=EmailOutbox.depth)
+
+
+def _move_outbox_to_mongodb(use_mongodb):
+    """Hand the SQLite outbox written while MongoDB was down to the Mongo
+    outbox: queued emails to be sent, and sent or dead ones so their
+    delivery status can still be looked up"""
+    if not use_mongodb or not os.path.exists(OUTBOX_DB_FILE):
+        return
+    conn = _sqlite()
+    rows = conn.execute('SELECT * FROM email_outbox').fetchall()
+    for row in rows:
+        job = dict(row)
+        delivery_id = job.pop('_id')
+        models.db['email_outbox'].update_one({'_id': delivery_id}, {'$setOnInsert': job}, upsert=True)
+        conn.execute('DELETE FROM email_outbox WHERE _id = ?', (delivery_id,))
+    if rows:
+        logger.info("Moved %d email(s) to the MongoDB outbox", len(rows))
+        _wakeup.set()
+
+
+models.on_backend_change(_move_outbox_to_mongodb)
+
+
+def queue_admin_reply_email(message_id, user_email, user_name, subject, reply_text,
+                            delivery_id=None):
+    """Queue an admin reply email; returns the delivery id"""
+    return EmailOutbox.enqueue(delivery_id or str(ObjectId()), message_id,
+                               user_email, user_name, subject, reply_text)
+
+
+def queue_admin_reply_emails(replies):
+    """Queue the emails of several admin replies in one outbox write.
+
+    ``replies`` holds (delivery_id, message, reply_text) per reply, the
+    message being the one replied to; returns the delivery ids.
+    """
+    return EmailOutbox.enqueue_many([
+        (delivery_id, message['_id'], message['user_email'], message['user_name'],
+         message['subject'], reply_text)
+        for delivery_id, message, reply_text in replies
+    ])
+
+
+# ==================== Worker pool ====================
+
+_wakeup = threading.Event()
+_workers = []
+_workers_lock = threading.Lock()
+
+
+def _deliver(jobs):
+    """Send claimed emails as one batch over a pooled session"""
+    try:
+        results = deliver_emails([
+            build_admin_reply_email(job['to'], job['user_name'], job['subject'], job['reply_text'])
+            for job in jobs
+        ])
+    except Exception as e:
+        results = [e] * len(jobs)
+    for job, error in zip(jobs, results):
+        try:
+            if error is None:
+                EmailOutbox.mark_sent(job)
+            else:
+                EmailOutbox.mark_failed(job, error)
+        except Exception:
+            # Left claimed: picked up again once its lease expires
+            logger.exception("Could not record the delivery of email %s", job['_id'])
+
+
+def _work_once():
+    """Claim and send one batch of due emails; returns how many were claimed"""
+    try:
+        jobs = EmailOutbox.claim(Config.EMAIL_BATCH_SIZE)
+    except Exception as e:
+        logger.error("Email worker could not read the outbox: %s", e)
+        return 0
+    if jobs:
+        try:
+            _deliver(jobs)
+        except Exception:
+            # Keep the worker alive; unmarked jobs are claimed again once
+            # their lease expires
+            logger.exception("Email worker failed on a batch of %d", len(jobs))
+    return len(jobs)
+
+
+def _worker_loop(poll_interval):
+    while True:
+        if not _work_once():
+            _wakeup.wait(poll_interval)
+            _wakeup.clear()
+
+
+def start_email_workers(count=None, poll_interval=5.0):
+    """Start the background delivery threads once per process"""
+    count = Config.EMAIL_WORKERS if count is None else count
+    with _workers_lock:
+        while len(_workers) < count:
+            worker = threading.Thread(target=_worker_loop, args=(poll_interval,),
+                                      name=f'email-worker-{len(_workers) + 1}', daemon=True)
+            worker.start()
+            _workers.append(worker)
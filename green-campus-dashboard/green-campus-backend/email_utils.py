@@ -1,43 +1,255 @@
+import time
+import queue
 import smtplib
+import threading
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from config import Config
+from metrics import SMTP_CONNECT_SECONDS, SMTP_SEND_SECONDS
+from logs import get_logger
 
-def send_admin_reply_email(user_email, user_name, subject, reply_text):
-    """Send admin reply to user via email"""
-    try:
-        # Create message
-        message = MIMEMultipart()
-        message['From'] = Config.EMAIL_ADDRESS
-        message['To'] = user_email
-        message['Subject'] = f"Re: {subject}"
-        
-        # Email body
-        body = f"""
+logger = get_logger(__name__)
+
+
+def build_admin_reply_email(user_email, user_name, subject, reply_text):
+    """Build the email carrying an admin reply to a user"""
+    message = MIMEMultipart()
+    message['From'] = Config.EMAIL_ADDRESS
+    message['To'] = user_email
+    message['Subject'] = f"Re: {subject}"
+
+    # Email body
+    body = f"""
         Hello {user_name},
-        
+
         Thank you for reaching out to Green Campus Dashboard.
-        
+
         Here is the admin's reply to your inquiry:
-        
+
         {reply_text}
-        
+
         If you have any further questions, feel free to contact us again.
-        
+
         Best regards,
         Green Campus Team
         """
-        
-        message.attach(MIMEText(body, 'plain'))
-        
-        # Send email
-        server = smtplib.SMTP(Config.SMTP_SERVER, Config.SMTP_PORT)
-        server.starttls()
-        server.login(Config.EMAIL_ADDRESS, Config.EMAIL_PASSWORD)
-        server.send_message(message)
-        server.quit()
-        
+
+    message.attach(MIMEText(body, 'plain'))
+    return message
+
+
+class _SMTP(smtplib.SMTP):
+    """smtplib.SMTP noting whether the message being sent reached DATA"""
+
+    handed_over = False
+
+    def data(self, msg):
+        # From here the server may accept the message even if the
+        # connection then fails before its reply arrives
+        self.handed_over = True
+        return super().data(msg)
+
+
+class SMTPMailer:
+    """Pool of authenticated SMTP sessions reused across sends.
+
+    Sessions are opened on demand (at most ``pool_size`` at once), kept
+    alive between sends and recycled after ``max_idle`` seconds or
+    ``max_messages`` messages, also within a batch. A session the server
+    dropped is replaced; the message is retried once on the fresh
+    connection only if it was dropped before the message was handed over
+    (DATA), since after that the server may already have accepted it.
+    """
+
+    def __init__(self, host, port, username=None, password=None, use_tls=True,
+                 timeout=30, pool_size=2, max_idle=60, max_messages=100):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_messages = max_messages
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            Config.SMTP_SERVER,
+            Config.SMTP_PORT,
+            username=Config.EMAIL_ADDRESS,
+            password=Config.EMAIL_PASSWORD,
+            use_tls=Config.SMTP_USE_TLS,
+            timeout=Config.SMTP_TIMEOUT,
+            pool_size=Config.SMTP_POOL_SIZE,
+            max_idle=Config.SMTP_MAX_IDLE_SECONDS,
+            max_messages=Config.SMTP_MAX_MESSAGES_PER_SESSION
+        )
+
+    def _connect(self):
+        started = time.perf_counter()
+        server = _SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.use_tls:
+                server.starttls()
+            if self.password:
+                server.login(self.username, self.password)
+        except Exception:
+            self._close(server)
+            raise
+        SMTP_CONNECT_SECONDS.observe(time.perf_counter() - started)
+        return {'server': server, 'last_used': time.monotonic(), 'sent': 0}
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    def _acquire(self):
+        """Take an idle live session, or open a new one"""
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - session['last_used'] < self.max_idle:
+                return session
+            self._close(session['server'])
+
+    def _release(self, session):
+        session['last_used'] = time.monotonic()
+        if session['sent'] >= self.max_messages:
+            self._close(session['server'])
+        else:
+            self._idle.put(session)
+
+    @staticmethod
+    def _send(session, message):
+        started = time.perf_counter()
+        result = 'failed'
+        session['server'].handed_over = False
+        try:
+            session['server'].send_message(message)
+            result = 'sent'
+        finally:
+            SMTP_SEND_SECONDS.observe(time.perf_counter() - started, result=result)
+
+    @staticmethod
+    def _dropped(error):
+        """Whether a send failed because the connection was lost, rather
+        than being refused by the server (SMTPException is an OSError)"""
+        return (isinstance(error, smtplib.SMTPServerDisconnected)
+                or not isinstance(error, smtplib.SMTPException))
+
+    def send_many(self, messages):
+        """Send messages over one pooled session.
+
+        Returns one entry per message: None when it was accepted, otherwise
+        the exception that made it fail. Raises only if no session can be
+        opened at all, before anything was sent; once the batch has
+        started, a failure to reconnect fails the remaining messages.
+        """
+        results = []
+        with self._slots:
+            session = self._acquire()
+            try:
+                for message in messages:
+                    if session is None or session['sent'] >= self.max_messages:
+                        # Replace a dropped session, or recycle a full one
+                        if session is not None:
+                            self._close(session['server'])
+                            session = None
+                        session = self._connect()
+                    try:
+                        self._send(session, message)
+                    except OSError as e:
+                        if not self._dropped(e):
+                            results.append(e)
+                            continue
+                        handed_over = session['server'].handed_over
+                        self._close(session['server'])
+                        session = None
+                        if handed_over:
+                            # Possibly accepted already: retrying here could
+                            # deliver it twice, so leave it to the caller
+                            results.append(e)
+                            continue
+                        # Dropped before the message was handed over (idle
+                        # timeout, restart): retry it once on a fresh session
+                        session = self._connect()
+                        try:
+                            self._send(session, message)
+                        except OSError as e:
+                            if self._dropped(e):
+                                self._close(session['server'])
+                                session = None
+                            results.append(e)
+                            continue
+                    session['sent'] += 1
+                    results.append(None)
+            except Exception as e:
+                # No session could be opened, or the current one is in an
+                # unknown state: drop it and fail the remaining messages
+                if session is not None:
+                    self._close(session['server'])
+                    session = None
+                results.extend([e] * (len(messages) - len(results)))
+            if session is not None:
+                self._release(session)
+        return results
+
+    def send(self, message):
+        """Send one message; raises on failure"""
+        error = self.send_many([message])[0]
+        if error is not None:
+            raise error
+
+    def close(self):
+        """Close all idle sessions"""
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(session['server'])
+
+
+_mailer = None
+_mailer_lock = threading.Lock()
+
+
+def get_mailer():
+    """Process-wide pooled mailer built from Config"""
+    global _mailer
+    if _mailer is None:
+        with _mailer_lock:
+            if _mailer is None:
+                _mailer = SMTPMailer.from_config()
+    return _mailer
+
+
+def deliver_email(message):
+    """Send a built email over a pooled SMTP session; raises on failure"""
+    get_mailer().send(message)
+
+
+def deliver_emails(messages):
+    """Send built emails over one pooled SMTP session.
+
+    Returns None or the failure exception for each message.
+    """
+    return get_mailer().send_many(messages)
+
+
+def send_admin_reply_email(user_email, user_name, subject, reply_text):
+    """Send admin reply to user via email"""
+    try:
+        deliver_email(build_admin_reply_email(user_email, user_name, subject, reply_text))
         return True
     except Exception as e:
-        print(f"Error sending email: {e}")
+        logger.error("Error sending email: %s", e)
         return False
@@ -0,0 +1,275 @@
+import os
+import queue
+import threading
+from collections import deque
+from datetime import datetime
+from pymongo import errors
+from config import Config
+import metrics
+import json_codec
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+EVENTS_PUBLISHED = metrics.Counter('stream_events_published_total',
+                                   'Change events published to stream subscribers', ('type',))
+STREAM_RESYNCS = metrics.Counter('stream_resyncs_total',
+                                 'Subscribers told to refetch instead of getting missed events',
+                                 ('reason',))
+
+# Prefix of this process's event ids: an id from another process (or from
+# before a restart) cannot be resumed from and triggers a resync
+_BOOT = os.urandom(4).hex()
+
+RESYNC_FRAME = b'event: resync\ndata: {}\n\n'
+HEARTBEAT_FRAME = b': keepalive\n\n'
+
+
+class TooManySubscribers(RuntimeError):
+    """The stream already has its maximum number of clients"""
+
+
+class Event:
+    """One change, serialized once as a Server-Sent Events frame.
+
+    ``owner`` is the email of the user the change concerns; ``public``
+    events (the dashboard) go to every subscriber, the others to admins
+    and the owner.
+    """
+
+    __slots__ = ('seq', 'type', 'owner', 'public', 'frame')
+
+    def __init__(self, seq, event_type, data, owner=None, public=False):
+        self.seq = seq
+        self.type = event_type
+        self.owner = owner
+        self.public = public
+        self.frame = (f'id: {_BOOT}-{seq}\nevent: {event_type}\ndata: '.encode('utf-8')
+                      + json_codec.dumps(data) + b'\n\n')
+
+    def visible_to(self, email, role):
+        return self.public or role == 'admin' or (email is not None and self.owner == email)
+
+
+class Subscription:
+    """A client's queue of pending frames; see EventBus.subscribe"""
+
+    def __init__(self, bus, email, role, size):
+        self.email = email
+        self.role = role
+        self._bus = bus
+        self._frames = queue.Queue(size)
+        # Why the client must refetch instead (None: it need not)
+        self._resync = None
+
+    def _offer(self, event):
+        if not event.visible_to(self.email, self.role):
+            return
+        try:
+            self._frames.put_nowait(event.frame)
+        except queue.Full:
+            # A client this far behind refetches rather than holding
+            # memory for events it may never read
+            self._resync = 'overflow'
+
+    def next_frame(self, timeout):
+        """The next frame to send, waiting up to ``timeout`` seconds and
+        returning a heartbeat comment if nothing happened"""
+        if self._resync is not None:
+            STREAM_RESYNCS.inc(reason=self._resync)
+            self._resync = None
+            while not self._frames.empty():
+                self._frames.get_nowait()
+            return RESYNC_FRAME
+        try:
+            return self._frames.get(timeout=timeout)
+        except queue.Empty:
+            return HEARTBEAT_FRAME
+
+    def close(self):
+        self._bus._unsubscribe(self)
+
+
+class EventBus:
+    """In-process fanout of change events to stream subscribers.
+
+    ``publish`` serializes an event once and offers it to every
+    subscriber allowed to see it without blocking: each has a bounded
+    queue drained by its own response thread. The last ``backlog``
+    events are kept so a reconnecting client (Last-Event-ID) gets what
+    it missed, or a resync event when that is no longer possible.
+    """
+
+    def __init__(self, max_subscribers=200, backlog=256):
+        self.max_subscribers = max_subscribers
+        self.backlog = backlog
+        # True while a ChangeStreamRelay publishes the database's changes
+        self.relayed = False
+        self._seq = 0
+        self._recent = deque(maxlen=backlog)
+        self._subscribers = set()
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def listen(self, callback):
+        """Call ``callback(event_type)`` synchronously for every published
+        event, e.g. to drop caches the change makes stale"""
+        self._listeners.append(callback)
+
+    def publish(self, event_type, data, owner=None, public=False):
+        for callback in self._listeners:
+            try:
+                callback(event_type)
+            except Exception:
+                logger.exception("Event listener failed")
+        with self._lock:
+            self._seq += 1
+            event = Event(self._seq, event_type, data, owner=owner, public=public)
+            self._recent.append(event)
+            for subscription in self._subscribers:
+                subscription._offer(event)
+        EVENTS_PUBLISHED.inc(type=event_type)
+
+    def subscribe(self, email=None, role=None, last_event_id=None):
+        """Register a subscriber and return its Subscription.
+
+        With ``last_event_id`` the events after it are queued first, or a
+        resync when they are no longer all kept. Raises
+        TooManySubscribers when the bus is full.
+        """
+        subscription = Subscription(self, email, role, self.backlog)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                raise TooManySubscribers('Too many stream clients')
+            if last_event_id:
+                self._replay(subscription, last_event_id)
+            self._subscribers.add(subscription)
+        return subscription
+
+    def _replay(self, subscription, last_event_id):
+        boot, _, seq = last_event_id.partition('-')
+        missed_from = int(seq) + 1 if boot == _BOOT and seq.isdigit() else None
+        if missed_from is None or (missed_from <= self._seq and
+                                   (not self._recent or self._recent[0].seq > missed_from)):
+            subscription._resync = 'reconnect'
+            return
+        for event in self._recent:
+            if event.seq >= missed_from:
+                subscription._offer(event)
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+
+# ---------- MongoDB change streams ----------
+
+# Collections whose changes are relayed (the rollups change too often and
+# are announced by the process that ingests the readings)
+_WATCHED = ('messages', 'dashboard')
+
+
+def _public_doc(doc):
+    doc = dict(doc)
+    doc['_id'] = str(doc['_id'])
+    doc.pop('rev_at', None)
+    return doc
+
+
+class ChangeStreamRelay:
+    """Publishes a MongoDB database's message and dashboard changes on a bus.
+
+    Change streams need a replica set (or sharded cluster); with one, the
+    events of writes made by every worker process reach every process's
+    subscribers, and the models stop publishing their own. On a
+    standalone server ``start`` returns False and the in-process events
+    are used instead.
+    """
+
+    def __init__(self, database, bus):
+        self.database = database
+        self.bus = bus
+        self._stream = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        try:
+            self._stream = self.database.watch(
+                [{'$match': {'ns.coll': {'$in': list(_WATCHED)}}}],
+                full_document='updateLookup',
+                max_await_time_ms=1000
+            )
+        except Exception as e:
+            # A standalone server (OperationFailure), or a client without
+            # change stream support at all
+            logger.info("MongoDB change streams unavailable (%s); using in-process events", e)
+            return False
+        self.bus.relayed = True
+        self._thread = threading.Thread(target=self._loop, name='change-stream-relay', daemon=True)
+        self._thread.start()
+        logger.info("Relaying MongoDB change streams to stream clients")
+        return True
+
+    def stop(self):
+        self._stop.set()
+        self.bus.relayed = False
+        if self._stream is not None:
+            try:
+                self._stream.close()
+            except errors.PyMongoError:
+                pass
+
+    def _loop(self):
+        try:
+            while not self._stop.is_set():
+                change = self._stream.try_next()
+                if change is not None:
+                    self._relay(change)
+        except errors.PyMongoError as e:
+            if not self._stop.is_set():
+                logger.warning("MongoDB change stream ended: %s; using in-process events", e)
+        finally:
+            self.bus.relayed = False
+
+    def _relay(self, change):
+        collection = change['ns']['coll']
+        operation = change['operationType']
+        if collection == 'dashboard':
+            self.bus.publish('dashboard', {'updated_at': datetime.now()}, public=True)
+            return
+        message_id = str(change['documentKey']['_id'])
+        doc = change.get('fullDocument')
+        if operation == 'delete':
+            # The document is gone, so only admins learn of the deletion
+            self.bus.publish('message_deleted', {'_id': message_id})
+            return
+        if doc is None:
+            return
+        owner = doc.get('user_email')
+        # Besides the change itself, every write sets the revision (rev, rev_at)
+        updated = change.get('updateDescription', {}).get('updatedFields', {})
+        if operation == 'update' and any(field.split('.')[0] == 'replies' for field in updated):
+            self.bus.publish('message_reply', {'_id': message_id, 'status': doc.get('status'),
+                                               'reply': doc['replies'][-1]}, owner=owner)
+        elif operation == 'update' and set(updated) - {'rev', 'rev_at'} == {'status'}:
+            self.bus.publish('message_status', {'_id': message_id, 'status': doc['status']},
+                             owner=owner)
+        else:
+            self.bus.publish('message', {'message': _public_doc(doc)}, owner=owner)
+
+
+bus = EventBus(max_subscribers=Config.STREAM_MAX_CLIENTS, backlog=Config.STREAM_BACKLOG)
+metrics.Gauge('stream_subscribers', 'Open /api/stream connections',
+              callback=lambda: bus.subscriber_count)
+
+
+def publish(event_type, data, owner=None, public=False):
+    """Publish a change made by this process, unless a ChangeStreamRelay
+    already publishes it from the database"""
+    if not bus.relayed:
+        bus.publish(event_type, data, owner=owner, public=public)
@@ -0,0 +1,606 @@
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from bisect import bisect_left, insort
+from logs import get_logger
+import json_codec
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+_NOT_LOADED = object()
+
+logger = get_logger(__name__)
+
+
+def _encode_line(record):
+    return json_codec.dumps(record) + b'\n'
+
+
+def write_json_atomic(filepath, data):
+    """Write compact JSON to a temp file, fsync it and rename it over ``filepath``.
+
+    A crash leaves either the old or the new file on disk, never a
+    truncated one.
+    """
+    directory = os.path.dirname(filepath) or '.'
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    # Unique temp name, so concurrent writers never share a half-written file
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(filepath) + '.',
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json_codec.dumps(data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on ``path`` (created if missing) across processes"""
+    directory = os.path.dirname(path) or '.'
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'a+b') as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class JsonCollection:
+    """Process-resident copy of a JSON list file with hash indexes.
+
+    The file is parsed once and kept in memory. Documents are indexed by
+    ``_id`` and by every field named in ``indexes``; the file is only
+    re-read when its mtime or size changes on disk (e.g. another process
+    wrote it). Documents handed out are shared with the cache, so callers
+    must treat them as read-only and go through ``update`` to change them.
+
+    When ``log_path`` is given, writes are not applied by rewriting the
+    file. Each insert/update/delete is appended as one fsynced JSON line to
+    the log, and every ``compact_every`` records the current state is folded
+    into a snapshot at ``filepath`` and the log is truncated. Loading reads
+    the snapshot and replays the log on top of it; records carry a sequence
+    number so a crash between writing the snapshot and truncating the log
+    does not apply anything twice.
+
+    Several processes may share the files. Readers never lock: snapshots
+    are replaced by atomic renames and only complete log lines are
+    replayed. Every write takes an exclusive lock on ``<filepath>.lock``,
+    catches up on what other processes wrote, and only then decides and
+    appends, so sequence numbers and read-modify-write sequences (see
+    ``transaction``) stay consistent across workers.
+
+    With ``filepath`` None the collection lives in memory only.
+
+    With ``revisions`` every write's sequence number doubles as a
+    revision: documents carry the ``rev`` of the write that last changed
+    them, deletes leave a tombstone with theirs, and ``changes`` lists
+    what changed after a given revision without scanning the collection.
+
+    A ``text_index`` (search.TextIndex) is kept in step with the documents
+    like the field indexes, and answers ``search``.
+    """
+
+    def __init__(self, filepath, indexes=(), log_path=None, compact_every=1000,
+                 order_by=None, revisions=False, text_index=None):
+        self.filepath = filepath
+        self.index_fields = tuple(indexes)
+        self.order_by = order_by
+        self.log_path = log_path
+        self.compact_every = compact_every
+        self.revisions = revisions
+        self.text_index = text_index
+        self._lock = threading.RLock()
+        self._lock_path = f"{filepath}.lock" if filepath else None
+        self._lock_depth = 0
+        self._signature = _NOT_LOADED
+        self._docs = {}
+        self._indexes = {field: {} for field in self.index_fields}
+        self._ordered = {None: []}
+        self._tombstones = {}
+        # (rev, _id) in write order; entries superseded by a later write
+        # of the same _id are skipped by ``changes`` and dropped on rebuild
+        self._revs = []
+        self._seq = 0
+        self._log_offset = 0
+        self._log_records = 0
+
+    # ---------- loading ----------
+
+    @staticmethod
+    def _signature_of(st):
+        # The inode changes on every atomic rename, even within one mtime tick
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _stat_signature(self):
+        if self.filepath is None:
+            return None
+        try:
+            st = os.stat(self.filepath)
+        except FileNotFoundError:
+            return None
+        return self._signature_of(st)
+
+    def _log_size(self):
+        try:
+            return os.path.getsize(self.log_path)
+        except FileNotFoundError:
+            return 0
+
+    def _read_snapshot(self):
+        """Return (seq, docs, tombstones, signature). Accepts both a bare
+        list and {seq, docs, tombstones}.
+
+        The signature is taken from the open file, so it always describes
+        the snapshot that was read even if another process replaces it.
+        """
+        if self.filepath is None:
+            return 0, [], [], None
+        try:
+            with open(self.filepath, 'rb') as f:
+                signature = self._signature_of(os.fstat(f.fileno()))
+                data = json_codec.loads(f.read())
+        except FileNotFoundError:
+            return 0, [], [], None
+        except Exception as e:
+            logger.error("Error loading %s: %s", self.filepath, e)
+            return 0, [], [], self._stat_signature()
+        if isinstance(data, dict):
+            return data.get('seq', 0), data.get('docs', []), data.get('tombstones', []), signature
+        return 0, data, [], signature
+
+    def _rebuild(self, docs, tombstones=()):
+        self._docs = {}
+        self._tombstones = {tombstone['_id']: tombstone for tombstone in tombstones}
+        self._indexes = {field: {} for field in self.index_fields}
+        self._ordered = {None: []}
+        if self.text_index is not None:
+            self.text_index.clear()
+        for doc in docs:
+            self._docs[doc['_id']] = doc
+            for field in self.index_fields:
+                self._indexes[field].setdefault(doc.get(field), {})[doc['_id']] = doc
+            if self.text_index is not None:
+                self.text_index.add(doc)
+        if self.order_by:
+            self._ordered[None] = sorted(self._sort_key(doc) for doc in self._docs.values())
+            for field in self.index_fields:
+                for value, bucket in self._indexes[field].items():
+                    self._ordered[(field, value)] = sorted(self._sort_key(doc) for doc in bucket.values())
+        self._rebuild_revs()
+
+    def _rebuild_revs(self):
+        if self.revisions:
+            self._revs = sorted((doc['rev'], doc['_id'])
+                                for docs in (self._docs.values(), self._tombstones.values())
+                                for doc in docs if doc.get('rev') is not None)
+
+    def _replay_log(self):
+        """Apply complete log lines written after the current offset"""
+        with open(self.log_path, 'rb') as f:
+            f.seek(self._log_offset)
+            chunk = f.read()
+        end = chunk.rfind(b'\n') + 1
+        for line in chunk[:end].splitlines():
+            try:
+                record = json_codec.loads(line)
+            except ValueError:
+                logger.warning("Skipping corrupt record in %s", self.log_path)
+                continue
+            self._log_records += 1
+            if record.get('seq', 0) > self._seq:
+                self._apply(record)
+                self._seq = record['seq']
+        self._log_offset += end
+        return len(chunk) - end
+
+    def _load(self):
+        seq, docs, tombstones, signature = self._read_snapshot()
+        self._rebuild(docs, tombstones)
+        self._seq = seq
+        self._log_offset = 0
+        self._log_records = 0
+        self._signature = signature
+        if self.log_path and os.path.exists(self.log_path):
+            self._replay_log()
+
+    def refresh(self):
+        """Bring the in-memory copy up to date with the files on disk"""
+        signature = self._stat_signature()
+        if signature == self._signature and (
+                not self.log_path or self._log_size() == self._log_offset):
+            return
+        with self._lock:
+            if self._stat_signature() != self._signature:
+                self._load()
+                return
+            if self.log_path:
+                log_size = self._log_size()
+                if log_size > self._log_offset:
+                    self._replay_log()
+                elif log_size < self._log_offset:
+                    self._load()
+
+    # ---------- indexes ----------
+
+    # When ``order_by`` is set, the collection also keeps sorted lists of
+    # (order_by value, _id) keys: one over all documents and one per indexed
+    # field value. ``page`` walks them to answer keyset-paginated queries
+    # without sorting or scanning the whole collection.
+
+    def _sort_key(self, doc):
+        return (doc.get(self.order_by) or '', doc['_id'])
+
+    def _add_to_indexes(self, doc):
+        if self.text_index is not None:
+            self.text_index.add(doc)
+        if self.order_by:
+            insort(self._ordered[None], self._sort_key(doc))
+        for field in self.index_fields:
+            value = doc.get(field)
+            bucket = self._indexes[field].setdefault(value, {})
+            bucket[doc['_id']] = doc
+            if self.order_by:
+                insort(self._ordered.setdefault((field, value), []), self._sort_key(doc))
+
+    def _remove_from_indexes(self, doc, reindexing=False):
+        if self.text_index is not None and not reindexing:
+            self.text_index.remove(doc['_id'])
+        if self.order_by:
+            self._remove_key(None, self._sort_key(doc))
+        for field in self.index_fields:
+            value = doc.get(field)
+            bucket = self._indexes[field].get(value)
+            if bucket is not None:
+                bucket.pop(doc['_id'], None)
+                if not bucket:
+                    del self._indexes[field][value]
+            if self.order_by:
+                self._remove_key((field, value), self._sort_key(doc))
+
+    def _remove_key(self, bucket, key):
+        keys = self._ordered.get(bucket)
+        if not keys:
+            return
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            del keys[i]
+        if not keys and bucket is not None:
+            del self._ordered[bucket]
+
+    # ---------- reads ----------
+
+    def all(self):
+        """Return every document"""
+        self.refresh()
+        return list(self._docs.values())
+
+    def get(self, doc_id):
+        """Return the document with the given _id, or None"""
+        self.refresh()
+        return self._docs.get(doc_id)
+
+    def is_deleted(self, doc_id):
+        """Whether the document with this _id was deleted (known only with
+        ``revisions``, which keep its tombstone)"""
+        self.refresh()
+        return doc_id in self._tombstones
+
+    def find(self, field, value):
+        """Return all documents whose indexed ``field`` equals ``value``"""
+        self.refresh()
+        return list(self._indexes[field].get(value, {}).values())
+
+    def find_one(self, field, value):
+        """Return one document whose indexed ``field`` equals ``value``"""
+        self.refresh()
+        return next(iter(self._indexes[field].get(value, {}).values()), None)
+
+    @property
+    def revision(self):
+        """Revision of the latest write (0 before the first)"""
+        self.refresh()
+        return self._seq
+
+    def changes(self, since, where=None, limit=None):
+        """Documents and tombstones written after revision ``since``, in
+        revision order, up to ``limit`` (None: all).
+
+        Tombstones are ``{'_id', 'rev', 'deleted': True}`` plus the deleted
+        document's indexed fields, so ``where`` (field -> required value)
+        filters them like documents.
+        """
+        self.refresh()
+        where = where or {}
+        with self._lock:
+            results = []
+            for rev, doc_id in self._revs[bisect_left(self._revs, (since + 1, '')):]:
+                doc = self._docs.get(doc_id) or self._tombstones.get(doc_id)
+                if doc is None or doc.get('rev') != rev:
+                    continue
+                if any(doc.get(field) != value for field, value in where.items()):
+                    continue
+                results.append(doc)
+                if limit is not None and len(results) >= limit:
+                    break
+            return results
+
+    def distinct(self, field):
+        """Return the distinct values of an indexed ``field``"""
+        self.refresh()
+        return list(self._indexes[field])
+
+    def search(self, query, limit=None, where=None):
+        """Return [(document, score)] matching ``query`` in the text index,
+        best first (see search.TextIndex.search); ``where`` maps indexed
+        fields to required values"""
+        self.refresh()
+        with self._lock:
+            within = None
+            for field, value in (where or {}).items():
+                bucket = self._indexes[field].get(value, {}).keys()
+                within = bucket if within is None else within & bucket
+            return [(self._docs[doc_id], score)
+                    for doc_id, score in self.text_index.search(query, limit=limit, within=within)]
+
+    def page(self, limit, where=None, before=None, since=None, until=None, match=None):
+        """Return up to ``limit`` (None: all) documents, newest ``order_by`` first.
+
+        ``where`` maps indexed fields to required values; the smallest
+        matching index bucket is walked and the remaining conditions are
+        checked per document. ``before`` is an exclusive (order_by, _id)
+        keyset cursor, ``since``/``until`` bound the order_by value
+        (inclusive/exclusive) and ``match`` is an optional extra predicate.
+        """
+        self.refresh()
+        where = where or {}
+        with self._lock:
+            bucket = None
+            if where:
+                bucket = min(((field, value) for field, value in where.items()),
+                             key=lambda b: len(self._ordered.get(b, ())))
+            keys = self._ordered.get(bucket, [])
+            hi = len(keys)
+            if until is not None:
+                hi = bisect_left(keys, (until, ''), 0, hi)
+            if before is not None:
+                hi = bisect_left(keys, tuple(before), 0, hi)
+            lo = bisect_left(keys, (since, ''), 0, hi) if since is not None else 0
+            results = []
+            for i in range(hi - 1, lo - 1, -1):
+                doc = self._docs[keys[i][1]]
+                if any(doc.get(field) != value for field, value in where.items()):
+                    continue
+                if match is not None and not match(doc):
+                    continue
+                results.append(doc)
+                if limit is not None and len(results) >= limit:
+                    break
+            return results
+
+    # ---------- writes ----------
+
+    def _apply(self, record):
+        op = record['op']
+        if op == 'insert':
+            doc = record['doc']
+            old = self._docs.get(doc['_id'])
+            if old is not None:
+                self._remove_from_indexes(old)
+            self._docs[doc['_id']] = doc
+            self._add_to_indexes(doc)
+            self._stamp(doc, record)
+            return
+        doc = self._docs.get(record['_id'])
+        if doc is None:
+            return
+        # An update re-adds the document, which lets the text index skip
+        # the words that did not change
+        self._remove_from_indexes(doc, reindexing=op == 'update')
+        if op == 'delete':
+            del self._docs[record['_id']]
+            if self.revisions:
+                tombstone = {field: doc.get(field) for field in self.index_fields}
+                tombstone.update({'_id': doc['_id'], 'deleted': True})
+                self._stamp(tombstone, record)
+            return
+        doc.update(record.get('set') or {})
+        for field, value in (record.get('push') or {}).items():
+            doc.setdefault(field, []).append(value)
+        self._add_to_indexes(doc)
+        self._stamp(doc, record)
+
+    def _stamp(self, doc, record):
+        if not self.revisions:
+            return
+        doc['rev'] = record['seq']
+        if doc.get('deleted'):
+            self._tombstones[doc['_id']] = doc
+        else:
+            self._tombstones.pop(doc['_id'], None)
+        self._revs.append((doc['rev'], doc['_id']))
+        if len(self._revs) > 2 * (len(self._docs) + len(self._tombstones)) + 1024:
+            self._rebuild_revs()
+
+    def _commit(self, record):
+        """Make ``record`` durable, then apply it in memory"""
+        self._commit_many([record])
+
+    def _commit_many(self, records):
+        """Make ``records`` durable as one write, then apply them in memory"""
+        if not records:
+            return
+        if not self.log_path:
+            for record in records:
+                self._seq += 1
+                record['seq'] = self._seq
+                self._apply(record)
+            self._save()
+            return
+        if self._log_size() > self._log_offset:
+            # Under the write lock everything complete has been replayed, so
+            # what is left is a torn tail from a crash mid-append; drop it
+            # so this append starts on a clean line
+            os.truncate(self.log_path, self._log_offset)
+        lines = []
+        for i, record in enumerate(records, start=1):
+            record['seq'] = self._seq + i
+            lines.append(_encode_line(record))
+        data = b''.join(lines)
+        try:
+            with open(self.log_path, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            logger.error("Error appending to %s: %s", self.log_path, e)
+            raise
+        self._seq = records[-1]['seq']
+        self._log_offset += len(data)
+        self._log_records += len(records)
+        for record in records:
+            self._apply(record)
+        if self._log_records >= self.compact_every:
+            self.compact()
+
+    @contextmanager
+    def _write_lock(self):
+        """Hold the collection lock and, for file-backed collections, the
+        inter-process lock file; re-entrant within this process"""
+        with self._lock:
+            if self._lock_path is None or self._lock_depth:
+                self._lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth -= 1
+                return
+            with file_lock(self._lock_path):
+                self._lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth -= 1
+
+    @contextmanager
+    def transaction(self):
+        """Hold the write lock across a read-modify-write sequence, so no
+        other thread or process writes between the reads and the writes"""
+        with self._write_lock():
+            self.refresh()
+            yield self
+
+    def bulk_write(self, records):
+        """Persist several insert/update/delete records in one write.
+
+        Records use the log format: ``{'op': 'insert', 'doc': ...}``,
+        ``{'op': 'update', '_id': ..., 'set': ..., 'push': ...}`` or
+        ``{'op': 'delete', '_id': ...}``; an insert replaces any document
+        with the same _id. Returns one boolean per record, False for an
+        update/delete whose document does not exist (it is skipped).
+        """
+        with self._write_lock():
+            self.refresh()
+            results = []
+            pending = []
+            # Existence as of the records before, e.g. a second delete of
+            # the same document in one batch finds nothing
+            exists = {}
+            for record in records:
+                if record['op'] == 'insert':
+                    found = exists[record['doc']['_id']] = True
+                else:
+                    found = exists.get(record['_id'], record['_id'] in self._docs)
+                    if record['op'] == 'delete':
+                        exists[record['_id']] = False
+                results.append(found)
+                if found:
+                    pending.append(dict(record))
+            self._commit_many(pending)
+        return results
+
+    def insert(self, doc):
+        """Add a document and persist"""
+        with self._write_lock():
+            self.refresh()
+            self._commit({'op': 'insert', 'doc': doc})
+        return doc['_id']
+
+    def update(self, doc_id, fields=None, push=None):
+        """Set fields on / append to list fields of a document and persist.
+
+        ``fields`` maps field -> new value and ``push`` maps list field -> item
+        to append, mirroring Mongo's ``$set``/``$push``. Returns False if no
+        document has that _id.
+        """
+        with self._write_lock():
+            self.refresh()
+            if doc_id not in self._docs:
+                return False
+            record = {'op': 'update', '_id': doc_id}
+            if fields:
+                record['set'] = fields
+            if push:
+                record['push'] = push
+            self._commit(record)
+        return True
+
+    def delete(self, doc_id):
+        """Remove a document and persist. Returns False if it did not exist."""
+        with self._write_lock():
+            self.refresh()
+            if doc_id not in self._docs:
+                return False
+            self._commit({'op': 'delete', '_id': doc_id})
+        return True
+
+    def compact(self):
+        """Fold the log into a fresh snapshot and truncate it"""
+        with self._write_lock():
+            self.refresh()
+            self._save()
+            if self.log_path and os.path.exists(self.log_path):
+                os.truncate(self.log_path, 0)
+            self._log_offset = 0
+            self._log_records = 0
+
+    def _save(self):
+        if self.filepath is None:
+            return
+        try:
+            if self.log_path or self.revisions:
+                write_json_atomic(self.filepath, {'seq': self._seq, 'docs': list(self._docs.values()),
+                                                  'tombstones': list(self._tombstones.values())})
+            else:
+                write_json_atomic(self.filepath, list(self._docs.values()))
+            logger.debug("Saved to %s", self.filepath)
+        except Exception as e:
+            logger.error("Error saving to %s: %s", self.filepath, e)
+            raise
+        self._signature = self._stat_signature()
@@ -0,0 +1,138 @@
+import numpy as np
+
+RESOURCES = ('energy', 'water', 'waste')
+
+# Share of each resource in the composite score
+WEIGHTS = {'energy': 0.4, 'water': 0.3, 'waste': 0.3}
+
+# Score for consumption exactly at baseline, and points lost (gained) per
+# percent of consumption above (below) it
+NEUTRAL_SCORE = 75.0
+POINTS_PER_PERCENT = 2.5
+
+# Blend of the level score (current period vs baseline) and the trend
+# score (mean week-over-week change within the current period)
+LEVEL_WEIGHT = 0.7
+TREND_WEIGHT = 0.3
+
+
+def _points(change):
+    """Map a relative change (0.1 = +10%) to a 0-100 score"""
+    return np.clip(NEUTRAL_SCORE - POINTS_PER_PERCENT * 100.0 * change, 0.0, 100.0)
+
+
+def score_resource(current, baseline):
+    """Score one resource for many entities at once.
+
+    ``current`` and ``baseline`` are (entities, weeks) arrays of weekly
+    consumption: the period being scored and the period it is compared
+    with. Returns a dict of per-entity arrays: ``score``, ``change_pct``
+    (current total vs baseline total), ``wow_pct`` (mean week-over-week
+    change) and ``has_data``.
+    """
+    current = np.asarray(current, dtype=np.float64)
+    baseline = np.asarray(baseline, dtype=np.float64)
+    current_total = current.sum(axis=1)
+    baseline_total = baseline.sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change = np.where(baseline_total > 0, current_total / baseline_total - 1.0, 0.0)
+        before, after = current[:, :-1], current[:, 1:]
+        wow = np.where(before > 0, (after - before) / before, 0.0)
+    trend = wow.mean(axis=1) if wow.shape[1] else np.zeros(len(current))
+
+    score = LEVEL_WEIGHT * _points(change) + TREND_WEIGHT * _points(trend)
+    return {
+        'score': score,
+        'change_pct': change * 100.0,
+        'wow_pct': trend * 100.0,
+        'current': current_total,
+        'baseline': baseline_total,
+        'has_data': (current_total > 0) | (baseline_total > 0)
+    }
+
+
+def composite(per_resource):
+    """Weighted composite of ``score_resource`` results.
+
+    Resources without data for an entity are left out and the remaining
+    weights rescaled; entities with no data at all get NaN.
+    """
+    weights = np.array([WEIGHTS[r] for r in per_resource])
+    scores = np.stack([per_resource[r]['score'] for r in per_resource])
+    present = np.stack([per_resource[r]['has_data'] for r in per_resource])
+    effective = weights[:, None] * present
+    total = effective.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total > 0, (effective * scores).sum(axis=0) / total, np.nan)
+
+
+def _summaries(names, per_resource, overall):
+    # Round and convert whole columns at once; per-entity work is then
+    # plain list indexing
+    columns = {
+        resource: {
+            'score': np.rint(values['score']).astype(int).tolist(),
+            'change_pct': np.round(values['change_pct'], 2).tolist(),
+            'wow_pct': np.round(values['wow_pct'], 2).tolist(),
+            'current': np.round(values['current'], 2).tolist(),
+            'baseline': np.round(values['baseline'], 2).tolist(),
+            'has_data': values['has_data'].tolist()
+        }
+        for resource, values in per_resource.items()
+    }
+    fields = ('score', 'change_pct', 'wow_pct', 'current', 'baseline')
+    has_score = ~np.isnan(overall)
+    scores = np.rint(np.where(has_score, overall, 0)).astype(int).tolist()
+    results = []
+    for i in np.flatnonzero(has_score).tolist():
+        results.append({
+            'name': names[i],
+            'score': scores[i],
+            'resources': {
+                resource: {field: column[field][i] for field in fields}
+                for resource, column in columns.items() if column['has_data'][i]
+            }
+        })
+    return results
+
+
+def score_entities(names, series):
+    """Score named entities from weekly series.
+
+    ``series`` maps resource -> (current, baseline), each an
+    (len(names), weeks) array. Returns one summary dict per entity that
+    has any data, with its composite and per-resource breakdown.
+    """
+    per_resource = {r: score_resource(*series[r]) for r in RESOURCES if r in series}
+    if not per_resource:
+        return []
+    return _summaries(names, per_resource, composite(per_resource))
+
+
+def _number(value):
+    """``value`` as a float, or None unless it is a finite number"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return float(value) if np.isfinite(value) else None
+
+
+def dashboard_series(dashboard):
+    """(current, baseline) 1xN arrays per resource from dashboard arrays.
+
+    Points that are not objects with numeric ``current``/``previous``
+    (default 0) are skipped, e.g. in a dashboard saved before PUT
+    /api/dashboard validated them.
+    """
+    series = {}
+    for resource in RESOURCES:
+        pairs = []
+        for point in dashboard.get(f'{resource}Data') or []:
+            if isinstance(point, dict):
+                pair = (_number(point.get('current', 0)), _number(point.get('previous', 0)))
+                if None not in pair:
+                    pairs.append(pair)
+        if pairs:
+            values = np.array(pairs, dtype=np.float64)
+            series[resource] = (values[:, 0][np.newaxis], values[:, 1][np.newaxis])
+    return series
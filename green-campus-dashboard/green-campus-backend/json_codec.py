@@ -0,0 +1,95 @@
+import json
+from datetime import date
+from bson import ObjectId
+from flask.json.provider import JSONProvider
+
+try:
+    import orjson
+except ImportError:  # the stdlib encoder is slower but produces the same JSON
+    orjson = None
+
+
+def _default(value):
+    """Encode what the encoders do not handle themselves: dates as ISO
+    8601, ObjectIds as their hex string, numpy values as plain numbers
+    and lists, and anything else as str()"""
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(obj):
+        """Compact UTF-8 JSON bytes of ``obj``"""
+        return orjson.dumps(obj, default=_default, option=_OPTIONS)
+
+    loads = orjson.loads
+else:
+    _encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, default=_default)
+
+    def dumps(obj):
+        """Compact UTF-8 JSON bytes of ``obj``"""
+        return _encoder.encode(obj).encode('utf-8')
+
+    def loads(data):
+        return json.loads(data)
+
+
+class Array:
+    """A JSON array of already-serialized elements (e.g. cached
+    per-message fragments), spliced verbatim into ``dumps_object``"""
+
+    __slots__ = ('fragments',)
+
+    def __init__(self, fragments):
+        self.fragments = fragments
+
+
+def dumps_object(fields):
+    """JSON bytes of the dict ``fields``, whose Array values are inserted
+    without re-encoding their elements.
+
+    The body is produced by a single comma join, the array elements being
+    items of it, so a large list is copied once rather than once per
+    level of nesting.
+    """
+    items = []
+    for key, value in fields.items():
+        name = dumps(key) + b':'
+        if not isinstance(value, Array):
+            items.append(name + dumps(value))
+        elif not value.fragments:
+            items.append(name + b'[]')
+        else:
+            start = len(items)
+            items.extend(value.fragments)
+            items[start] = name + b'[' + items[start]
+            items[-1] += b']'
+    if not items:
+        return b'{}'
+    items[0] = b'{' + items[0]
+    items[-1] += b'}'
+    return b','.join(items)
+
+
+class FastJSONProvider(JSONProvider):
+    """Flask's request parsing and ``jsonify`` through ``dumps``/``loads``:
+    compact output, ISO 8601 datetimes and string ObjectIds"""
+
+    mimetype = 'application/json'
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj), mimetype=self.mimetype)
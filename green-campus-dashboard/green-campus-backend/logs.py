@@ -0,0 +1,123 @@
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+import contextvars
+from logging.handlers import QueueHandler, QueueListener
+from config import Config
+
+# Correlation id of the request being handled (None outside requests) and
+# whether that request's DEBUG records are kept (see SamplingFilter)
+request_id = contextvars.ContextVar('request_id', default=None)
+debug_sampled = contextvars.ContextVar('debug_sampled', default=None)
+
+_configured = False
+_configure_lock = threading.Lock()
+_listener = None
+
+# LogRecord attributes that are not user-supplied ``extra`` fields
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id'}
+
+
+def begin_request(correlation_id):
+    """Tag this request's records with ``correlation_id`` and decide once
+    whether its DEBUG records are sampled in"""
+    request_id.set(correlation_id)
+    debug_sampled.set(random.random() < Config.LOG_DEBUG_SAMPLE_RATE)
+
+
+def end_request():
+    """Clear the request context (worker threads are reused)"""
+    request_id.set(None)
+    debug_sampled.set(None)
+
+
+class ContextFilter(logging.Filter):
+    """Stamp each record with the current request's correlation id"""
+
+    def filter(self, record):
+        record.request_id = request_id.get() or '-'
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a ``rate`` share of DEBUG records; other levels always pass.
+
+    Inside a request the decision is made once per request (all or none
+    of its DEBUG lines), elsewhere per record.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno != logging.DEBUG or self.rate >= 1:
+            return True
+        sampled = debug_sampled.get()
+        if sampled is None:
+            return random.random() < self.rate
+        return sampled
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, including any ``extra`` fields"""
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure():
+    """Route the app's logging through a queue to a background writer.
+
+    Callers only format the record and put it on an in-memory queue; a
+    QueueListener thread writes to stdout, so request threads never block
+    on console I/O. Runs once per process; the listener is flushed at exit.
+    """
+    global _configured, _listener
+    with _configure_lock:
+        if _configured:
+            return
+        output = logging.StreamHandler(sys.stdout)
+        if Config.LOG_FORMAT == 'json':
+            output.setFormatter(JsonFormatter())
+        else:
+            output.setFormatter(logging.Formatter(
+                '%(asctime)s %(levelname)-7s %(name)s [%(request_id)s] %(message)s'
+            ))
+
+        records = queue.SimpleQueue()
+        handler = QueueHandler(records)
+        handler.addFilter(ContextFilter())
+        handler.addFilter(SamplingFilter(Config.LOG_DEBUG_SAMPLE_RATE))
+
+        root = logging.getLogger()
+        root.addHandler(handler)
+        root.setLevel(Config.LOG_LEVEL)
+
+        _listener = QueueListener(records, output, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+        _configured = True
+
+
+def get_logger(name):
+    """Logger for module ``name``, configuring logging on first use"""
+    if not _configured:
+        configure()
+    return logging.getLogger(name)
@@ -0,0 +1,259 @@
+import sys
+import time
+import threading
+from bisect import bisect_left
+from collections import Counter as _Tally
+from contextlib import contextmanager
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+# Latency buckets in seconds, and size buckets in bytes
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_registry = []
+_started = time.time()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def _samples(self):
+        with self._lock:
+            return [(key, self._copy(value)) for key, value in self._values.items()]
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, value in sorted(self._samples(), key=lambda sample: sample[0]):
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}']
+
+
+class Counter(_Metric):
+    """Monotonic count, e.g. requests served"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Current value; ``callback`` (returning a number, or a dict of label
+    tuple -> number) is evaluated on every scrape"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), callback=None):
+        super().__init__(name, documentation, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self):
+        if self.callback is None:
+            return super()._samples()
+        try:
+            value = self.callback()
+        except Exception as e:
+            logger.error("Could not collect metric %s: %s", self.name, e)
+            return []
+        if isinstance(value, dict):
+            return list(value.items())
+        return [((), value)]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # Per-bucket counts (the last one is +Inf), sum, count
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @staticmethod
+    def _copy(value):
+        return [list(value[0]), value[1], value[2]]
+
+    def _render_sample(self, key, value):
+        counts, total, count = value
+        labels = _format_labels(self.labels, key)
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            le = f'le="{_format_value(float(bound))}"'
+            lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}')
+        lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def timer(histogram, **labels):
+    """Observe the duration of the ``with`` block in ``histogram``"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started, **labels)
+
+
+# ---------- metrics shared across modules ----------
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Request latency by route',
+                            ('method', 'route', 'status'))
+REQUEST_BYTES = Histogram('http_request_size_bytes', 'Request body size by route',
+                          ('method', 'route'), buckets=SIZE_BUCKETS)
+RESPONSE_BYTES = Histogram('http_response_size_bytes', 'Response body size by route',
+                           ('method', 'route'), buckets=SIZE_BUCKETS)
+STORAGE_SECONDS = Histogram('storage_operation_duration_seconds',
+                            'Storage operation latency by backend',
+                            ('backend', 'operation'))
+STORAGE_ERRORS = Counter('storage_operation_errors_total', 'Storage operations that raised',
+                         ('backend', 'operation'))
+CACHE_REQUESTS = Counter('response_cache_requests_total', 'Response cache lookups',
+                         ('key', 'result'))
+SMTP_CONNECT_SECONDS = Histogram('smtp_connect_duration_seconds',
+                                 'Time to open and authenticate an SMTP session')
+SMTP_SEND_SECONDS = Histogram('smtp_send_duration_seconds', 'Time to send one email',
+                              ('result',))
+Gauge('process_uptime_seconds', 'Seconds since the process started',
+      callback=lambda: round(time.time() - _started, 3))
+
+
+class TimedBackend:
+    """Proxy to a storage backend that times every public method call"""
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._methods = {}
+
+    def __getattr__(self, name):
+        method = self._methods.get(name)
+        if method is not None:
+            return method
+        attr = getattr(self._backend, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        backend = self._backend.name
+
+        def method(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            except Exception:
+                STORAGE_ERRORS.inc(backend=backend, operation=name)
+                raise
+            finally:
+                STORAGE_SECONDS.observe(time.perf_counter() - started,
+                                        backend=backend, operation=name)
+
+        self._methods[name] = method
+        return method
+
+
+# ---------- sampling profiler ----------
+
+class SamplingProfiler:
+    """Samples one thread's call stack every ``interval`` seconds.
+
+    ``stop`` returns the samples as folded stacks (``outer;inner count``
+    per line, hottest first), the input format of flame graph tools. Only
+    the sampler thread does any work, so the profiled code runs at full
+    speed between samples.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self._stacks = _Tally()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})')
+                frame = frame.f_back
+            self._stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return ''.join(f'{stack} {count}\n' for stack, count in self._stacks.most_common())
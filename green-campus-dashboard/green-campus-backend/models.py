@@ -1,55 +1,329 @@
 from config import Config
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import os
 import json
+import math
+import time
+import base64
 from bson import ObjectId
+from file_store import JsonCollection, file_lock
+from series_store import SeriesStore
+from storage import FileBackend, MemoryBackend, MongoBackend, SQLiteBackend
 
-# Try to connect to MongoDB, fall back to file-based storage if unavailable
-try:
-    from pymongo import MongoClient, errors
-    client = MongoClient(Config.MONGODB_URI, serverSelectionTimeoutMS=5000)
-    # Test connection
-    client.server_info()
-    db = client[Config.MONGO_DB_NAME]
-    USE_MONGODB = True
-    print("✓ Connected to MongoDB")
-except Exception as e:
-    print(f"⚠ MongoDB not available: {e}. Using file-based storage.")
-    USE_MONGODB = False
-    db = None
+from pymongo import errors
+from mongo_monitor import MongoMonitor
+from write_batcher import WriteBatcher
+from passwords import VerificationBusy, verification_pool
+import events
+import metrics
+from metrics import TimedBackend
+from functools import wraps
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+# Active backend. Starts on the local store and switches to MongoDB
+# (and back) at runtime as the background monitor sees the server come
+# and go; see start_mongo_monitor below.
+USE_MONGODB = False
+db = None
+
+# MongoDB indexes the queries below rely on: collection -> (name, keys, options)
+MONGO_INDEXES = {
+    'users': [
+        ('email_unique', [('email', 1)], {'unique': True}),
+    ],
+    'messages': [
+        # Admin inbox, newest first, keyset-paginated on (created_at, _id)
+        ('created_at_id', [('created_at', -1), ('_id', -1)], {}),
+        # Per-user inbox (Message.get_messages_for_user)
+        ('user_email_created_at', [('user_email', 1), ('created_at', -1), ('_id', -1)], {}),
+        # Status-filtered views (e.g. unread only)
+        ('status_created_at', [('status', 1), ('created_at', -1), ('_id', -1)], {}),
+        # Delta sync (Message.changes_since), for admins and per user
+        ('rev', [('rev', 1)], {}),
+        ('user_email_rev', [('user_email', 1), ('rev', 1)], {}),
+        # Full-text search (Message.search); text fields in name order
+        ('text', [('message', 'text'), ('replies.text', 'text'), ('subject', 'text')], {}),
+    ],
+    'message_tombstones': [
+        ('rev', [('rev', 1)], {}),
+        ('user_email_rev', [('user_email', 1), ('rev', 1)], {}),
+    ],
+    'readings': [
+        ('meter_ts', [('meter_id', 1), ('ts', 1)], {}),
+    ],
+    'rollups': [
+        # Range reads of one series (Readings.get_rollups)
+        ('series_bucket', [('series', 1), ('bucket', 1)], {}),
+        # All buildings' weekly buckets (Readings.building_weekly_series)
+        ('scope_granularity_bucket', [('scope', 1), ('granularity', 1), ('bucket', 1)], {}),
+    ],
+    'email_outbox': [
+        # Workers claiming due emails (email_queue.EmailOutbox.claim)
+        ('status_next_attempt_at', [('status', 1), ('next_attempt_at', 1)], {}),
+    ],
+}
+
+
+def _index_keys(info):
+    """An index's keys as create_index takes them. The server reports a
+    text index's fields as weights behind placeholder keys."""
+    keys = [tuple(k) for k in info['key']]
+    if keys and keys[0] == ('_fts', 'text'):
+        return [(field, 'text') for field in sorted(info.get('weights', {}))]
+    return keys
 
-# File-based database for development
-DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+def ensure_indexes(database=None):
+    """Create the MongoDB indexes in MONGO_INDEXES and verify they exist.
+
+    Returns True when every index is present with the expected keys. A
+    failure (e.g. duplicate emails blocking the unique index) is reported
+    and leaves the remaining indexes in place.
+    """
+    database = database if database is not None else db
+    if database is None:
+        return True
+    ok = True
+    for collection, specs in MONGO_INDEXES.items():
+        coll = database[collection]
+        for name, keys, options in specs:
+            try:
+                coll.create_index(keys, name=name, **options)
+            except errors.PyMongoError as e:
+                logger.error("Could not create index %s.%s: %s", collection, name, e)
+                ok = False
+        existing = coll.index_information()
+        for name, keys, options in specs:
+            info = existing.get(name)
+            if not info or _index_keys(info) != keys or \
+                    bool(info.get('unique')) != bool(options.get('unique')):
+                logger.error("Index %s.%s is missing or differs from %s", collection, name, keys)
+                ok = False
+    if ok:
+        logger.info("MongoDB indexes verified")
+    return ok
+
+# Local storage: file-based database for development, SQLite or memory
+DATA_DIR = Config.DATA_DIR or os.path.join(os.path.dirname(__file__), 'data')
 USERS_FILE = os.path.join(DATA_DIR, 'users.json')
 MESSAGES_FILE = os.path.join(DATA_DIR, 'messages.json')
 DASHBOARD_FILE = os.path.join(DATA_DIR, 'dashboard.json')
+MESSAGES_LOG_FILE = os.path.join(DATA_DIR, 'messages.log')
+SERIES_DIR = os.path.join(DATA_DIR, 'series')
+ROLLUPS_FILE = os.path.join(DATA_DIR, 'rollups.json')
+ROLLUPS_LOG_FILE = os.path.join(DATA_DIR, 'rollups.log')
+JOURNAL_FILE = os.path.join(DATA_DIR, 'mongo_journal.json')
+JOURNAL_LOG_FILE = os.path.join(DATA_DIR, 'mongo_journal.log')
+RECONCILE_LOCK_FILE = os.path.join(DATA_DIR, 'reconcile.lock')
+SQLITE_FILE = Config.SQLITE_PATH or os.path.join(DATA_DIR, 'green_campus.db')
+
+STORAGE_BACKENDS = ('mongodb', 'sqlite', 'file', 'memory')
+
+
+def create_local_storage(name):
+    """Build the local (non-MongoDB) storage backend called ``name``"""
+    if name == 'sqlite':
+        return SQLiteBackend(SQLITE_FILE)
+    if name == 'memory':
+        return MemoryBackend()
+    if name == 'file':
+        return FileBackend(USERS_FILE, MESSAGES_FILE, MESSAGES_LOG_FILE, DASHBOARD_FILE,
+                           compact_every=Config.MESSAGE_LOG_COMPACT_EVERY)
+    raise ValueError(f"Unknown storage backend {name!r}; expected one of {STORAGE_BACKENDS}")
+
+
+if Config.STORAGE_BACKEND not in STORAGE_BACKENDS:
+    raise ValueError(f"Unknown STORAGE_BACKEND {Config.STORAGE_BACKEND!r}; "
+                     f"expected one of {STORAGE_BACKENDS}")
+
+# Users, messages and the dashboard when MongoDB is not in use: the
+# configured backend, or the fallback while MongoDB is unreachable
+local_storage = create_local_storage(
+    Config.LOCAL_STORAGE_BACKEND if Config.STORAGE_BACKEND == 'mongodb' else Config.STORAGE_BACKEND
+)
+_timed_local_storage = TimedBackend(local_storage)
+_mongo_storage = None
+
+
+def storage():
+    """The backend serving users, messages and the dashboard right now
+    (timed per operation, see metrics.TimedBackend)"""
+    global _mongo_storage
+    if USE_MONGODB:
+        if _mongo_storage is None or _mongo_storage.db is not db:
+            _mongo_storage = TimedBackend(MongoBackend(db, settle_seconds=Config.MESSAGE_SYNC_SETTLE_SECONDS))
+        return _mongo_storage
+    return _timed_local_storage
+
+
+def _timed(operation):
+    """Time a model operation that bypasses storage() (e.g. readings)"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.timer(metrics.STORAGE_SECONDS,
+                               backend='mongodb' if USE_MONGODB else local_storage.name,
+                               operation=operation):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+rollups_store = JsonCollection(
+    ROLLUPS_FILE,
+    indexes=('series',),
+    log_path=ROLLUPS_LOG_FILE,
+    compact_every=Config.MESSAGE_LOG_COMPACT_EVERY,
+    order_by='bucket'
+)
+series_store = SeriesStore(SERIES_DIR)
+# Writes made on the local store while MongoDB was down, replayed into it
+# once it is reachable again (see reconcile_journal)
+journal_store = JsonCollection(
+    JOURNAL_FILE,
+    log_path=JOURNAL_LOG_FILE,
+    compact_every=Config.MESSAGE_LOG_COMPACT_EVERY
+)
+
+
+def _journaling():
+    """Whether writes to the local store are journaled for MongoDB"""
+    return not USE_MONGODB and Config.STORAGE_BACKEND == 'mongodb' and bool(Config.MONGODB_URI)
+
+
+def _journal(kind, key=None, **fields):
+    """Record a write made on the local store for replay into MongoDB.
+
+    Entries with a ``key`` replace earlier ones for the same document
+    (e.g. a user, whose latest state is copied); keyless entries, such as
+    each change to a message, are kept apart and replayed in order.
+    """
+    _journal_many(kind, [(key, fields)])
+
+
+def _journal_many(kind, entries):
+    """``_journal`` for several (key, fields) entries of one kind, in one write"""
+    if not _journaling() or not entries:
+        return
+    written_at = time.time_ns()
+    journal_store.bulk_write([
+        {'op': 'insert', 'doc': {
+            '_id': f"{kind}|{key}" if key is not None else str(ObjectId()),
+            'kind': kind, 'key': key, 'written_at': written_at, **fields
+        }}
+        for key, fields in entries
+    ])
+
+
+def _current_statuses(message_ids):
+    """Status of each existing message among ``message_ids`` while writes
+    are journaled (for _journal_statuses), else {}"""
+    if not _journaling():
+        return {}
+    return {message_id: message.get('status')
+            for message_id, message in storage().get_messages(message_ids).items()}
+
+
+def _journal_statuses(message_ids, status, old_statuses):
+    """Journal status changes with the status each replaced: replay sets
+    ``status`` only where MongoDB still has that one"""
+    _journal_many('message_status', [
+        (None, {'message_id': message_id, 'old_status': old_statuses[message_id], 'status': status})
+        for message_id in message_ids
+        if message_id in old_statuses and old_statuses[message_id] != status
+    ])
+
+
+def _journal_rehash(email, old_password, password):
+    """Journal a password rehash made on the local store.
+
+    Replay only swaps ``old_password`` for ``password`` in MongoDB, so it
+    never touches an account whose hash the local store did not see. A
+    later rehash before replay keeps the first entry's old hash.
+    """
+    if not _journaling():
+        return
+    pending = journal_store.get(f'rehash|{email}')
+    if pending is not None:
+        old_password = pending['old_password']
+    _journal('rehash', key=email, old_password=old_password, password=password)
+
 
 def ensure_data_dir():
     """Ensure data directory exists"""
-    if not USE_MONGODB and not os.path.exists(DATA_DIR):
-        os.makedirs(DATA_DIR)
+    if not os.path.exists(DATA_DIR):
+        os.makedirs(DATA_DIR, exist_ok=True)
 
-def load_json_file(filepath):
-    """Load JSON from file"""
-    ensure_data_dir()
-    if os.path.exists(filepath):
-        try:
-            with open(filepath, 'r') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"Error loading {filepath}: {e}")
-            return []
-    return []
-
-def save_json_file(filepath, data):
-    """Save JSON to file"""
-    ensure_data_dir()
+def encode_cursor(created_at, message_id):
+    """Build the opaque keyset cursor pointing just past a message"""
+    if isinstance(created_at, datetime):
+        created_at = created_at.isoformat()
+    raw = json.dumps([created_at, str(message_id)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (created_at ISO string, message_id) or raise ValueError"""
     try:
-        with open(filepath, 'w') as f:
-            json.dump(data, f, indent=2, default=str)
-        print(f"✓ Saved to {filepath}")
-    except Exception as e:
-        print(f"✗ Error saving to {filepath}: {e}")
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, message_id = json.loads(base64.urlsafe_b64decode(padded))
+        datetime.fromisoformat(created_at)
+        if not ObjectId.is_valid(message_id):
+            raise ValueError(message_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+    return created_at, message_id
+
+
+def encode_revision(rev):
+    """Build the opaque sync token for message revision ``rev`` of the
+    active backend (revisions of different backends are unrelated)"""
+    return f'{storage().name}.{rev}'
+
+
+def decode_revision(token):
+    """Return (backend name, rev) or raise ValueError"""
+    name, _, rev = (token or '').rpartition('.')
+    if not name or not rev.isdigit():
+        raise ValueError('Invalid since token')
+    return name, int(rev)
+
+
+class ChangesUnavailable(Exception):
+    """A sync token the active backend cannot answer (another backend's,
+    or from before the store was reset); the client must reload"""
+
+
+DASHBOARD_SERIES = ('energyData', 'waterData', 'wasteData')
+
+
+def parse_dashboard(raw):
+    """Validate a dashboard sent by an admin and keep its datasets.
+
+    Each of ``energyData``, ``waterData`` and ``wasteData`` (default
+    empty) is a list of objects whose ``current`` and ``previous``, when
+    present, are finite numbers (the green score reads them). Raises
+    ValueError describing the problem.
+    """
+    if not isinstance(raw, dict):
+        raise ValueError('dashboard must be an object')
+    dashboard = {}
+    for name in DASHBOARD_SERIES:
+        points = raw.get(name, [])
+        if not isinstance(points, list):
+            raise ValueError(f'{name} must be a list')
+        for i, point in enumerate(points):
+            if not isinstance(point, dict):
+                raise ValueError(f'{name}[{i}] must be an object')
+            for field in ('current', 'previous'):
+                value = point.get(field, 0)
+                if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+                        not math.isfinite(value):
+                    raise ValueError(f'{name}[{i}].{field} must be a finite number')
+        dashboard[name] = points
+    return dashboard
 
 
 class Dashboard:
@@ -58,80 +332,121 @@ class Dashboard:
     @staticmethod
     def get_dashboard():
         """Return a dashboard dict with energyData, waterData, wasteData"""
-        if USE_MONGODB:
-            coll = db['dashboard']
-            doc = coll.find_one({})
-            if doc:
-                # remove _id if present
-                doc.pop('_id', None)
-                return doc
-            return None
-        else:
-            data = load_json_file(DASHBOARD_FILE)
-            return data or None
+        return storage().get_dashboard()
 
     @staticmethod
     def save_dashboard(dashboard):
-        """Save dashboard dict to storage (overwrite)"""
-        if USE_MONGODB:
-            coll = db['dashboard']
-            # Upsert a single document
-            coll.replace_one({}, dashboard, upsert=True)
-            return True
-        else:
-            save_json_file(DASHBOARD_FILE, dashboard)
-            return True
+        """Save dashboard dict to storage (overwrite), stamped with its
+        ``updated_at``"""
+        updated_at = datetime.now()
+        storage().save_dashboard(dict(dashboard, updated_at=updated_at))
+        _journal('dashboard', key='dashboard', updated_at=updated_at)
+        events.publish('dashboard', {'updated_at': updated_at}, public=True)
+        return True
 
 class User:
     """User model for authentication"""
     
     @staticmethod
     def create_user(email, password, role='user'):
-        """Create a new user"""
-        if USE_MONGODB:
-            users_collection = db['users']
-            if users_collection.find_one({'email': email}):
-                return None
-            user = {
-                'email': email,
-                'password': password,
-                'role': role,
-                'created_at': datetime.now()
-            }
-            result = users_collection.insert_one(user)
-            return str(result.inserted_id)
-        else:
-            users = load_json_file(USERS_FILE)
-            if any(u['email'] == email for u in users):
-                return None
-            user = {
-                '_id': str(ObjectId()),
-                'email': email,
-                'password': password,
-                'role': role,
-                'created_at': datetime.now().isoformat()
-            }
-            users.append(user)
-            save_json_file(USERS_FILE, users)
-            return user['_id']
+        """Create a new user; returns its id, or None if the email is taken.
+
+        Only a scrypt hash of the password is stored (see passwords.py);
+        hashing runs on the verification pool and may raise
+        passwords.VerificationBusy.
+        """
+        user_id = storage().create_user({
+            'email': email,
+            'password': verification_pool.hash(password),
+            'role': role,
+            'created_at': datetime.now()
+        })
+        if user_id:
+            _journal('users', key=email)
+        return user_id
     
+    @staticmethod
+    def ensure_user(email, password, role='user'):
+        """Create a user unless one with this email exists; safe to run
+        concurrently from several processes. Returns True if created."""
+        if User.find_by_email(email):
+            # Skip hashing a password that would not be stored
+            return False
+        return User.create_user(email, password, role=role) is not None
+
     @staticmethod
     def find_by_email(email):
         """Find user by email"""
-        if USE_MONGODB:
-            users_collection = db['users']
-            return users_collection.find_one({'email': email})
-        else:
-            users = load_json_file(USERS_FILE)
-            return next((u for u in users if u['email'] == email), None)
+        return storage().find_user(email)
     
     @staticmethod
     def verify_credentials(email, password):
-        """Verify user credentials"""
+        """Return the user if ``password`` is theirs, else None.
+
+        The check runs on the bounded verification pool and raises
+        passwords.VerificationBusy when it is saturated. Plaintext
+        passwords and hashes made with an outdated cost are rehashed on a
+        successful login.
+        """
         user = User.find_by_email(email)
-        if user and user['password'] == password:
-            return user
-        return None
+        matches, needs_rehash = verification_pool.check(user['password'] if user else None, password)
+        if not matches:
+            return None
+        if needs_rehash:
+            try:
+                old_password, rehashed = user['password'], verification_pool.hash(password)
+                storage().update_user(email, {'password': rehashed})
+                _journal_rehash(email, old_password, rehashed)
+            except VerificationBusy:
+                pass  # Still valid; migrated at a later login
+        return user
+
+
+def _flush_messages(messages):
+    """Write a batch of new messages (see Message.create_message)"""
+    message_ids = storage().create_messages(messages)
+    _journal_many('message_created', [(None, {'message_id': message_id, 'message': message})
+                                      for message, message_id in zip(messages, message_ids)])
+    for message, message_id in zip(messages, message_ids):
+        events.publish('message', {'message': dict(message, _id=message_id)},
+                       owner=message['user_email'])
+    return message_ids
+
+
+def _publish_message_change(event_type, message_id, message=None, **data):
+    """Announce a change to an existing message on the event stream,
+    addressed to its sender (looked up unless ``message`` is given)"""
+    if events.bus.relayed:
+        return
+    if message is None:
+        message = storage().get_message(message_id)
+    events.publish(event_type, dict(data, _id=message_id),
+                   owner=message['user_email'] if message else None)
+
+
+def _publish_message_changes(event_type, message_ids, messages=None, **data):
+    """``_publish_message_change`` for several messages, looked up in one
+    query unless ``messages`` (keyed by _id) is given"""
+    if events.bus.relayed or not message_ids:
+        return
+    if messages is None:
+        messages = storage().get_messages(message_ids)
+    for message_id in message_ids:
+        message = messages.get(message_id)
+        events.publish(event_type, dict(data, _id=message_id),
+                       owner=message['user_email'] if message else None)
+
+
+# Contact-form bursts are written in groups: one insert_many, log append
+# or SQLite transaction per batch instead of one per message
+_message_batcher = WriteBatcher(
+    _flush_messages,
+    max_batch=Config.MESSAGE_BATCH_MAX,
+    window=Config.MESSAGE_BATCH_WINDOW_MS / 1000.0,
+    name='message-batcher'
+)
+metrics.Gauge('message_batch_pending', 'New messages waiting for the batch writer',
+              callback=lambda: _message_batcher.pending)
 
 
 class Message:
@@ -139,123 +454,751 @@ class Message:
     
     @staticmethod
     def create_message(user_name, user_email, subject, message_text):
-        """Create a new message from user"""
-        if USE_MONGODB:
-            messages_collection = db['messages']
-            message = {
-                'user_name': user_name,
-                'user_email': user_email,
-                'subject': subject,
-                'message': message_text,
-                'status': 'unread',
-                'created_at': datetime.now(),
-                'replies': []
-            }
-            result = messages_collection.insert_one(message)
-            return str(result.inserted_id)
-        else:
-            messages = load_json_file(MESSAGES_FILE)
-            message = {
-                '_id': str(ObjectId()),
-                'user_name': user_name,
-                'user_email': user_email,
-                'subject': subject,
-                'message': message_text,
-                'status': 'unread',
-                'created_at': datetime.now().isoformat(),
-                'replies': []
-            }
-            messages.append(message)
-            save_json_file(MESSAGES_FILE, messages)
-            return message['_id']
+        """Create a new message from user.
+
+        Returns once the message is durable; concurrent calls share one
+        write (see _message_batcher).
+        """
+        message = {
+            'user_name': user_name,
+            'user_email': user_email,
+            'subject': subject,
+            'message': message_text,
+            'status': 'unread',
+            'created_at': datetime.now(),
+            'replies': []
+        }
+        if Config.MESSAGE_BATCH_MAX <= 1:
+            return _flush_messages([message])[0]
+        return _message_batcher.submit(message)
     
     @staticmethod
     def get_all_messages():
         """Get all messages for admin"""
-        if USE_MONGODB:
-            messages_collection = db['messages']
-            messages = list(messages_collection.find().sort('created_at', -1))
-            for msg in messages:
-                msg['_id'] = str(msg['_id'])
-            return messages
-        else:
-            messages = load_json_file(MESSAGES_FILE)
-            return sorted(messages, key=lambda x: x['created_at'], reverse=True)
+        return storage().query_messages()
+
+    @staticmethod
+    def get_messages_for_user(email, limit=None, cursor=None, status=None,
+                              since=None, until=None):
+        """Get one user's messages, newest first, as (messages, next_cursor).
+
+        The email filter is part of the query itself (indexed on
+        user_email/created_at in every backend), so the cost depends on
+        that user's messages rather than the whole inbox.
+        """
+        return Message.query_messages(limit=limit, cursor=cursor, status=status,
+                                      user_email=email, since=since, until=until)
+
+    @staticmethod
+    def query_messages(limit=None, cursor=None, status=None, user_email=None,
+                       since=None, until=None):
+        """Return (messages, next_cursor), newest first.
+
+        Filters on status, user_email and a created_at range (``since``
+        inclusive, ``until`` exclusive, both datetimes) and resumes after
+        ``cursor``. next_cursor is None once the last page is reached or
+        when no limit is given.
+        """
+        before = decode_cursor(cursor) if cursor else None
+        messages = storage().query_messages(
+            limit=limit + 1 if limit else None,
+            before=before,
+            status=status,
+            user_email=user_email,
+            since=since,
+            until=until
+        )
+
+        next_cursor = None
+        if limit and len(messages) > limit:
+            messages = messages[:limit]
+            last = messages[-1]
+            next_cursor = encode_cursor(last['created_at'], last['_id'])
+        return messages, next_cursor
     
+    @staticmethod
+    def current_revision():
+        """Sync token for the messages as they are now; read it before
+        loading the inbox and pass it to changes_since afterwards"""
+        return encode_revision(storage().message_revision())
+
+    @staticmethod
+    def changes_since(token, user_email=None, limit=None):
+        """Return (messages, deleted_ids, next_token, has_more): the
+        messages inserted or updated after ``token``, in their current
+        state, and the ids of those deleted, oldest change first.
+
+        Only ``user_email``'s messages when given. Resume with next_token
+        while has_more. Raises ValueError for a malformed token and
+        ChangesUnavailable for one this backend cannot answer.
+        """
+        backend = storage()
+        name, since = decode_revision(token)
+        if name != backend.name or since > backend.message_revision():
+            raise ChangesUnavailable(token)
+        changes = backend.message_changes(since, user_email=user_email,
+                                          limit=limit + 1 if limit else None)
+        has_more = bool(limit) and len(changes) > limit
+        if has_more:
+            changes = changes[:limit]
+        messages = [doc for doc in changes if not doc.get('deleted')]
+        deleted = [doc['_id'] for doc in changes if doc.get('deleted')]
+        next_token = encode_revision(changes[-1]['rev']) if changes else token
+        return messages, deleted, next_token, has_more
+
+    @staticmethod
+    def search(query, user_email=None, limit=None):
+        """Messages whose subject, body or replies hold every word of
+        ``query``, best match first, each with its relevance ``score``.
+
+        The last word also matches longer words it starts (except on
+        MongoDB, whose text index matches stemmed words instead). Only
+        ``user_email``'s messages when given.
+        """
+        return [dict(message, score=score) for message, score in
+                storage().search_messages(query, user_email=user_email, limit=limit)]
+
     @staticmethod
     def get_message_by_id(message_id):
         """Get a specific message"""
-        if USE_MONGODB:
-            messages_collection = db['messages']
-            message = messages_collection.find_one({'_id': ObjectId(message_id)})
-            if message:
-                message['_id'] = str(message['_id'])
-            return message
-        else:
-            messages = load_json_file(MESSAGES_FILE)
-            return next((m for m in messages if m['_id'] == message_id), None)
+        return storage().get_message(message_id)
     
     @staticmethod
-    def add_reply(message_id, reply_text):
-        """Add admin reply to a message"""
-        if USE_MONGODB:
-            messages_collection = db['messages']
-            reply = {
-                'sender': 'Admin',
-                'text': reply_text,
-                'timestamp': datetime.now()
-            }
-            messages_collection.update_one(
-                {'_id': ObjectId(message_id)},
-                {
-                    '$push': {'replies': reply},
-                    '$set': {'status': 'replied'}
-                }
-            )
-            return True
-        else:
-            messages = load_json_file(MESSAGES_FILE)
-            for msg in messages:
-                if msg['_id'] == message_id:
-                    msg['replies'].append({
-                        'sender': 'Admin',
-                        'text': reply_text,
-                        'timestamp': datetime.now().isoformat()
-                    })
-                    msg['status'] = 'replied'
-                    break
-            save_json_file(MESSAGES_FILE, messages)
-            return True
+    def add_reply(message_id, reply_text, delivery_id=None):
+        """Add admin reply to a message.
+
+        ``delivery_id`` links the reply to its queued notification email.
+        """
+        reply = {
+            'sender': 'Admin',
+            'text': reply_text,
+            'timestamp': datetime.now(),
+            'delivery_id': delivery_id
+        }
+        if storage().add_reply(message_id, reply):
+            _journal('message_reply', message_id=message_id, reply=reply)
+            _publish_message_change('message_reply', message_id, reply=reply, status='replied')
+        return True
     
     @staticmethod
     def delete_message(message_id):
         """Delete a message"""
-        if USE_MONGODB:
-            messages_collection = db['messages']
-            result = messages_collection.delete_one({'_id': ObjectId(message_id)})
-            return result.deleted_count > 0
-        else:
-            messages = load_json_file(MESSAGES_FILE)
-            initial_count = len(messages)
-            messages = [m for m in messages if m['_id'] != message_id]
-            save_json_file(MESSAGES_FILE, messages)
-            return len(messages) < initial_count
+        message = None if events.bus.relayed else storage().get_message(message_id)
+        deleted = storage().delete_message(message_id)
+        if deleted:
+            _journal('message_deleted', message_id=message_id)
+            _publish_message_change('message_deleted', message_id, message=message)
+        return deleted
     
     @staticmethod
     def mark_as_read(message_id):
         """Mark message as read"""
+        old_statuses = _current_statuses([message_id])
+        if storage().set_status(message_id, 'read'):
+            _journal_statuses([message_id], 'read', old_statuses)
+            _publish_message_change('message_status', message_id, status='read')
+        return True
+
+    # Bulk variants: one storage write and one journal write for the whole
+    # list, returning {message_id: found} with duplicate ids collapsed
+
+    @staticmethod
+    def get_messages_by_ids(message_ids):
+        """The existing messages among ``message_ids``, keyed by _id"""
+        return storage().get_messages(list(dict.fromkeys(message_ids)))
+
+    @staticmethod
+    def add_replies(message_ids, reply_text, delivery_ids=None):
+        """Add the same admin reply to several messages.
+
+        ``delivery_ids`` maps each message to its reply's queued
+        notification email.
+        """
+        message_ids = list(dict.fromkeys(message_ids))
+        delivery_ids = delivery_ids or {}
+        timestamp = datetime.now()
+        replies = {
+            message_id: {
+                'sender': 'Admin',
+                'text': reply_text,
+                'timestamp': timestamp,
+                'delivery_id': delivery_ids.get(message_id)
+            }
+            for message_id in message_ids
+        }
+        found = dict(zip(message_ids, storage().add_replies(list(replies.items()))))
+        replied = [message_id for message_id in message_ids if found[message_id]]
+        if replied:
+            _journal_many('message_reply', [(None, {'message_id': message_id,
+                                                    'reply': replies[message_id]})
+                                            for message_id in replied])
+            if not events.bus.relayed:
+                messages = storage().get_messages(replied)
+                for message_id in replied:
+                    _publish_message_change('message_reply', message_id,
+                                            message=messages.get(message_id),
+                                            reply=replies[message_id], status='replied')
+        return found
+
+    @staticmethod
+    def delete_messages(message_ids):
+        """Delete several messages"""
+        message_ids = list(dict.fromkeys(message_ids))
+        messages = None if events.bus.relayed else storage().get_messages(message_ids)
+        found = dict(zip(message_ids, storage().delete_messages(message_ids)))
+        deleted = [message_id for message_id in message_ids if found[message_id]]
+        if deleted:
+            _journal_many('message_deleted', [(None, {'message_id': message_id})
+                                              for message_id in deleted])
+            _publish_message_changes('message_deleted', deleted, messages=messages)
+        return found
+
+    @staticmethod
+    def mark_many_as_read(message_ids):
+        """Mark several messages as read"""
+        message_ids = list(dict.fromkeys(message_ids))
+        old_statuses = _current_statuses(message_ids)
+        found = dict(zip(message_ids, storage().set_statuses(message_ids, 'read')))
+        marked = [message_id for message_id in message_ids if found[message_id]]
+        if marked:
+            _journal_statuses(marked, 'read', old_statuses)
+            _publish_message_changes('message_status', marked, status='read')
+        return found
+
+
+# ==================== Meter readings ====================
+
+RESOURCES = ('energy', 'water', 'waste')
+GRANULARITIES = ('hour', 'day', 'week')
+
+
+def parse_timestamp(timestamp):
+    """Unix seconds from an ISO 8601 string (naive = UTC) or a number"""
+    if isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+        return float(timestamp)
+    if isinstance(timestamp, str):
+        when = datetime.fromisoformat(timestamp)
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        return when.timestamp()
+    raise ValueError('timestamp is required')
+
+
+def parse_reading(raw):
+    """Validate one incoming meter reading and normalize it.
+
+    Accepts ``meter_id``, ``resource`` (energy/water/waste), ``timestamp``
+    (ISO 8601 string or Unix seconds; naive times are UTC), ``value`` and
+    an optional ``building``. Raises ValueError describing the problem.
+    """
+    if not isinstance(raw, dict):
+        raise ValueError('reading must be an object')
+    meter_id = raw.get('meter_id')
+    if not meter_id or not isinstance(meter_id, str):
+        raise ValueError('meter_id is required')
+    resource = raw.get('resource')
+    if resource not in RESOURCES:
+        raise ValueError(f"resource must be one of {', '.join(RESOURCES)}")
+    value = raw.get('value')
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError('value must be a finite number')
+    ts = parse_timestamp(raw.get('timestamp'))
+    building = raw.get('building')
+    if building is not None and not isinstance(building, str):
+        raise ValueError('building must be a string')
+    return {
+        'meter_id': meter_id,
+        'resource': resource,
+        'building': building,
+        'ts': ts,
+        'value': float(value)
+    }
+
+
+def _utc(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None)
+
+
+def bucket_start(ts, granularity):
+    """Start of the hour/day/week (Monday, UTC) containing ``ts``, as ISO"""
+    when = _utc(ts)
+    if granularity == 'hour':
+        when = when.replace(minute=0, second=0, microsecond=0)
+    else:
+        when = when.replace(hour=0, minute=0, second=0, microsecond=0)
+        if granularity == 'week':
+            when -= timedelta(days=when.weekday())
+    return when.isoformat()
+
+
+def series_id(resource, scope, key, granularity):
+    """Name of one rollup series, e.g. ``energy|campus|*|week``"""
+    return f"{resource}|{scope}|{key}|{granularity}"
+
+
+class Readings:
+    """Raw meter readings plus incrementally maintained rollups.
+
+    Every reading updates hourly, daily and weekly sum/min/max/count
+    buckets for its meter, its building (when given) and the whole campus,
+    so dashboards read a handful of rollup documents instead of raw data.
+    """
+
+    @staticmethod
+    def _aggregate(readings):
+        """Fold a batch into one partial rollup per touched bucket"""
+        partials = {}
+        for r in readings:
+            scopes = [('meter', r['meter_id']), ('campus', '*')]
+            if r['building']:
+                scopes.append(('building', r['building']))
+            for granularity in GRANULARITIES:
+                bucket = bucket_start(r['ts'], granularity)
+                for scope, key in scopes:
+                    series = series_id(r['resource'], scope, key, granularity)
+                    rollup_id = f"{series}|{bucket}"
+                    p = partials.get(rollup_id)
+                    if p is None:
+                        partials[rollup_id] = {
+                            '_id': rollup_id,
+                            'series': series,
+                            'resource': r['resource'],
+                            'scope': scope,
+                            'key': key,
+                            'granularity': granularity,
+                            'bucket': bucket,
+                            'sum': r['value'],
+                            'min': r['value'],
+                            'max': r['value'],
+                            'count': 1
+                        }
+                    else:
+                        p['sum'] += r['value']
+                        p['min'] = min(p['min'], r['value'])
+                        p['max'] = max(p['max'], r['value'])
+                        p['count'] += 1
+        return partials
+
+    @staticmethod
+    @_timed('ingest')
+    def ingest(readings):
+        """Store parsed readings and fold them into the rollups.
+
+        Returns the number of readings stored.
+        """
+        if not readings:
+            return 0
         if USE_MONGODB:
-            messages_collection = db['messages']
-            messages_collection.update_one(
-                {'_id': ObjectId(message_id)},
-                {'$set': {'status': 'read'}}
+            stored = Readings._ingest_mongodb(db, readings)
+        else:
+            stored = Readings._ingest_local(readings)
+        # Rollups are not relayed from change streams, so this process
+        # always announces the new dashboard figures itself
+        events.bus.publish('dashboard', {'updated_at': datetime.now()}, public=True)
+        return stored
+
+    @staticmethod
+    def _ingest_local(readings):
+        """Append readings to the series store and fold them into the
+        local rollups"""
+        series_store.append(readings)
+        with rollups_store.transaction():
+            records = []
+            for p in Readings._aggregate(readings).values():
+                current = rollups_store.get(p['_id'])
+                if current is not None:
+                    p = {
+                        **current,
+                        'sum': current['sum'] + p['sum'],
+                        'min': min(current['min'], p['min']),
+                        'max': max(current['max'], p['max']),
+                        'count': current['count'] + p['count']
+                    }
+                records.append({'op': 'insert', 'doc': p})
+            rollups_store.bulk_write(records)
+        _journal('readings', readings=readings)
+        return len(readings)
+
+    @staticmethod
+    def _ingest_mongodb(database, readings):
+        """Insert raw readings and $inc their rollups in ``database``"""
+        from pymongo import UpdateOne
+        partials = Readings._aggregate(readings)
+        database['readings'].insert_many([
+            {**r, 'ts': _utc(r['ts'])} for r in readings
+        ], ordered=False)
+        database['rollups'].bulk_write([
+            UpdateOne(
+                {'_id': p['_id']},
+                {
+                    '$inc': {'sum': p['sum'], 'count': p['count']},
+                    '$min': {'min': p['min']},
+                    '$max': {'max': p['max']},
+                    '$setOnInsert': {k: p[k] for k in
+                                     ('series', 'resource', 'scope', 'key', 'granularity', 'bucket')}
+                },
+                upsert=True
             )
-            return True
+            for p in partials.values()
+        ], ordered=False)
+        return len(readings)
+
+    @staticmethod
+    @_timed('get_rollups')
+    def get_rollups(resource, granularity, scope='campus', key='*', since=None, until=None):
+        """Rollup buckets of one series in time order.
+
+        ``since``/``until`` are ISO bucket bounds (inclusive/exclusive).
+        """
+        series = series_id(resource, scope, key, granularity)
+        if USE_MONGODB:
+            query = {'series': series}
+            bounds = {}
+            if since:
+                bounds['$gte'] = since
+            if until:
+                bounds['$lt'] = until
+            if bounds:
+                query['bucket'] = bounds
+            return list(db['rollups'].find(query, {'_id': 0}).sort('bucket', 1))
+        docs = rollups_store.page(None, where={'series': series}, since=since, until=until)
+        return [{k: v for k, v in doc.items() if k != '_id'} for doc in reversed(docs)]
+
+    @staticmethod
+    @_timed('aggregate_range')
+    def aggregate_range(resource, since, until, meter_id=None, interval=None):
+        """Aggregate raw readings of a resource over [since, until).
+
+        ``since``/``until`` are Unix seconds. Without ``interval`` returns
+        one sum/min/max/count dict; with ``interval`` (seconds) returns a
+        list of {'start', 'sum', 'count'} buckets covering the range.
+        """
+        meter_ids = [meter_id] if meter_id else None
+        if not USE_MONGODB:
+            if interval is None:
+                return series_store.aggregate(resource, since, until, meter_ids)
+            starts, sums, counts = series_store.bucketed(resource, since, until, interval, meter_ids)
+            return [
+                {'start': _utc(start).isoformat(), 'sum': float(total), 'count': int(count)}
+                for start, total, count in zip(starts.tolist(), sums.tolist(), counts.tolist())
+            ]
+
+        match = {'resource': resource, 'ts': {'$gte': _utc(since), '$lt': _utc(until)}}
+        if meter_id:
+            match['meter_id'] = meter_id
+        if interval is None:
+            rows = list(db['readings'].aggregate([
+                {'$match': match},
+                {'$group': {'_id': None, 'sum': {'$sum': '$value'}, 'min': {'$min': '$value'},
+                            'max': {'$max': '$value'}, 'count': {'$sum': 1}}}
+            ]))
+            if not rows:
+                return {'sum': 0.0, 'min': None, 'max': None, 'count': 0}
+            rows[0].pop('_id')
+            return rows[0]
+
+        step_ms = int(interval * 1000)
+        # Date minus date is the difference in milliseconds
+        offset = {'$subtract': ['$ts', _utc(since)]}
+        rows = db['readings'].aggregate([
+            {'$match': match},
+            {'$group': {
+                '_id': {'$subtract': [offset, {'$mod': [offset, step_ms]}]},
+                'sum': {'$sum': '$value'},
+                'count': {'$sum': 1}
+            }}
+        ])
+        found = {row['_id'] // step_ms: row for row in rows}
+        buckets = max(0, -(-int((until - since) * 1000) // step_ms))
+        return [
+            {
+                'start': _utc(since + i * interval).isoformat(),
+                'sum': float(found[i]['sum']) if i in found else 0.0,
+                'count': found[i]['count'] if i in found else 0
+            }
+            for i in range(buckets)
+        ]
+
+    @staticmethod
+    @_timed('building_weekly_series')
+    def building_weekly_series(weeks=4, now=None):
+        """Weekly per-building totals for green scoring.
+
+        Returns (building names, {resource: (current, baseline)}) where
+        ``current`` holds the last ``weeks`` weekly sums up to the current
+        week and ``baseline`` the ``weeks`` before that, both as
+        (buildings, weeks) NumPy arrays.
+        """
+        import numpy as np
+        now = now or datetime.now(timezone.utc).timestamp()
+        this_week = datetime.fromisoformat(bucket_start(now, 'week'))
+        starts = [(this_week - timedelta(weeks=2 * weeks - 1 - i)).isoformat()
+                  for i in range(2 * weeks)]
+        end = (this_week + timedelta(weeks=1)).isoformat()
+        if USE_MONGODB:
+            docs = list(db['rollups'].find(
+                {'scope': 'building', 'granularity': 'week',
+                 'bucket': {'$gte': starts[0], '$lt': end}},
+                {'resource': 1, 'key': 1, 'bucket': 1, 'sum': 1}
+            ))
+        else:
+            docs = []
+            for series in rollups_store.distinct('series'):
+                resource, scope, _, granularity = series.split('|')
+                if scope == 'building' and granularity == 'week':
+                    docs.extend(rollups_store.page(None, where={'series': series},
+                                                   since=starts[0], until=end))
+
+        names = sorted({doc['key'] for doc in docs})
+        row = {name: i for i, name in enumerate(names)}
+        column = {start: i for i, start in enumerate(starts)}
+        matrices = {}
+        for doc in docs:
+            matrix = matrices.get(doc['resource'])
+            if matrix is None:
+                matrix = matrices[doc['resource']] = np.zeros((len(names), 2 * weeks))
+            matrix[row[doc['key']], column[doc['bucket']]] = doc['sum']
+        return names, {r: (m[:, weeks:], m[:, :weeks]) for r, m in matrices.items()}
+
+    @staticmethod
+    def _weekly_sums(resource, weeks):
+        """Sum of each weekly campus bucket in ``weeks`` (ISO starts)"""
+        series = series_id(resource, 'campus', '*', 'week')
+        ids = [f"{series}|{week}" for week in weeks]
+        if USE_MONGODB:
+            found = {doc['_id']: doc['sum'] for doc in
+                     db['rollups'].find({'_id': {'$in': ids}}, {'sum': 1})}
         else:
-            messages = load_json_file(MESSAGES_FILE)
-            for msg in messages:
-                if msg['_id'] == message_id:
-                    msg['status'] = 'read'
-                    break
-            save_json_file(MESSAGES_FILE, messages)
-            return True
+            found = {}
+            for rollup_id in ids:
+                doc = rollups_store.get(rollup_id)
+                if doc is not None:
+                    found[rollup_id] = doc['sum']
+        return [found.get(rollup_id) for rollup_id in ids]
+
+    @staticmethod
+    def dashboard_series(now=None, weeks=4):
+        """Dashboard arrays computed from the weekly campus rollups.
+
+        Returns ``{'energyData': [...], ...}`` in the week/current/previous
+        shape, where Week 1..N are the last N weeks up to the current one
+        and ``previous`` is the same week one period earlier. Resources
+        with no readings in that window are left out.
+        """
+        now = now or datetime.now(timezone.utc).timestamp()
+        this_week = datetime.fromisoformat(bucket_start(now, 'week'))
+        current = [(this_week - timedelta(weeks=weeks - 1 - i)).isoformat() for i in range(weeks)]
+        previous = [(this_week - timedelta(weeks=2 * weeks - 1 - i)).isoformat() for i in range(weeks)]
+        dashboard = {}
+        for resource in RESOURCES:
+            sums = Readings._weekly_sums(resource, current + previous)
+            if all(v is None for v in sums):
+                continue
+            dashboard[f'{resource}Data'] = [
+                {
+                    'week': f'Week {i + 1}',
+                    'current': round(sums[i] or 0, 2),
+                    'previous': round(sums[weeks + i] or 0, 2)
+                }
+                for i in range(weeks)
+            ]
+        return dashboard
+
+
+# ==================== Backend selection ====================
+
+_monitor = None
+_backend_listeners = []
+
+
+def on_backend_change(callback):
+    """Call ``callback(use_mongodb)`` whenever the active backend switches"""
+    _backend_listeners.append(callback)
+
+
+def _notify_backend_change():
+    for callback in _backend_listeners:
+        try:
+            callback(USE_MONGODB)
+        except Exception:
+            logger.exception("Backend change handler failed")
+
+
+_relay = None
+
+
+def _relay_changes(use_mongodb):
+    """Follow MongoDB's change stream while it is the backend, when the
+    server supports one (see events.ChangeStreamRelay)"""
+    global _relay
+    if _relay is not None:
+        _relay.stop()
+        _relay = None
+    if use_mongodb:
+        relay = events.ChangeStreamRelay(db, events.bus)
+        if relay.start():
+            _relay = relay
+
+
+on_backend_change(_relay_changes)
+
+
+def _mongo_datetime(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _to_millisecond(value):
+    # MongoDB keeps datetimes to the millisecond
+    return value.replace(microsecond=value.microsecond // 1000 * 1000) \
+        if isinstance(value, datetime) else value
+
+
+def _has_reply(message, reply):
+    """Whether MongoDB's ``message`` already holds ``reply`` (replayed
+    before the journal entry could be dropped)"""
+    timestamp = _to_millisecond(reply.get('timestamp'))
+    return any(stored.get('text') == reply.get('text') and
+               _to_millisecond(stored.get('timestamp')) == timestamp
+               for stored in message.get('replies') or ())
+
+
+def _replay(database, entry):
+    """Apply one journal entry to ``database``"""
+    kind, key = entry['kind'], entry['key']
+    mongo = MongoBackend(database)
+    if kind == 'users':
+        user = local_storage.find_user(key)
+        if user:
+            doc = dict(user, created_at=_mongo_datetime(user.get('created_at')))
+            if mongo.create_user(doc) is None:
+                # Registered locally under an email MongoDB already has:
+                # the MongoDB account wins and is never overwritten
+                logger.warning("Skipping offline user %s: the email exists in MongoDB", key)
+    elif kind == 'rehash':
+        # Compare-and-set: only the hash the local store replaced is updated
+        result = database['users'].update_one({'email': key, 'password': entry['old_password']},
+                                              {'$set': {'password': entry['password']}})
+        if result.matched_count == 0 and database['users'].count_documents(
+                {'email': key, 'password': entry['password']}) == 0:
+            logger.warning("Skipping offline password rehash of %s: its MongoDB hash differs", key)
+    elif kind == 'message_created':
+        message = entry['message']
+        doc = dict(message, _id=entry['message_id'],
+                   created_at=_mongo_datetime(message['created_at']))
+        doc['replies'] = [dict(reply, timestamp=_mongo_datetime(reply.get('timestamp')))
+                          for reply in message.get('replies') or ()]
+        if not mongo.insert_message(doc) and mongo.get_message(entry['message_id']) is None:
+            logger.warning("Skipping offline message %s: it was deleted in MongoDB",
+                           entry['message_id'])
+    elif kind == 'message_reply':
+        # Appended to MongoDB's copy, whatever else changed there
+        reply = dict(entry['reply'], timestamp=_mongo_datetime(entry['reply'].get('timestamp')))
+        message = mongo.get_message(entry['message_id'])
+        if message is None:
+            logger.warning("Skipping offline reply to %s: the message is not in MongoDB",
+                           entry['message_id'])
+        elif not _has_reply(message, reply):
+            mongo.add_reply(entry['message_id'], reply)
+    elif kind == 'message_status':
+        # Compare-and-set: a status MongoDB changed meanwhile is kept
+        if not mongo.set_status(entry['message_id'], entry['status'],
+                                expected=entry['old_status']):
+            message = mongo.get_message(entry['message_id'])
+            if message is None or message.get('status') != entry['status']:
+                logger.warning("Skipping offline status change of %s: the message changed "
+                               "or was deleted in MongoDB", entry['message_id'])
+    elif kind == 'message_deleted':
+        mongo.delete_message(entry['message_id'])
+    elif kind == 'dashboard':
+        dashboard = local_storage.get_dashboard()
+        current = mongo.get_dashboard()
+        updated_at = _mongo_datetime(entry.get('updated_at'))
+        if not dashboard:
+            pass
+        elif current and current.get('updated_at') and updated_at and \
+                _mongo_datetime(current['updated_at']) >= _to_millisecond(updated_at):
+            # Saved since (or this very save, replayed before)
+            logger.warning("Skipping offline dashboard save: MongoDB has a newer one")
+        else:
+            mongo.save_dashboard(dict(dashboard, updated_at=_mongo_datetime(dashboard.get('updated_at'))))
+    elif kind == 'readings':
+        Readings._ingest_mongodb(database, entry['readings'])
+
+
+def reconcile_journal(database):
+    """Replay writes made on the local store into MongoDB, oldest first.
+
+    Nothing written to MongoDB meanwhile is overwritten. Users are added
+    unless the email already exists, and password rehashes are applied
+    only over the hash they replaced. Each message change is replayed on
+    its own: new messages are inserted unless MongoDB deleted them,
+    replies appended, statuses set only where MongoDB still has the one
+    they replaced, and deletes applied. The dashboard is copied unless
+    MongoDB's was saved later, and reading batches are ingested.
+
+    Each entry is dropped once applied, unless it was rewritten
+    meanwhile; an error stops the replay and leaves the remaining entries
+    for the next attempt. Returns the number of entries applied.
+    """
+    applied = 0
+    with file_lock(RECONCILE_LOCK_FILE):
+        # A rewritten entry keeps its place in the store, so order by time
+        for entry in sorted(journal_store.all(), key=lambda entry: entry['written_at']):
+            _replay(database, entry)
+            with journal_store.transaction():
+                current = journal_store.get(entry['_id'])
+                if current is not None and current['written_at'] == entry['written_at']:
+                    journal_store.delete(entry['_id'])
+            applied += 1
+    if applied:
+        logger.info("Reconciled %d offline write(s) into MongoDB", applied)
+    return applied
+
+
+def _use_mongodb(database):
+    global USE_MONGODB, db
+    if not ensure_indexes(database):
+        raise RuntimeError('MongoDB indexes could not be created or verified')
+    reconcile_journal(database)
+    db = database
+    USE_MONGODB = True
+    logger.info("Connected to MongoDB")
+    _notify_backend_change()
+
+
+def _use_files(error):
+    global USE_MONGODB
+    USE_MONGODB = False
+    logger.warning("MongoDB not available: %s. Using %s storage.", error, local_storage.name)
+    _notify_backend_change()
+
+
+def _reconcile_pending(database):
+    # Writes that raced the switch to MongoDB landed in the journal
+    if journal_store.all():
+        reconcile_journal(database)
+
+
+def start_mongo_monitor(wait=0):
+    """Start watching MongoDB in the background (once per process).
+
+    Nothing blocks on the server: the local store is used until the
+    first successful ping, and from then on the backend follows the
+    server's health. ``wait`` bounds how many seconds to wait for that
+    first ping. Returns whether MongoDB is in use.
+    """
+    global _monitor
+    if Config.STORAGE_BACKEND != 'mongodb' or not Config.MONGODB_URI:
+        return False
+    if _monitor is None:
+        _monitor = MongoMonitor(
+            Config.MONGODB_URI,
+            Config.MONGO_DB_NAME,
+            timeout_ms=Config.MONGO_TIMEOUT_MS,
+            interval=Config.MONGO_PROBE_INTERVAL,
+            on_up=_use_mongodb,
+            on_down=_use_files,
+            on_healthy=_reconcile_pending
+        )
+    _monitor.start(wait)
+    return USE_MONGODB
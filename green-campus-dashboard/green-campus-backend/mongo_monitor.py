@@ -0,0 +1,84 @@
+import threading
+from pymongo import MongoClient
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+
+class MongoMonitor:
+    """Background health probe for the MongoDB connection.
+
+    The client is created on ``start`` (``MongoClient`` connects in the
+    background, so this never blocks) and a daemon thread pings the
+    server every ``interval`` seconds. ``on_up(database)`` is called when
+    the server becomes reachable and ``on_down(error)`` when it stops
+    answering; while it stays up ``on_healthy(database)`` runs after each
+    successful ping. ``on_up`` may raise to stay in the down state and
+    be retried on the next probe.
+    """
+
+    def __init__(self, uri, db_name, timeout_ms=5000, interval=5.0,
+                 on_up=None, on_down=None, on_healthy=None):
+        self.uri = uri
+        self.db_name = db_name
+        self.timeout_ms = timeout_ms
+        self.interval = interval
+        self.on_up = on_up
+        self.on_down = on_down
+        self.on_healthy = on_healthy
+        self.up = False
+        self.client = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._probed = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, wait=0):
+        """Start probing; optionally wait up to ``wait`` seconds for the
+        first result. Returns whether MongoDB is up."""
+        with self._lock:
+            if self._thread is None:
+                self.client = MongoClient(self.uri, serverSelectionTimeoutMS=self.timeout_ms,
+                                          connectTimeoutMS=self.timeout_ms)
+                self._thread = threading.Thread(target=self._loop, name='mongo-monitor',
+                                                daemon=True)
+                self._thread.start()
+        if wait:
+            self._probed.wait(wait)
+        return self.up
+
+    def stop(self):
+        self._stop.set()
+
+    def probe(self):
+        """Ping once and fire the transition callbacks"""
+        try:
+            self.client.admin.command('ping')
+        except Exception as e:
+            if self.up or not self._probed.is_set():
+                self.up = False
+                if self.on_down:
+                    self.on_down(e)
+            return False
+
+        database = self.client[self.db_name]
+        if not self.up:
+            try:
+                if self.on_up:
+                    self.on_up(database)
+            except Exception as e:
+                logger.error("MongoDB is reachable but could not be brought into use: %s", e)
+                return False
+            self.up = True
+        elif self.on_healthy:
+            try:
+                self.on_healthy(database)
+            except Exception as e:
+                logger.error("MongoDB maintenance failed: %s", e)
+        return True
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.probe()
+            self._probed.set()
+            self._stop.wait(self.interval)
@@ -0,0 +1,148 @@
+import os
+import hmac
+import base64
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from config import Config
+import metrics
+
+SCHEME = 'scrypt'
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+VERIFY_SECONDS = metrics.Histogram('password_verify_duration_seconds',
+                                   'Time from submitting a password check to its result')
+VERIFY_REJECTED = metrics.Counter('password_verify_rejected_total',
+                                  'Password checks refused because the pool was saturated')
+
+
+class VerificationBusy(RuntimeError):
+    """Too many password jobs are queued; the caller should retry later"""
+
+
+def _b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def _derive(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                          maxmem=128 * r * (n + p + 2) + 1024 * 1024, dklen=KEY_BYTES)
+
+
+def _current_params():
+    return Config.PASSWORD_SCRYPT_N, Config.PASSWORD_SCRYPT_R, Config.PASSWORD_SCRYPT_P
+
+
+def hash_password(password):
+    """Encode ``password`` as ``scrypt$n$r$p$salt$key`` with the configured cost"""
+    n, r, p = _current_params()
+    salt = os.urandom(SALT_BYTES)
+    return '$'.join((SCHEME, str(n), str(r), str(p), _b64(salt),
+                     _b64(_derive(password, salt, n, r, p))))
+
+
+def check_password(stored, password):
+    """Return (matches, needs_rehash) for a stored credential.
+
+    Anything that is not a scrypt hash is a plaintext password from
+    before hashing was introduced: it is compared in constant time and
+    always needs a rehash, as does a hash made with a different cost.
+    """
+    if not isinstance(stored, str) or not isinstance(password, str):
+        return False, False
+    parts = stored.split('$')
+    if len(parts) != 6 or parts[0] != SCHEME:
+        return hmac.compare_digest(stored.encode('utf-8'), password.encode('utf-8')), True
+    try:
+        n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+        salt, key = base64.b64decode(parts[4]), base64.b64decode(parts[5])
+    except ValueError:
+        return False, False
+    matches = hmac.compare_digest(_derive(password, salt, n, r, p), key)
+    return matches, (n, r, p) != _current_params()
+
+
+# Checked when the user does not exist, so a login takes as long for an
+# unknown email as for a wrong password
+_DUMMY_HASH = None
+_dummy_lock = threading.Lock()
+
+
+def _dummy_hash():
+    global _DUMMY_HASH
+    if _DUMMY_HASH is None:
+        with _dummy_lock:
+            if _DUMMY_HASH is None:
+                _DUMMY_HASH = hash_password(_b64(os.urandom(SALT_BYTES)))
+    return _DUMMY_HASH
+
+
+def _check_or_dummy(stored, password):
+    if stored is None:
+        check_password(_dummy_hash(), password)
+        return False, False
+    return check_password(stored, password)
+
+
+class VerificationPool:
+    """Runs password hashing and checks on a few dedicated threads.
+
+    hashlib.scrypt releases the GIL, so at most ``workers`` cores go to
+    hashing however many logins arrive, and request threads waiting for
+    a result use no CPU. Once ``max_pending`` jobs are queued or
+    running, further ones fail fast with VerificationBusy instead of
+    piling up behind a login storm.
+    """
+
+    def __init__(self, workers=2, max_pending=64, timeout=10.0):
+        self.workers = workers
+        self.timeout = timeout
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                        thread_name_prefix='password-verify')
+        return self._executor
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            VERIFY_REJECTED.inc()
+            raise VerificationBusy('Too many concurrent logins')
+        try:
+            future = self._pool().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the work really finishes, even if the
+        # caller stops waiting for it
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            raise VerificationBusy('Password hashing timed out')
+
+    def check(self, stored, password):
+        """(matches, needs_rehash) of check_password, computed on the pool.
+
+        ``stored`` None (unknown user) is checked against a dummy hash and
+        never matches. Raises VerificationBusy when the pool is saturated.
+        """
+        with metrics.timer(VERIFY_SECONDS):
+            return self._run(_check_or_dummy, stored, password)
+
+    def hash(self, password):
+        """hash_password computed on the pool"""
+        return self._run(hash_password, password)
+
+
+verification_pool = VerificationPool(
+    workers=Config.PASSWORD_VERIFY_WORKERS,
+    max_pending=Config.PASSWORD_VERIFY_MAX_PENDING,
+    timeout=Config.PASSWORD_VERIFY_TIMEOUT
+)
@@ -0,0 +1,127 @@
+import time
+import hashlib
+import threading
+from metrics import CACHE_REQUESTS
+
+
+class CachedResponse:
+    """A serialized response body with its strong ETag and version"""
+
+    __slots__ = ('body', 'etag', 'version', 'expires_at', 'depends_on')
+
+    def __init__(self, body, version, expires_at, depends_on=None):
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.version = version
+        self.expires_at = expires_at
+        self.depends_on = depends_on
+
+
+class ResponseCache:
+    """In-process cache of precomputed response bodies, keyed by name.
+
+    Entries are rebuilt on first use after ``invalidate`` (called by the
+    writers in this process) or after ``ttl`` seconds, which bounds how
+    long a write made by another worker process can go unnoticed. Each
+    rebuild bumps the entry's version; only one thread rebuilds a key
+    while the others wait for its result.
+    """
+
+    def __init__(self, ttl=5.0):
+        self.ttl = ttl
+        self._entries = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def _fresh(self, entry, depends_on):
+        return (entry is not None and entry.expires_at > time.monotonic()
+                and entry.depends_on == depends_on)
+
+    def get(self, key, build, depends_on=None):
+        """Return the cached entry for ``key``, building it with ``build()``
+        (which must return bytes) when missing or expired.
+
+        ``depends_on`` ties the entry to the version of whatever it was
+        derived from (e.g. another entry's ETag): a different value
+        forces a rebuild.
+        """
+        entry = self._entries.get(key)
+        if self._fresh(entry, depends_on):
+            CACHE_REQUESTS.inc(key=key, result='hit')
+            return entry
+        with self._lock:
+            entry = self._entries.get(key)
+            if self._fresh(entry, depends_on):
+                CACHE_REQUESTS.inc(key=key, result='hit')
+                return entry
+            CACHE_REQUESTS.inc(key=key, result='miss')
+            body = build()
+            version = self._versions.get(key, 0) + 1
+            self._versions[key] = version
+            entry = CachedResponse(body, version, time.monotonic() + self.ttl, depends_on)
+            self._entries[key] = entry
+            return entry
+
+    def invalidate(self, key):
+        """Drop ``key`` so the next ``get`` rebuilds it"""
+        self._entries.pop(key, None)
+
+
+class FragmentCache:
+    """Serialized JSON of individual documents, keyed by _id and valid for
+    one ``rev``, so list responses are assembled from cached bytes.
+
+    Every write to a message stamps a new rev, which makes its cached
+    fragment miss and be replaced on the next read; ``discard`` frees
+    deleted ones and ``clear`` everything (e.g. on a backend switch).
+    Holds at most ``size`` fragments, evicting the oldest first (0
+    disables the cache). Documents without a rev are never cached.
+    """
+
+    def __init__(self, encode, size=50000, name='fragments'):
+        self.encode = encode
+        self.size = size
+        self.name = name
+        # _id -> (rev, bytes)
+        self._fragments = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._fragments)
+
+    def get_many(self, docs):
+        """Serialized bytes of each of ``docs``, in order"""
+        get = self._fragments.get
+        # Cached fragments never have a None rev, so rev-less docs miss
+        fragments = [cached[1] if (cached := get(doc['_id'])) is not None
+                     and cached[0] == doc.get('rev') else None
+                     for doc in docs]
+        misses = [i for i, fragment in enumerate(fragments) if fragment is None]
+        for i in misses:
+            fragments[i] = self.encode(docs[i])
+        if misses and self.size:
+            self._store([(docs[i]['_id'], docs[i]['rev'], fragments[i])
+                         for i in misses if docs[i].get('rev') is not None])
+        if fragments:
+            CACHE_REQUESTS.inc(len(fragments) - len(misses), key=self.name, result='hit')
+            CACHE_REQUESTS.inc(len(misses), key=self.name, result='miss')
+        return fragments
+
+    def _store(self, entries):
+        """Cache (_id, rev, fragment) entries, evicting the oldest to make room"""
+        with self._lock:
+            for doc_id, rev, fragment in entries[-self.size:]:
+                self._fragments.pop(doc_id, None)
+                if len(self._fragments) >= self.size:
+                    del self._fragments[next(iter(self._fragments))]
+                self._fragments[doc_id] = (rev, fragment)
+
+    def discard(self, doc_ids):
+        """Drop the fragments of ``doc_ids`` (e.g. deleted messages)"""
+        with self._lock:
+            for doc_id in doc_ids:
+                self._fragments.pop(doc_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._fragments.clear()
@@ -0,0 +1,168 @@
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime, timezone
+from urllib.parse import quote, unquote
+
+import numpy as np
+
+from file_store import file_lock
+
+# Column dtypes: Unix milliseconds and reading values, little-endian,
+# fixed-width so a segment file is a raw NumPy array on disk
+TS_DTYPE = np.dtype('<i8')
+VALUE_DTYPE = np.dtype('<f8')
+
+
+def _month(ts_ms):
+    return datetime.fromtimestamp(ts_ms / 1000, timezone.utc).strftime('%Y%m')
+
+
+class SeriesStore:
+    """Columnar, append-only store for raw meter readings.
+
+    Layout: ``<root>/<resource>/<meter>/<YYYYMM>.ts`` holds int64 Unix
+    milliseconds and the sibling ``.val`` file float64 values, one row per
+    reading. Writers only ever append to the current month's segment;
+    readers map segments with ``numpy.memmap`` and aggregate over
+    zero-copy slices, so a range query never parses or copies rows it
+    does not touch. Appends hold ``<root>/.lock`` so the two columns of a
+    segment stay aligned when several processes ingest at once.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        # path -> (size, is_sorted), so order is only checked once per size
+        self._sorted = {}
+
+    # ---------- layout ----------
+
+    def _meter_dir(self, resource, meter_id):
+        return os.path.join(self.root, resource, quote(meter_id, safe=''))
+
+    def meters(self, resource):
+        """Meter ids that have data for ``resource``"""
+        directory = os.path.join(self.root, resource)
+        if not os.path.isdir(directory):
+            return []
+        return [unquote(name) for name in os.listdir(directory)]
+
+    def _segments(self, resource, meter_id):
+        directory = self._meter_dir(resource, meter_id)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(os.path.join(directory, name[:-3])
+                      for name in os.listdir(directory) if name.endswith('.ts'))
+
+    # ---------- writes ----------
+
+    def append(self, readings):
+        """Append parsed readings (``ts`` in seconds) to their segments.
+
+        Rows are grouped per segment and sorted by time before being
+        written, then both column files are fsynced.
+        """
+        groups = defaultdict(list)
+        for r in readings:
+            ts_ms = int(round(r['ts'] * 1000))
+            groups[(r['resource'], r['meter_id'], _month(ts_ms))].append((ts_ms, r['value']))
+
+        with self._lock, file_lock(os.path.join(self.root, '.lock')):
+            for (resource, meter_id, month), rows in groups.items():
+                rows.sort()
+                directory = self._meter_dir(resource, meter_id)
+                os.makedirs(directory, exist_ok=True)
+                base = os.path.join(directory, month)
+                self._repair(base)
+                ts = np.fromiter((row[0] for row in rows), dtype=TS_DTYPE, count=len(rows))
+                values = np.fromiter((row[1] for row in rows), dtype=VALUE_DTYPE, count=len(rows))
+                for path, column in ((base + '.ts', ts), (base + '.val', values)):
+                    with open(path, 'ab') as f:
+                        f.write(column.tobytes())
+                        f.flush()
+                        os.fsync(f.fileno())
+        return len(readings)
+
+    def _repair(self, base):
+        """Trim columns to equal length after a crash between the two appends"""
+        try:
+            rows_ts = os.path.getsize(base + '.ts') // TS_DTYPE.itemsize
+            rows_val = os.path.getsize(base + '.val') // VALUE_DTYPE.itemsize
+        except FileNotFoundError:
+            return
+        rows = min(rows_ts, rows_val)
+        os.truncate(base + '.ts', rows * TS_DTYPE.itemsize)
+        os.truncate(base + '.val', rows * VALUE_DTYPE.itemsize)
+
+    # ---------- reads ----------
+
+    def _open(self, base):
+        """Memory-map a segment; returns (ts, values) views or None if empty"""
+        try:
+            rows = min(os.path.getsize(base + '.ts') // TS_DTYPE.itemsize,
+                       os.path.getsize(base + '.val') // VALUE_DTYPE.itemsize)
+        except FileNotFoundError:
+            return None
+        if rows == 0:
+            return None
+        ts = np.memmap(base + '.ts', dtype=TS_DTYPE, mode='r', shape=(rows,))
+        values = np.memmap(base + '.val', dtype=VALUE_DTYPE, mode='r', shape=(rows,))
+        return ts, values
+
+    def _is_sorted(self, base, ts):
+        cached = self._sorted.get(base)
+        if cached and cached[0] == len(ts):
+            return cached[1]
+        is_sorted = bool(np.all(ts[1:] >= ts[:-1]))
+        self._sorted[base] = (len(ts), is_sorted)
+        return is_sorted
+
+    def _slices(self, resource, start_ms, end_ms, meter_ids=None):
+        """Yield (ts, values) views of every segment row in [start, end)"""
+        first_month, last_month = _month(start_ms), _month(max(start_ms, end_ms - 1))
+        for meter_id in (meter_ids if meter_ids is not None else self.meters(resource)):
+            for base in self._segments(resource, meter_id):
+                if not first_month <= os.path.basename(base) <= last_month:
+                    continue
+                segment = self._open(base)
+                if segment is None:
+                    continue
+                ts, values = segment
+                if self._is_sorted(base, ts):
+                    lo, hi = np.searchsorted(ts, [start_ms, end_ms], side='left')
+                    if hi > lo:
+                        yield ts[lo:hi], values[lo:hi]
+                else:
+                    mask = (ts >= start_ms) & (ts < end_ms)
+                    if mask.any():
+                        yield ts[mask], values[mask]
+
+    def aggregate(self, resource, start, end, meter_ids=None):
+        """sum/min/max/count of readings with start <= ts < end (seconds)"""
+        total, count = 0.0, 0
+        low, high = np.inf, -np.inf
+        for _, values in self._slices(resource, int(start * 1000), int(end * 1000), meter_ids):
+            total += float(values.sum())
+            count += len(values)
+            low = min(low, float(values.min()))
+            high = max(high, float(values.max()))
+        if not count:
+            return {'sum': 0.0, 'min': None, 'max': None, 'count': 0}
+        return {'sum': total, 'min': low, 'max': high, 'count': count}
+
+    def bucketed(self, resource, start, end, step, meter_ids=None):
+        """Per-interval sums and counts over [start, end) in ``step`` seconds.
+
+        Returns (bucket start times in seconds, sums, counts) as arrays.
+        """
+        start_ms, end_ms, step_ms = int(start * 1000), int(end * 1000), int(step * 1000)
+        buckets = max(0, -(-(end_ms - start_ms) // step_ms))
+        sums = np.zeros(buckets, dtype=VALUE_DTYPE)
+        counts = np.zeros(buckets, dtype=np.int64)
+        for ts, values in self._slices(resource, start_ms, end_ms, meter_ids):
+            index = (ts - start_ms) // step_ms
+            sums += np.bincount(index, weights=values, minlength=buckets)
+            counts += np.bincount(index, minlength=buckets)
+        starts = (start_ms + np.arange(buckets, dtype=np.int64) * step_ms) / 1000
+        return starts, sums, counts
@@ -0,0 +1,74 @@
+import os
+import time
+from config import Config
+import models
+from models import User, ensure_data_dir
+from email_queue import start_email_workers
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+
+class StartupError(RuntimeError):
+    """The application cannot serve requests with its current storage"""
+
+
+def check_storage():
+    """Verify the local store, which is always available as a fallback.
+
+    MongoDB indexes are verified by models each time it switches to
+    MongoDB; it stays on the local store if they cannot be.
+    """
+    ensure_data_dir()
+    if not os.access(models.DATA_DIR, os.W_OK):
+        raise StartupError(f'Data directory {models.DATA_DIR} is not writable')
+
+
+def seed_default_users():
+    """Create the admin and sample accounts if they do not exist yet"""
+    created = [
+        User.ensure_user(Config.ADMIN_EMAIL, Config.ADMIN_PASSWORD, role='admin'),
+        User.ensure_user(Config.SAMPLE_USER_EMAIL, Config.SAMPLE_USER_PASSWORD, role='user')
+    ]
+    if any(created):
+        logger.info("Created %d default user(s)", sum(created))
+
+
+def _seed_on_mongodb(use_mongodb):
+    if use_mongodb:
+        seed_default_users()
+
+
+def warm_local_stores():
+    """Load the local stores (and replay their logs) up front"""
+    models.local_storage.refresh()
+    for store in (models.rollups_store, models.journal_store):
+        store.refresh()
+
+
+def run(warmers=()):
+    """Run the one-time startup phase for this process.
+
+    Starts the MongoDB monitor (without waiting for the server), checks
+    storage, seeds the default users, loads the local stores, runs each
+    callable in ``warmers`` (e.g. priming response caches) and starts the
+    email workers. Seeding is idempotent and serialized across processes,
+    so every worker can run this at boot, and it runs again whenever the
+    backend switches to MongoDB. Any failure raises StartupError so the
+    process exits instead of serving errors.
+    """
+    started = time.monotonic()
+    models.on_backend_change(_seed_on_mongodb)
+    try:
+        check_storage()
+        models.start_mongo_monitor()
+        seed_default_users()
+        warm_local_stores()
+        for warm in warmers:
+            warm()
+    except StartupError:
+        raise
+    except Exception as e:
+        raise StartupError(f'Startup failed: {e}') from e
+    start_email_workers()
+    logger.info("Startup complete in %.2fs", time.monotonic() - started)
@@ -0,0 +1,1040 @@
+import os
+import sqlite3
+import time
+import threading
+from heapq import merge
+from itertools import islice
+from contextlib import contextmanager
+from datetime import datetime
+from bson import ObjectId
+from pymongo import errors, ReturnDocument, UpdateOne, ReplaceOne
+from file_store import JsonCollection, write_json_atomic
+import json_codec
+from search import TextIndex, tokenize, parse_query
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+
+def _iso(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _local_doc(doc):
+    """Copy of a document as the local backends store it: string _id and
+    ISO timestamps, including those of replies"""
+    out = {k: _iso(v) for k, v in doc.items()}
+    out['_id'] = str(out.get('_id') or ObjectId())
+    if 'replies' in out:
+        out['replies'] = [{k: _iso(v) for k, v in reply.items()} for reply in out['replies']]
+    return out
+
+
+def _object_id(value):
+    return ObjectId(value) if isinstance(value, str) and ObjectId.is_valid(value) else value
+
+
+def _tombstone(message_id, user_email, rev):
+    return {'_id': message_id, 'user_email': user_email, 'rev': rev, 'deleted': True}
+
+
+def _merge_changes(messages, tombstones, limit):
+    """Interleave two rev-ordered lists, keeping the first ``limit``"""
+    merged = merge(messages, tombstones, key=lambda doc: doc['rev'])
+    return list(islice(merged, limit) if limit else merged)
+
+
+def _deletion_results(message_ids, found):
+    """Per-id results of a bulk delete of ``found``: as when deleting one
+    by one, an id repeated in the list finds nothing the second time"""
+    seen = set()
+    results = []
+    for message_id in message_ids:
+        results.append(message_id in found and message_id not in seen)
+        seen.add(message_id)
+    return results
+
+
+def _rank_messages(messages, query, limit):
+    """[(message, score)] of ``messages`` matching ``query``, ranked by an
+    index built over just them"""
+    index = TextIndex()
+    by_id = {}
+    for message in messages:
+        index.add(message)
+        by_id[message['_id']] = message
+    return [(by_id[message_id], score) for message_id, score in index.search(query, limit=limit)]
+
+
+class StorageBackend:
+    """Storage for users, messages and the dashboard.
+
+    The models call these methods instead of branching per database.
+    Documents are passed in with datetimes; they come back with a string
+    ``_id`` and timestamps as the backend keeps them (datetimes from
+    MongoDB, ISO strings from the local backends). Message queries are
+    newest first on (created_at, _id).
+
+    Every message write stamps the message with a new ``rev``, higher
+    than any before it in that backend; a delete leaves a tombstone with
+    its own. ``message_changes`` lists both after a given revision, so
+    clients can sync without re-reading the inbox.
+    """
+
+    name = None
+
+    def refresh(self):
+        """Load or revalidate any in-process state ahead of traffic"""
+
+    def close(self):
+        """Release connections and files"""
+
+    # ---------- dashboard ----------
+
+    def get_dashboard(self):
+        """Return the saved dashboard dict, or None"""
+        raise NotImplementedError
+
+    def save_dashboard(self, dashboard):
+        """Replace the saved dashboard"""
+        raise NotImplementedError
+
+    # ---------- users ----------
+
+    def create_user(self, user):
+        """Insert ``user`` unless its email is taken; returns its _id or None.
+
+        Atomic per email, so concurrent callers create one user at most.
+        """
+        raise NotImplementedError
+
+    def find_user(self, email):
+        """Return the user with this email, or None"""
+        raise NotImplementedError
+
+    def update_user(self, email, fields):
+        """Set ``fields`` on the user with this email; False if missing"""
+        raise NotImplementedError
+
+    # ---------- messages ----------
+
+    def create_message(self, message):
+        """Insert a new message; returns its _id"""
+        raise NotImplementedError
+
+    def create_messages(self, messages):
+        """Insert several new messages in one durable write; returns their _ids.
+
+        All or nothing: on error none of them is reported as created.
+        """
+        return [self.create_message(message) for message in messages]
+
+    def insert_message(self, message):
+        """Insert a message under its own _id; False if that _id exists or
+        was deleted (nothing is replaced, and no deleted message restored)"""
+        raise NotImplementedError
+
+    def get_message(self, message_id):
+        """Return one message, or None"""
+        raise NotImplementedError
+
+    def get_messages(self, message_ids):
+        """Return the existing messages among ``message_ids``, keyed by _id"""
+        found = {}
+        for message_id in message_ids:
+            message = self.get_message(message_id)
+            if message is not None:
+                found[message_id] = message
+        return found
+
+    def query_messages(self, limit=None, before=None, status=None, user_email=None,
+                       since=None, until=None):
+        """Return up to ``limit`` (None: all) messages, newest first.
+
+        ``before`` is an exclusive (created_at ISO string, _id) keyset
+        position; ``since``/``until`` are datetimes bounding created_at
+        (inclusive/exclusive).
+        """
+        raise NotImplementedError
+
+    def add_reply(self, message_id, reply):
+        """Append ``reply`` and mark the message replied; False if missing"""
+        raise NotImplementedError
+
+    def set_status(self, message_id, status, expected=None):
+        """Set a message's status; False if missing, or if ``expected`` is
+        given and the status is something else (compare-and-set)"""
+        raise NotImplementedError
+
+    def delete_message(self, message_id):
+        """Delete a message, leaving a tombstone; False if missing"""
+        raise NotImplementedError
+
+    # The bulk variants below make one durable write for the whole list
+    # and return one boolean per item, False where the message is missing
+
+    def add_replies(self, replies):
+        """``add_reply`` for each (message_id, reply) pair"""
+        return [self.add_reply(message_id, reply) for message_id, reply in replies]
+
+    def set_statuses(self, message_ids, status):
+        """``set_status`` for each of ``message_ids``"""
+        return [self.set_status(message_id, status) for message_id in message_ids]
+
+    def delete_messages(self, message_ids):
+        """``delete_message`` for each of ``message_ids``"""
+        return [self.delete_message(message_id) for message_id in message_ids]
+
+    def message_revision(self):
+        """Revision of the latest message write (0 before the first)"""
+        raise NotImplementedError
+
+    def search_messages(self, query, user_email=None, limit=None):
+        """Return [(message, score)] of the messages matching ``query``,
+        best first, up to ``limit`` (None: all).
+
+        Every word must occur in the subject, body or a reply; the last
+        one may be the start of a word (see search.parse_query). This
+        fallback indexes the messages on each call.
+        """
+        return _rank_messages(self.query_messages(user_email=user_email), query, limit)
+
+    def message_changes(self, since, user_email=None, limit=None):
+        """Messages and tombstones (``{'_id', 'user_email', 'rev',
+        'deleted': True}``) with a rev above ``since``, lowest rev first,
+        up to ``limit`` (None: all)"""
+        raise NotImplementedError
+
+
+class MongoBackend(StorageBackend):
+    """Users, messages and the dashboard in MongoDB (indexes: models.MONGO_INDEXES).
+
+    Revisions are drawn from a counter and written a round trip later, so
+    a higher one can land before a lower one. Each write also stores when
+    its revision was drawn (``rev_at``, kept out of returned documents),
+    and ``message_changes`` stops below a missing revision drawn within
+    the last ``settle_seconds``, the time allowed for a write to land.
+    """
+
+    name = 'mongodb'
+
+    def __init__(self, database, settle_seconds=5.0):
+        self.db = database
+        self.settle_seconds = settle_seconds
+
+    @staticmethod
+    def _public(doc):
+        if doc is not None:
+            doc['_id'] = str(doc['_id'])
+            doc.pop('rev_at', None)
+        return doc
+
+    def get_dashboard(self):
+        doc = self.db['dashboard'].find_one({})
+        if doc:
+            doc.pop('_id', None)
+            return doc
+        return None
+
+    def save_dashboard(self, dashboard):
+        self.db['dashboard'].replace_one({}, dict(dashboard), upsert=True)
+
+    def create_user(self, user):
+        doc = dict(user)
+        if '_id' in doc:
+            doc['_id'] = _object_id(doc['_id'])
+        try:
+            result = self.db['users'].insert_one(doc)
+        except errors.DuplicateKeyError:
+            # Unique index on email
+            return None
+        return str(result.inserted_id)
+
+    def find_user(self, email):
+        return self._public(self.db['users'].find_one({'email': email}))
+
+    def update_user(self, email, fields):
+        return self.db['users'].update_one({'email': email}, {'$set': fields}).matched_count > 0
+
+    def _next_revs(self, count=1):
+        """Draw ``count`` consecutive revisions; returns (first, drawn_at).
+
+        The write that uses them lands a round trip later, so for that
+        moment a higher revision can be visible before a lower one; the
+        write stores ``drawn_at`` as ``rev_at`` (see message_changes).
+        """
+        drawn_at = time.time()
+        counter = self.db['counters'].find_one_and_update(
+            {'_id': 'messages'}, {'$inc': {'rev': count}},
+            upsert=True, return_document=ReturnDocument.AFTER
+        )
+        return counter['rev'] - count + 1, drawn_at
+
+    def create_message(self, message):
+        rev, drawn_at = self._next_revs()
+        result = self.db['messages'].insert_one(dict(message, rev=rev, rev_at=drawn_at))
+        return str(result.inserted_id)
+
+    def create_messages(self, messages):
+        first, drawn_at = self._next_revs(len(messages))
+        result = self.db['messages'].insert_many(
+            [dict(message, rev=first + i, rev_at=drawn_at) for i, message in enumerate(messages)]
+        )
+        return [str(inserted_id) for inserted_id in result.inserted_ids]
+
+    def insert_message(self, message):
+        message_id = _object_id(message['_id'])
+        if self.db['message_tombstones'].find_one({'_id': message_id}, {'_id': 1}):
+            return False
+        rev, drawn_at = self._next_revs()
+        try:
+            self.db['messages'].insert_one(dict(message, _id=message_id, rev=rev, rev_at=drawn_at))
+        except errors.DuplicateKeyError:
+            return False
+        return True
+
+    def get_message(self, message_id):
+        if not ObjectId.is_valid(message_id):
+            return None
+        return self._public(self.db['messages'].find_one({'_id': ObjectId(message_id)}))
+
+    def _find_many(self, message_ids, projection=None):
+        """The existing messages among ``message_ids`` (all fields, or just
+        ``projection``'s), keyed by string _id; invalid ids match nothing"""
+        object_ids = [ObjectId(message_id) for message_id in set(message_ids)
+                      if ObjectId.is_valid(message_id)]
+        if not object_ids:
+            return {}
+        found = self.db['messages'].find({'_id': {'$in': object_ids}}, projection)
+        return {str(doc['_id']): doc for doc in found}
+
+    def get_messages(self, message_ids):
+        return {message_id: self._public(doc)
+                for message_id, doc in self._find_many(message_ids).items()}
+
+    def query_messages(self, limit=None, before=None, status=None, user_email=None,
+                       since=None, until=None):
+        query = {}
+        if status:
+            query['status'] = status
+        if user_email:
+            query['user_email'] = user_email
+        created = {}
+        if since:
+            created['$gte'] = since
+        if until:
+            created['$lt'] = until
+        if created:
+            query['created_at'] = created
+        if before:
+            created_at = datetime.fromisoformat(before[0])
+            query['$or'] = [
+                {'created_at': {'$lt': created_at}},
+                {'created_at': created_at, '_id': {'$lt': ObjectId(before[1])}}
+            ]
+        found = self.db['messages'].find(query).sort([('created_at', -1), ('_id', -1)])
+        if limit:
+            found = found.limit(limit)
+        return [self._public(doc) for doc in found]
+
+    def add_reply(self, message_id, reply):
+        rev, drawn_at = self._next_revs()
+        result = self.db['messages'].update_one(
+            {'_id': ObjectId(message_id)},
+            {'$push': {'replies': reply}, '$set': {'status': 'replied', 'rev': rev, 'rev_at': drawn_at}}
+        )
+        return result.matched_count > 0
+
+    def set_status(self, message_id, status, expected=None):
+        query = {'_id': ObjectId(message_id)}
+        if expected is not None:
+            query['status'] = expected
+        rev, drawn_at = self._next_revs()
+        result = self.db['messages'].update_one(query,
+                                                {'$set': {'status': status, 'rev': rev, 'rev_at': drawn_at}})
+        return result.matched_count > 0
+
+    def delete_message(self, message_id):
+        deleted = self.db['messages'].find_one_and_delete({'_id': ObjectId(message_id)},
+                                                          projection={'user_email': 1})
+        if deleted is None:
+            return False
+        rev, drawn_at = self._next_revs()
+        tombstone = dict(_tombstone(deleted['_id'], deleted.get('user_email'), rev), rev_at=drawn_at)
+        self.db['message_tombstones'].replace_one({'_id': deleted['_id']}, tombstone, upsert=True)
+        return True
+
+    # The bulk writes look the messages up first and report those found
+    # then: one query, one revision draw and one bulk write per call
+
+    def add_replies(self, replies):
+        found = self._find_many([message_id for message_id, _ in replies], {'_id': 1})
+        pending = [(message_id, reply) for message_id, reply in replies if message_id in found]
+        if pending:
+            first, drawn_at = self._next_revs(len(pending))
+            self.db['messages'].bulk_write([
+                UpdateOne({'_id': found[message_id]['_id']},
+                          {'$push': {'replies': reply},
+                           '$set': {'status': 'replied', 'rev': first + i, 'rev_at': drawn_at}})
+                for i, (message_id, reply) in enumerate(pending)
+            ])
+        return [message_id in found for message_id, _ in replies]
+
+    def set_statuses(self, message_ids, status):
+        found = self._find_many(message_ids, {'_id': 1})
+        if found:
+            first, drawn_at = self._next_revs(len(found))
+            self.db['messages'].bulk_write([
+                UpdateOne({'_id': doc['_id']},
+                          {'$set': {'status': status, 'rev': first + i, 'rev_at': drawn_at}})
+                for i, doc in enumerate(found.values())
+            ], ordered=False)
+        return [message_id in found for message_id in message_ids]
+
+    def delete_messages(self, message_ids):
+        found = self._find_many(message_ids, {'user_email': 1})
+        if found:
+            docs = list(found.values())
+            self.db['messages'].delete_many({'_id': {'$in': [doc['_id'] for doc in docs]}})
+            first, drawn_at = self._next_revs(len(docs))
+            self.db['message_tombstones'].bulk_write([
+                ReplaceOne({'_id': doc['_id']},
+                           dict(_tombstone(doc['_id'], doc.get('user_email'), first + i), rev_at=drawn_at),
+                           upsert=True)
+                for i, doc in enumerate(docs)
+            ], ordered=False)
+        return _deletion_results(message_ids, found)
+
+    def message_revision(self):
+        counter = self.db['counters'].find_one({'_id': 'messages'})
+        return counter['rev'] if counter else 0
+
+    def search_messages(self, query, user_email=None, limit=None):
+        # The text index stems words instead of matching prefixes; quoting
+        # each word makes all of them required
+        words = tokenize(query)
+        if not words:
+            return []
+        text = {'$text': {'$search': ' '.join(f'"{word}"' for word in words)}}
+        if user_email:
+            text['user_email'] = user_email
+        score = {'$meta': 'textScore'}
+        found = self.db['messages'].find(text, {'score': score}).sort([('score', score)])
+        if limit:
+            found = found.limit(limit)
+        results = []
+        for doc in found:
+            relevance = doc.pop('score')
+            results.append((self._public(doc), relevance))
+        return results
+
+    def _unsettled_rev(self, high, since):
+        """Lowest revision in (since, high] that may belong to a write
+        still in flight, or None.
+
+        Revisions drawn more than ``settle_seconds`` ago have landed or
+        never will (superseded by a later write to the message, or a
+        failed write). Above the newest of those, each revision up to the
+        counter should be visible; the first that is not may be in flight.
+        """
+        settled = time.time() - self.settle_seconds
+        old = {'$or': [{'rev_at': {'$lte': settled}}, {'rev_at': {'$exists': False}}]}
+        floor = since
+        for collection in ('messages', 'message_tombstones'):
+            doc = self.db[collection].find_one(old, {'rev': 1}, sort=[('rev', -1)])
+            if doc and doc.get('rev') is not None:
+                floor = max(floor, doc['rev'])
+        visible = set()
+        for collection in ('messages', 'message_tombstones'):
+            visible.update(doc['rev'] for doc in self.db[collection].find(
+                {'rev': {'$gt': floor, '$lte': high}}, {'rev': 1}))
+        return next((rev for rev in range(floor + 1, high + 1) if rev not in visible), None)
+
+    def message_changes(self, since, user_email=None, limit=None):
+        # Read first, so a write drawing its revision meanwhile is left out
+        high = self.message_revision()
+        query = {'rev': {'$gt': since}}
+        if user_email:
+            query['user_email'] = user_email
+        found = []
+        for collection in ('messages', 'message_tombstones'):
+            cursor = self.db[collection].find(query).sort('rev', 1)
+            if limit:
+                cursor = cursor.limit(limit)
+            found.append(list(cursor))
+        changes = _merge_changes(found[0], found[1], limit)
+        # Nothing from the first revision that may still land onwards
+        bound = self._unsettled_rev(high, since) or high + 1
+        changes = [doc for doc in changes if doc['rev'] < bound]
+        return [self._public(doc) for doc in changes]
+
+
+class _CollectionBackend(StorageBackend):
+    """Shared logic of the JsonCollection-backed local backends"""
+
+    def __init__(self, users, messages):
+        self.users = users
+        self.messages = messages
+
+    def refresh(self):
+        self.users.refresh()
+        self.messages.refresh()
+
+    def create_user(self, user):
+        with self.users.transaction():
+            if self.users.find_one('email', user['email']):
+                return None
+            return self.users.insert(_local_doc(user))
+
+    def find_user(self, email):
+        return self.users.find_one('email', email)
+
+    def update_user(self, email, fields):
+        with self.users.transaction():
+            user = self.users.find_one('email', email)
+            if user is None:
+                return False
+            return self.users.update(user['_id'], fields={k: _iso(v) for k, v in fields.items()})
+
+    def create_message(self, message):
+        return self.messages.insert(_local_doc(message))
+
+    def create_messages(self, messages):
+        docs = [_local_doc(message) for message in messages]
+        self.messages.bulk_write([{'op': 'insert', 'doc': doc} for doc in docs])
+        return [doc['_id'] for doc in docs]
+
+    def insert_message(self, message):
+        doc = _local_doc(message)
+        with self.messages.transaction():
+            if self.messages.get(doc['_id']) is not None or self.messages.is_deleted(doc['_id']):
+                return False
+            self.messages.insert(doc)
+        return True
+
+    def get_message(self, message_id):
+        return self.messages.get(message_id)
+
+    def get_messages(self, message_ids):
+        found = {}
+        for message_id in message_ids:
+            message = self.messages.get(message_id)
+            if message is not None:
+                found[message_id] = message
+        return found
+
+    def query_messages(self, limit=None, before=None, status=None, user_email=None,
+                       since=None, until=None):
+        where = {}
+        if status:
+            where['status'] = status
+        if user_email:
+            where['user_email'] = user_email
+        return self.messages.page(limit, where=where, before=before,
+                                  since=_iso(since), until=_iso(until))
+
+    def add_reply(self, message_id, reply):
+        return self.messages.update(message_id, fields={'status': 'replied'},
+                                    push={'replies': {k: _iso(v) for k, v in reply.items()}})
+
+    def set_status(self, message_id, status, expected=None):
+        with self.messages.transaction():
+            message = self.messages.get(message_id)
+            if message is None or expected is not None and message.get('status') != expected:
+                return False
+            return self.messages.update(message_id, fields={'status': status})
+
+    def delete_message(self, message_id):
+        return self.messages.delete(message_id)
+
+    def add_replies(self, replies):
+        return self.messages.bulk_write([
+            {'op': 'update', '_id': message_id, 'set': {'status': 'replied'},
+             'push': {'replies': {k: _iso(v) for k, v in reply.items()}}}
+            for message_id, reply in replies
+        ])
+
+    def set_statuses(self, message_ids, status):
+        return self.messages.bulk_write([
+            {'op': 'update', '_id': message_id, 'set': {'status': status}}
+            for message_id in message_ids
+        ])
+
+    def delete_messages(self, message_ids):
+        return self.messages.bulk_write([{'op': 'delete', '_id': message_id}
+                                         for message_id in message_ids])
+
+    def message_revision(self):
+        return self.messages.revision
+
+    def message_changes(self, since, user_email=None, limit=None):
+        where = {'user_email': user_email} if user_email else None
+        return self.messages.changes(since, where=where, limit=limit)
+
+    def search_messages(self, query, user_email=None, limit=None):
+        where = {'user_email': user_email} if user_email else None
+        return self.messages.search(query, limit=limit, where=where)
+
+
+class FileBackend(_CollectionBackend):
+    """JSON files in the data directory (the original development store).
+
+    Users live in one JSON file, messages in a snapshot plus append-only
+    log (see file_store.JsonCollection) and the dashboard in its own file.
+    """
+
+    name = 'file'
+
+    def __init__(self, users_file, messages_file, messages_log_file, dashboard_file,
+                 compact_every=1000):
+        super().__init__(
+            JsonCollection(users_file, indexes=('email',)),
+            JsonCollection(messages_file, indexes=('user_email', 'status'),
+                           log_path=messages_log_file, compact_every=compact_every,
+                           order_by='created_at', revisions=True, text_index=TextIndex())
+        )
+        self.dashboard_file = dashboard_file
+
+    def get_dashboard(self):
+        if not os.path.exists(self.dashboard_file):
+            return None
+        try:
+            with open(self.dashboard_file, 'rb') as f:
+                return json_codec.loads(f.read()) or None
+        except Exception as e:
+            logger.error("Error loading %s: %s", self.dashboard_file, e)
+            return None
+
+    def save_dashboard(self, dashboard):
+        write_json_atomic(self.dashboard_file, dashboard)
+        logger.debug("Saved to %s", self.dashboard_file)
+
+
+class MemoryBackend(_CollectionBackend):
+    """Process-local, non-persistent storage (tests and throwaway runs)"""
+
+    name = 'memory'
+
+    def __init__(self):
+        super().__init__(
+            JsonCollection(None, indexes=('email',)),
+            JsonCollection(None, indexes=('user_email', 'status'), order_by='created_at',
+                           revisions=True, text_index=TextIndex())
+        )
+        self._dashboard = None
+
+    def get_dashboard(self):
+        return json_codec.loads(self._dashboard) if self._dashboard else None
+
+    def save_dashboard(self, dashboard):
+        self._dashboard = json_codec.dumps(dashboard)
+
+
+class SQLiteBackend(StorageBackend):
+    """Single-file SQLite database for single-node installs.
+
+    Runs in WAL mode, so readers in any thread or process proceed while
+    one writer commits. Each row keeps the full document as JSON next to
+    the columns the queries filter and sort on, which are indexed the
+    same way as the MongoDB collections. Connections are per thread and
+    reuse their compiled statements. User and dashboard writes are single
+    statements, atomic without explicit transactions; each message write
+    runs in one transaction with the draw of its revision from the
+    counters table, so revisions become visible in order.
+
+    Search uses an FTS5 table written in the same transactions. Its rows
+    share the messages' rowids, which VACUUM may renumber: drop
+    message_search after a VACUUM and it is rebuilt on the next start.
+    Without FTS5 support, searches fall back to scanning.
+    """
+
+    name = 'sqlite'
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS users (
+            _id TEXT PRIMARY KEY,
+            email TEXT NOT NULL UNIQUE,
+            doc TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            _id TEXT PRIMARY KEY,
+            user_email TEXT,
+            status TEXT,
+            created_at TEXT NOT NULL,
+            rev INTEGER,
+            doc TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_created_at ON messages (created_at, _id);
+        CREATE INDEX IF NOT EXISTS messages_user_email ON messages (user_email, created_at, _id);
+        CREATE INDEX IF NOT EXISTS messages_status ON messages (status, created_at, _id);
+        CREATE TABLE IF NOT EXISTS dashboard (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            doc TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS message_tombstones (
+            _id TEXT PRIMARY KEY,
+            user_email TEXT,
+            rev INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS message_tombstones_rev ON message_tombstones (rev);
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    '''
+
+    # Created once messages.rev exists (databases from before revisions
+    # get the column added first; their messages count as revision 0)
+    REVISION_INDEXES = '''
+        CREATE INDEX IF NOT EXISTS messages_rev ON messages (rev);
+        CREATE INDEX IF NOT EXISTS messages_user_email_rev ON messages (user_email, rev);
+    '''
+
+    # Created, and filled from the existing messages, when missing
+    SEARCH_SCHEMA = '''
+        CREATE VIRTUAL TABLE message_search USING fts5(subject, message, replies);
+        INSERT INTO message_search (rowid, subject, message, replies)
+        SELECT rowid, json_extract(doc, '$.subject'), json_extract(doc, '$.message'),
+               (SELECT group_concat(json_extract(value, '$.text'), ' ')
+                FROM json_each(doc, '$.replies'))
+        FROM messages;
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(messages)')]
+        if 'rev' not in columns:
+            conn.execute('ALTER TABLE messages ADD COLUMN rev INTEGER')
+        conn.executescript(self.REVISION_INDEXES)
+        self.full_text = True
+        try:
+            with self._transaction() as conn:
+                if not conn.execute("SELECT 1 FROM sqlite_master "
+                                    "WHERE name = 'message_search'").fetchone():
+                    for statement in filter(str.strip, self.SEARCH_SCHEMA.split(';')):
+                        conn.execute(statement)
+        except sqlite3.OperationalError as e:
+            logger.warning("SQLite full-text search unavailable (%s); searches will scan", e)
+            self.full_text = False
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                   check_same_thread=False, cached_statements=256)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    @staticmethod
+    def _dumps(doc):
+        return json_codec.dumps(doc).decode('utf-8')
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    @staticmethod
+    def _next_revs(conn, count=1):
+        """Draw ``count`` consecutive revisions inside the caller's
+        transaction; returns the first"""
+        conn.execute("INSERT INTO counters (name, value) VALUES ('messages', ?) "
+                     "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value", (count,))
+        value = conn.execute("SELECT value FROM counters WHERE name = 'messages'").fetchone()[0]
+        return value - count + 1
+
+    def get_dashboard(self):
+        row = self._conn().execute('SELECT doc FROM dashboard WHERE id = 1').fetchone()
+        return json_codec.loads(row[0]) if row else None
+
+    def save_dashboard(self, dashboard):
+        self._conn().execute('INSERT OR REPLACE INTO dashboard (id, doc) VALUES (1, ?)',
+                             (self._dumps(dashboard),))
+
+    def create_user(self, user):
+        doc = _local_doc(user)
+        try:
+            self._conn().execute('INSERT INTO users (_id, email, doc) VALUES (?, ?, ?)',
+                                 (doc['_id'], doc['email'], self._dumps(doc)))
+        except sqlite3.IntegrityError:
+            return None
+        return doc['_id']
+
+    def find_user(self, email):
+        row = self._conn().execute('SELECT doc FROM users WHERE email = ?', (email,)).fetchone()
+        return json_codec.loads(row[0]) if row else None
+
+    def update_user(self, email, fields):
+        if not fields:
+            return self.find_user(email) is not None
+        paths = ', '.join("?, json(?)" for _ in fields)
+        params = []
+        for field, value in fields.items():
+            params.extend([f'$.{field}', self._dumps(_iso(value))])
+        cursor = self._conn().execute(f'UPDATE users SET doc = json_set(doc, {paths}) WHERE email = ?',
+                                      (*params, email))
+        return cursor.rowcount > 0
+
+    def _message_row(self, message, rev):
+        doc = _local_doc(message)
+        doc['rev'] = rev
+        return (doc['_id'], doc.get('user_email'), doc.get('status'), doc['created_at'], rev,
+                self._dumps(doc))
+
+    # message_search rows are written after their message is inserted and
+    # removed before it is deleted, finding it by the message's rowid
+
+    def _index_messages(self, conn, messages):
+        """Add (message_id, message) pairs to message_search"""
+        if self.full_text:
+            conn.executemany(
+                'INSERT INTO message_search (rowid, subject, message, replies) '
+                'SELECT rowid, ?, ?, ? FROM messages WHERE _id = ?',
+                [(message.get('subject'), message.get('message'),
+                  ' '.join(reply.get('text') or '' for reply in message.get('replies') or ()),
+                  message_id)
+                 for message_id, message in messages]
+            )
+
+    def _index_replies(self, conn, replies):
+        """Append the text of (message_id, reply) pairs to message_search"""
+        if self.full_text:
+            conn.executemany(
+                "UPDATE message_search SET replies = coalesce(replies || ' ', '') || ? "
+                "WHERE rowid = (SELECT rowid FROM messages WHERE _id = ?)",
+                [(reply.get('text') or '', message_id) for message_id, reply in replies]
+            )
+
+    def _unindex_messages(self, conn, message_ids):
+        if self.full_text:
+            conn.executemany('DELETE FROM message_search '
+                             'WHERE rowid = (SELECT rowid FROM messages WHERE _id = ?)',
+                             [(message_id,) for message_id in message_ids])
+
+    def create_message(self, message):
+        return self.create_messages([message])[0]
+
+    def create_messages(self, messages):
+        # One transaction, so the batch costs a single WAL commit
+        with self._transaction() as conn:
+            first = self._next_revs(conn, len(messages))
+            rows = [self._message_row(message, first + i) for i, message in enumerate(messages)]
+            conn.executemany(
+                'INSERT INTO messages (_id, user_email, status, created_at, rev, doc) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            self._index_messages(conn, [(row[0], message) for row, message in zip(rows, messages)])
+        return [row[0] for row in rows]
+
+    def insert_message(self, message):
+        message_id = str(message['_id'])
+        with self._transaction() as conn:
+            if conn.execute('SELECT 1 FROM messages WHERE _id = ? UNION ALL '
+                            'SELECT 1 FROM message_tombstones WHERE _id = ?',
+                            (message_id, message_id)).fetchone():
+                return False
+            conn.execute(
+                'INSERT INTO messages (_id, user_email, status, created_at, rev, doc) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                self._message_row(message, self._next_revs(conn))
+            )
+            self._index_messages(conn, [(message_id, message)])
+        return True
+
+    def get_message(self, message_id):
+        row = self._conn().execute('SELECT doc FROM messages WHERE _id = ?', (message_id,)).fetchone()
+        return json_codec.loads(row[0]) if row else None
+
+    # Ids per IN (...) query, under the host parameter limit of older SQLite
+    IN_CHUNK = 500
+
+    def _find_many(self, conn, message_ids, column):
+        """``column`` of the existing messages among ``message_ids``, keyed by _id"""
+        ids = list(dict.fromkeys(message_ids))
+        found = {}
+        for start in range(0, len(ids), self.IN_CHUNK):
+            chunk = ids[start:start + self.IN_CHUNK]
+            marks = ', '.join('?' for _ in chunk)
+            for row in conn.execute(f'SELECT _id, {column} FROM messages WHERE _id IN ({marks})',
+                                    chunk):
+                found[row[0]] = row[1]
+        return found
+
+    def get_messages(self, message_ids):
+        found = self._find_many(self._conn(), message_ids, 'doc')
+        return {message_id: json_codec.loads(doc) for message_id, doc in found.items()}
+
+    def query_messages(self, limit=None, before=None, status=None, user_email=None,
+                       since=None, until=None):
+        clauses, params = [], []
+        if status:
+            clauses.append('status = ?')
+            params.append(status)
+        if user_email:
+            clauses.append('user_email = ?')
+            params.append(user_email)
+        if since:
+            clauses.append('created_at >= ?')
+            params.append(_iso(since))
+        if until:
+            clauses.append('created_at < ?')
+            params.append(_iso(until))
+        if before:
+            clauses.append('(created_at < ? OR (created_at = ? AND _id < ?))')
+            params.extend([before[0], before[0], before[1]])
+        sql = 'SELECT doc FROM messages'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY created_at DESC, _id DESC'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return [json_codec.loads(row[0]) for row in self._conn().execute(sql, params)]
+
+    def add_reply(self, message_id, reply):
+        reply = {k: _iso(v) for k, v in reply.items()}
+        with self._transaction() as conn:
+            rev = self._next_revs(conn)
+            cursor = conn.execute(
+                "UPDATE messages SET status = 'replied', rev = ?, "
+                "doc = json_insert(json_set(doc, '$.status', 'replied', '$.rev', ?), "
+                "'$.replies[#]', json(?)) WHERE _id = ?",
+                (rev, rev, self._dumps(reply), message_id)
+            )
+            self._index_replies(conn, [(message_id, reply)])
+        return cursor.rowcount > 0
+
+    def set_status(self, message_id, status, expected=None):
+        sql = ("UPDATE messages SET status = ?, rev = ?, "
+               "doc = json_set(doc, '$.status', ?, '$.rev', ?) WHERE _id = ?")
+        with self._transaction() as conn:
+            rev = self._next_revs(conn)
+            params = (status, rev, status, rev, message_id)
+            if expected is not None:
+                sql += ' AND status = ?'
+                params += (expected,)
+            cursor = conn.execute(sql, params)
+        return cursor.rowcount > 0
+
+    def delete_message(self, message_id):
+        with self._transaction() as conn:
+            row = conn.execute('SELECT user_email FROM messages WHERE _id = ?',
+                               (message_id,)).fetchone()
+            if row is None:
+                return False
+            self._unindex_messages(conn, [message_id])
+            conn.execute('DELETE FROM messages WHERE _id = ?', (message_id,))
+            conn.execute('INSERT OR REPLACE INTO message_tombstones (_id, user_email, rev) '
+                         'VALUES (?, ?, ?)', (message_id, row[0], self._next_revs(conn)))
+        return True
+
+    def add_replies(self, replies):
+        with self._transaction() as conn:
+            found = self._find_many(conn, [message_id for message_id, _ in replies], '_id')
+            pending = [(message_id, {k: _iso(v) for k, v in reply.items()})
+                       for message_id, reply in replies if message_id in found]
+            first = self._next_revs(conn, len(pending)) if pending else 0
+            conn.executemany(
+                "UPDATE messages SET status = 'replied', rev = ?, "
+                "doc = json_insert(json_set(doc, '$.status', 'replied', '$.rev', ?), "
+                "'$.replies[#]', json(?)) WHERE _id = ?",
+                [(first + i, first + i, self._dumps(reply), message_id)
+                 for i, (message_id, reply) in enumerate(pending)]
+            )
+            self._index_replies(conn, pending)
+        return [message_id in found for message_id, _ in replies]
+
+    def set_statuses(self, message_ids, status):
+        with self._transaction() as conn:
+            found = self._find_many(conn, message_ids, '_id')
+            first = self._next_revs(conn, len(found)) if found else 0
+            conn.executemany(
+                "UPDATE messages SET status = ?, rev = ?, "
+                "doc = json_set(doc, '$.status', ?, '$.rev', ?) WHERE _id = ?",
+                [(status, first + i, status, first + i, message_id)
+                 for i, message_id in enumerate(found)]
+            )
+        return [message_id in found for message_id in message_ids]
+
+    def delete_messages(self, message_ids):
+        with self._transaction() as conn:
+            found = self._find_many(conn, message_ids, 'user_email')
+            first = self._next_revs(conn, len(found)) if found else 0
+            self._unindex_messages(conn, found)
+            conn.executemany('DELETE FROM messages WHERE _id = ?',
+                             [(message_id,) for message_id in found])
+            conn.executemany('INSERT OR REPLACE INTO message_tombstones (_id, user_email, rev) '
+                             'VALUES (?, ?, ?)',
+                             [(message_id, user_email, first + i)
+                              for i, (message_id, user_email) in enumerate(found.items())])
+        return _deletion_results(message_ids, found)
+
+    def message_revision(self):
+        row = self._conn().execute("SELECT value FROM counters WHERE name = 'messages'").fetchone()
+        return row[0] if row else 0
+
+    def message_changes(self, since, user_email=None, limit=None):
+        where = 'rev > ?' + (' AND user_email = ?' if user_email else '')
+        params = [since] + ([user_email] if user_email else [])
+        tail = ' ORDER BY rev LIMIT ?' if limit else ' ORDER BY rev'
+        if limit:
+            params.append(limit)
+        conn = self._conn()
+        messages = [json_codec.loads(row[0])
+                    for row in conn.execute(f'SELECT doc FROM messages WHERE {where}{tail}', params)]
+        tombstones = [_tombstone(*row) for row in conn.execute(
+            f'SELECT _id, user_email, rev FROM message_tombstones WHERE {where}{tail}', params
+        )]
+        return _merge_changes(messages, tombstones, limit)
+
+    def search_messages(self, query, user_email=None, limit=None):
+        if not self.full_text:
+            return super().search_messages(query, user_email=user_email, limit=limit)
+        words, prefix = parse_query(query)
+        terms = [f'"{word}"' for word in words] + ([f'"{prefix}"*'] if prefix else [])
+        if not terms:
+            return []
+        match = ' '.join(terms)
+        if user_email:
+            # bm25() costs far more than the match itself on common words, so
+            # match the user's few messages here and rank only those
+            rows = self._conn().execute(
+                'SELECT doc FROM messages WHERE user_email = ? AND rowid IN '
+                '(SELECT rowid FROM message_search WHERE message_search MATCH ?)',
+                (user_email, match))
+            return _rank_messages((json_codec.loads(doc) for (doc,) in rows), query, limit)
+        # Rank and cut inside the FTS table, so only the hits returned are
+        # looked up in messages
+        sql = ('SELECT m.doc, -hit.rank FROM (SELECT rowid, rank FROM message_search '
+               'WHERE message_search MATCH ? ORDER BY rank{}) AS hit '
+               'JOIN messages m ON m.rowid = hit.rowid ORDER BY hit.rank')
+        params = [match]
+        if limit:
+            params.append(limit)
+        sql = sql.format(' LIMIT ?' if limit else '')
+        return [(json_codec.loads(doc), score) for doc, score in self._conn().execute(sql, params)]
@@ -0,0 +1,94 @@
+"""Reply email outbox (email_queue) delivered by the worker to a stub SMTP
+server, with the SQLite outbox used while MongoDB is unavailable.
+
+    python -m pytest test_email_queue.py
+"""
+import threading
+import pytest
+import email_queue
+import email_utils
+import models
+from config import Config
+from email_queue import EmailOutbox, DEAD, RETRYING, SENT
+
+mongomock = pytest.importorskip('mongomock')
+
+
+@pytest.fixture
+def outbox(monkeypatch, tmp_path, smtp_server):
+    """An empty SQLite outbox whose worker sends to ``smtp_server``"""
+    monkeypatch.setattr(models, 'USE_MONGODB', False)
+    monkeypatch.setattr(email_queue, 'OUTBOX_DB_FILE', str(tmp_path / 'outbox.db'))
+    monkeypatch.setattr(email_queue, '_local', threading.local())
+    monkeypatch.setattr(email_queue, 'DATA_DIR', str(tmp_path))
+    mailer = email_utils.SMTPMailer('127.0.0.1', smtp_server.port, use_tls=False, timeout=5)
+    monkeypatch.setattr(email_utils, '_mailer', mailer)
+    monkeypatch.setattr(Config, 'EMAIL_MAX_ATTEMPTS', 2)
+    monkeypatch.setattr(Config, 'EMAIL_RETRY_BASE_SECONDS', 0)
+    yield smtp_server
+    mailer.close()
+    email_queue._local.conn.close()
+
+
+def queue(delivery_id):
+    return email_queue.queue_admin_reply_email('m1', 'user@x.org', 'User', 'Solar panels',
+                                               'Installed next week', delivery_id=delivery_id)
+
+
+def status(delivery_id):
+    return EmailOutbox.get(delivery_id)['status']
+
+
+def test_queued_email_is_sent(outbox):
+    queue('d1')
+    assert email_queue._work_once() == 1
+    delivery = EmailOutbox.get('d1')
+    assert delivery['status'] == SENT and delivery['attempts'] == 1 and delivery['sent_at']
+    assert len(outbox.messages) == 1 and b'Installed next week' in outbox.messages[0]
+    assert EmailOutbox.depth() == 0
+    assert email_queue._work_once() == 0
+
+
+def test_transient_failure_is_retried(outbox):
+    outbox.fail('MAIL', '451 Try again later')
+    queue('d1')
+    email_queue._work_once()
+    delivery = EmailOutbox.get('d1')
+    assert delivery['status'] == RETRYING and '451' in delivery['last_error']
+    assert outbox.messages == []
+
+    assert email_queue._work_once() == 1
+    assert status('d1') == SENT and EmailOutbox.get('d1')['attempts'] == 2
+    assert len(outbox.messages) == 1
+
+
+def test_dead_after_max_attempts(outbox):
+    outbox.fail('RCPT', '450 Mailbox busy', '450 Mailbox busy')
+    queue('d1')
+    email_queue._work_once()
+    assert status('d1') == RETRYING
+    email_queue._work_once()
+    assert status('d1') == DEAD
+    assert email_queue._work_once() == 0
+    assert outbox.messages == [] and EmailOutbox.depth() == 0
+
+
+def test_deliveries_are_found_after_moving_to_mongodb(outbox, monkeypatch):
+    outbox.fail('RCPT', '550 No such user', '550 No such user')
+    queue('dead')
+    email_queue._work_once()
+    email_queue._work_once()
+    queue('sent')
+    email_queue._work_once()
+    queue('queued')
+    assert [status(d) for d in ('dead', 'sent', 'queued')] == [DEAD, SENT, 'queued']
+
+    # MongoDB is back
+    monkeypatch.setattr(models, 'db', mongomock.MongoClient()['outbox'])
+    monkeypatch.setattr(models, 'USE_MONGODB', True)
+    email_queue._move_outbox_to_mongodb(True)
+    assert [status(d) for d in ('dead', 'sent', 'queued')] == [DEAD, SENT, 'queued']
+    assert email_queue._sqlite().execute('SELECT COUNT(*) FROM email_outbox').fetchone()[0] == 0
+
+    assert email_queue._work_once() == 1
+    assert status('queued') == SENT and len(outbox.messages) == 2
@@ -0,0 +1,63 @@
+"""Pooled SMTP sending (email_utils.SMTPMailer) against a stub server.
+
+    python -m pytest test_email_utils.py
+"""
+import smtplib
+from email_utils import SMTPMailer, build_admin_reply_email
+
+
+def mailer_for(server, **kwargs):
+    return SMTPMailer('127.0.0.1', server.port, use_tls=False, timeout=5, **kwargs)
+
+
+def emails(count):
+    return [build_admin_reply_email(f'user{i}@x.org', 'User', f'Subject {i}', 'Reply')
+            for i in range(count)]
+
+
+def test_send_many_reuses_one_session(smtp_server):
+    mailer = mailer_for(smtp_server)
+    assert mailer.send_many(emails(3)) == [None] * 3
+    assert mailer.send_many(emails(2)) == [None] * 2
+    assert len(smtp_server.messages) == 5
+    assert smtp_server.connections == 1
+    mailer.close()
+
+
+def test_max_messages_is_checked_per_message(smtp_server):
+    mailer = mailer_for(smtp_server, max_messages=2)
+    assert mailer.send_many(emails(5)) == [None] * 5
+    assert len(smtp_server.messages) == 5
+    assert smtp_server.connections == 3
+    mailer.close()
+
+
+def test_dropped_before_data_is_retried_on_a_fresh_session(smtp_server):
+    smtp_server.fail('MAIL', 'drop')
+    mailer = mailer_for(smtp_server)
+    assert mailer.send_many(emails(2)) == [None, None]
+    assert len(smtp_server.messages) == 2
+    assert smtp_server.connections == 2
+    mailer.close()
+
+
+def test_dropped_after_data_is_not_retried(smtp_server):
+    # Accepted, but the connection dropped before the reply came back
+    smtp_server.fail('END', 'drop')
+    mailer = mailer_for(smtp_server)
+    first, second = mailer.send_many(emails(2))
+    assert isinstance(first, smtplib.SMTPServerDisconnected)
+    assert second is None
+    assert len(smtp_server.messages) == 2
+    assert b'Subject 0' in smtp_server.messages[0] and b'Subject 1' in smtp_server.messages[1]
+    mailer.close()
+
+
+def test_refused_message_keeps_the_session(smtp_server):
+    smtp_server.fail('RCPT', '550 No such user')
+    mailer = mailer_for(smtp_server)
+    first, second = mailer.send_many(emails(2))
+    assert isinstance(first, smtplib.SMTPRecipientsRefused)
+    assert second is None
+    assert smtp_server.connections == 1
+    mailer.close()
@@ -0,0 +1,90 @@
+"""Log-structured JsonCollection (file_store): replay after a crash and
+compaction.
+
+    python -m pytest test_file_store.py
+"""
+import os
+import json
+import pytest
+from file_store import JsonCollection
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return str(tmp_path / 'messages.json'), str(tmp_path / 'messages.log')
+
+
+def open_collection(paths, compact_every=1000):
+    snapshot, log = paths
+    return JsonCollection(snapshot, indexes=('status',), log_path=log,
+                          compact_every=compact_every, revisions=True)
+
+
+def state(collection):
+    docs = sorted(collection.all(), key=lambda doc: doc['_id'])
+    return docs, collection.revision, [doc['_id'] for doc in collection.changes(0)]
+
+
+def write_some(collection):
+    collection.insert({'_id': 'a', 'status': 'unread', 'replies': []})
+    collection.insert({'_id': 'b', 'status': 'unread', 'replies': []})
+    collection.insert({'_id': 'c', 'status': 'unread', 'replies': []})
+    collection.update('a', {'status': 'replied'}, push={'replies': 'First'})
+    collection.update('a', push={'replies': 'Second'})
+    collection.delete('b')
+
+
+def test_torn_last_line_is_ignored_and_overwritten(paths):
+    collection = open_collection(paths)
+    write_some(collection)
+    expected = state(collection)
+    # A crash mid-append leaves half a record at the end of the log
+    with open(paths[1], 'ab') as f:
+        f.write(b'{"op":"update","_id":"c","set":{"status":"re')
+
+    reopened = open_collection(paths)
+    assert state(reopened) == expected
+    reopened.update('c', {'status': 'read'})
+
+    after = open_collection(paths)
+    assert after.get('c')['status'] == 'read'
+    assert after.revision == expected[1] + 1
+    # The torn tail was cut off before the append, not left in front of it
+    with open(paths[1], 'rb') as f:
+        assert [json.loads(line)['seq'] for line in f] == list(range(1, 8))
+
+
+def test_compaction_keeps_the_state(paths):
+    collection = open_collection(paths)
+    write_some(collection)
+    expected = state(collection)
+
+    collection.compact()
+    assert os.path.getsize(paths[1]) == 0
+    assert state(collection) == expected
+    assert state(open_collection(paths)) == expected
+    assert collection.is_deleted('b') and open_collection(paths).is_deleted('b')
+
+
+def test_compaction_every_n_records_matches_the_plain_log(tmp_path):
+    plain = open_collection((str(tmp_path / 'plain.json'), str(tmp_path / 'plain.log')))
+    compacted = open_collection((str(tmp_path / 'compacted.json'),
+                                 str(tmp_path / 'compacted.log')), compact_every=2)
+    write_some(plain)
+    write_some(compacted)
+    assert state(compacted) == state(plain)
+    assert state(open_collection((str(tmp_path / 'compacted.json'),
+                                  str(tmp_path / 'compacted.log')))) == state(plain)
+
+
+def test_crash_between_snapshot_and_truncation_applies_nothing_twice(paths):
+    collection = open_collection(paths)
+    write_some(collection)
+    expected = state(collection)
+    # compact() wrote the snapshot but died before truncating the log
+    collection._save()
+    assert os.path.getsize(paths[1]) > 0
+
+    reopened = open_collection(paths)
+    assert state(reopened) == expected
+    assert reopened.get('a')['replies'] == ['First', 'Second']
@@ -0,0 +1,50 @@
+"""Dashboard validation (models.parse_dashboard) and the campus series
+the green score reads from it.
+
+    python -m pytest test_greenscore.py
+"""
+import math
+import pytest
+import greenscore
+from models import parse_dashboard
+
+POINTS = [{'week': 'Week 1', 'current': 120, 'previous': 100},
+          {'week': 'Week 2', 'current': 130.5, 'previous': 110}]
+
+
+def test_parse_dashboard_keeps_the_datasets():
+    dashboard = parse_dashboard({'energyData': POINTS, 'wasteData': [{'week': 'Week 1'}],
+                                 'extra': 'dropped'})
+    assert dashboard == {'energyData': POINTS, 'waterData': [],
+                         'wasteData': [{'week': 'Week 1'}]}
+
+
+@pytest.mark.parametrize('raw, error', [
+    ([], 'dashboard must be an object'),
+    ({'energyData': {'current': 1}}, 'energyData must be a list'),
+    ({'waterData': [POINTS[0], 'Week 2']}, r'waterData\[1\] must be an object'),
+    ({'energyData': [{'current': 'lots'}]}, r'energyData\[0\].current must be a finite number'),
+    ({'wasteData': [{'current': 1, 'previous': None}]}, r'wasteData\[0\].previous'),
+    ({'energyData': [{'current': True}]}, r'energyData\[0\].current'),
+    ({'energyData': [{'current': math.inf}]}, r'energyData\[0\].current'),
+])
+def test_parse_dashboard_rejects_non_numeric_points(raw, error):
+    with pytest.raises(ValueError, match=error):
+        parse_dashboard(raw)
+
+
+def test_dashboard_series_skips_bad_points():
+    # As stored before PUT /api/dashboard validated its body
+    dashboard = {'energyData': POINTS + ['Week 3', {'current': 'n/a', 'previous': 1}],
+                 'waterData': [{'current': None}], 'wasteData': None}
+    series = greenscore.dashboard_series(dashboard)
+    assert set(series) == {'energy'}
+    current, baseline = series['energy']
+    assert current.tolist() == [[120.0, 130.5]]
+    assert baseline.tolist() == [[100.0, 110.0]]
+    assert greenscore.score_entities(['campus'], series)[0]['name'] == 'campus'
+
+
+def test_dashboard_series_defaults_missing_values_to_zero():
+    current, baseline = greenscore.dashboard_series({'energyData': [{'current': 5}]})['energy']
+    assert current.tolist() == [[5.0]] and baseline.tolist() == [[0.0]]
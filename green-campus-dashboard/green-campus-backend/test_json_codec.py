@@ -0,0 +1,120 @@
+"""JSON encoding of responses (json_codec) and the per-message fragments
+they are assembled from (response_cache.FragmentCache).
+
+    python -m pytest test_json_codec.py
+"""
+import json
+from datetime import date, datetime, timezone
+from bson import ObjectId
+import pytest
+import json_codec
+from json_codec import Array, dumps, dumps_object
+from response_cache import FragmentCache
+from storage import MemoryBackend, SQLiteBackend
+
+ID = ObjectId('65a1b2c3d4e5f6a7b8c9d0e1')
+
+DOC = {
+    '_id': ID,
+    'subject': 'Solar café',
+    'created_at': datetime(2024, 1, 1, 9, 30, 15, 123456),
+    'day': date(2024, 1, 2),
+    'sent_at': datetime(2024, 1, 1, 9, 30, tzinfo=timezone.utc),
+    'replies': [{'at': datetime(2024, 1, 3, 8, 0), 'by': ID}],
+    'points': [1, 2.5, None, True]
+}
+
+
+def stdlib_dumps(obj):
+    """What the stdlib encoder produces for the same value"""
+    def default(value):
+        return value.isoformat() if isinstance(value, date) else str(value)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False,
+                      default=default).encode('utf-8')
+
+
+def test_dumps_matches_stdlib_json():
+    assert dumps(DOC) == stdlib_dumps(DOC)
+    assert json_codec.loads(dumps(DOC))['_id'] == str(ID)
+
+
+@pytest.mark.parametrize('fragments', [[], [DOC], [DOC, {'_id': 'x'}, DOC]])
+def test_dumps_object_splices_fragments_like_a_list(fragments):
+    fields = {'total': len(fragments), 'since': DOC['created_at'], 'next': None}
+    body = dumps_object({'messages': Array([dumps(doc) for doc in fragments]), **fields})
+    assert body == stdlib_dumps({'messages': fragments, **fields})
+
+
+def test_dumps_object_without_arrays():
+    assert dumps_object({}) == b'{}'
+    assert dumps_object({'a': DOC}) == stdlib_dumps({'a': DOC})
+
+
+def message(subject):
+    return {'_id': str(ObjectId()), 'user_name': 'Sender', 'user_email': 'a@x.org',
+            'subject': subject, 'message': 'Body', 'status': 'unread',
+            'created_at': datetime(2024, 1, 1, 9, 0), 'replies': []}
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path):
+    backend = MemoryBackend() if request.param == 'memory' else SQLiteBackend(str(tmp_path / 'db'))
+    yield backend
+    backend.close()
+
+
+def fragments_of(cache, backend, message_ids):
+    found = backend.get_messages(message_ids)
+    return [json.loads(fragment) for fragment in cache.get_many([found[i] for i in message_ids])]
+
+
+def test_fragments_follow_writes(backend):
+    cache = FragmentCache(dumps)
+    first, second = message('First'), message('Second')
+    backend.insert_message(first)
+    backend.insert_message(second)
+    ids = [first['_id'], second['_id']]
+    assert [f['status'] for f in fragments_of(cache, backend, ids)] == ['unread', 'unread']
+    assert len(cache) == 2
+
+    backend.add_reply(first['_id'], {'sender': 'Admin', 'text': 'Thanks', 'timestamp': datetime.now()})
+    backend.set_status(second['_id'], 'read')
+    replied, read = fragments_of(cache, backend, ids)
+    assert replied['status'] == 'replied' and [r['text'] for r in replied['replies']] == ['Thanks']
+    assert read['status'] == 'read'
+    # The stale fragments were replaced, not kept alongside
+    assert len(cache) == 2
+
+    backend.delete_message(first['_id'])
+    cache.discard([first['_id']])
+    assert len(cache) == 1
+
+
+def test_cached_fragment_is_reused_for_the_same_rev():
+    calls = []
+
+    def encode(doc):
+        calls.append(doc['_id'])
+        return dumps(doc)
+
+    cache = FragmentCache(encode)
+    doc = {'_id': 'a', 'rev': 1, 'subject': 'First'}
+    assert cache.get_many([doc]) == cache.get_many([doc]) == [dumps(doc)]
+    assert calls == ['a']
+    assert cache.get_many([dict(doc, rev=2, subject='Edited')]) == [dumps(dict(doc, rev=2, subject='Edited'))]
+    assert calls == ['a', 'a']
+
+
+def test_docs_without_rev_are_never_cached():
+    cache = FragmentCache(dumps)
+    cache.get_many([{'_id': 'a', 'subject': 'First'}])
+    assert len(cache) == 0
+    assert cache.get_many([{'_id': 'a', 'subject': 'Edited'}]) == [dumps({'_id': 'a', 'subject': 'Edited'})]
+
+
+def test_oldest_fragments_are_evicted():
+    cache = FragmentCache(dumps, size=2)
+    cache.get_many([{'_id': doc_id, 'rev': 1} for doc_id in 'abc'])
+    assert len(cache) == 2
+    cache.clear()
+    assert len(cache) == 0
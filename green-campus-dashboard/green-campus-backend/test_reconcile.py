@@ -0,0 +1,138 @@
+"""Replay of writes made on the local store while MongoDB was down
+(models.reconcile_journal), against mongomock.
+
+    python -m pytest test_reconcile.py
+"""
+from datetime import datetime, timedelta
+from bson import ObjectId
+import pytest
+import models
+from config import Config
+from file_store import JsonCollection
+from storage import MemoryBackend, MongoBackend
+
+mongomock = pytest.importorskip('mongomock')
+
+
+@pytest.fixture
+def database(monkeypatch, tmp_path):
+    """MongoDB (mongomock) while it is unreachable: the models write to a
+    memory store and journal those writes for reconcile_journal"""
+    database = mongomock.MongoClient()['reconcile']
+    models.ensure_indexes(database)
+    local = MemoryBackend()
+    monkeypatch.setattr(models, 'local_storage', local)
+    monkeypatch.setattr(models, '_timed_local_storage', local)
+    monkeypatch.setattr(models, 'journal_store', JsonCollection(None))
+    monkeypatch.setattr(models, 'RECONCILE_LOCK_FILE', str(tmp_path / 'reconcile.lock'))
+    monkeypatch.setattr(models, 'USE_MONGODB', False)
+    monkeypatch.setattr(Config, 'STORAGE_BACKEND', 'mongodb')
+    monkeypatch.setattr(Config, 'MONGODB_URI', 'mongodb://localhost:27017/green_campus')
+    monkeypatch.setattr(Config, 'MESSAGE_BATCH_MAX', 1)
+    return database
+
+
+def seed(mongo, subject):
+    """A message in MongoDB that the local store also holds a copy of"""
+    message = {
+        '_id': str(ObjectId()),
+        'user_name': 'Sender',
+        'user_email': 'a@x.org',
+        'subject': subject,
+        'message': 'Body',
+        'status': 'unread',
+        'created_at': datetime(2024, 1, 1, 9, 0),
+        'replies': []
+    }
+    assert mongo.insert_message(message)
+    assert models.local_storage.insert_message(message)
+    return message['_id']
+
+
+def reply(text):
+    return {'sender': 'Admin', 'text': text, 'timestamp': datetime.now(), 'delivery_id': None}
+
+
+def texts(message):
+    return [r['text'] for r in message['replies']]
+
+
+def test_offline_changes_are_replayed(database):
+    mongo = MongoBackend(database)
+    replied, deleted = seed(mongo, 'Replied'), seed(mongo, 'Deleted')
+    created = models.Message.create_message('Sender', 'a@x.org', 'Offline', 'Body')
+    models.Message.mark_as_read(created)
+    models.Message.add_reply(replied, 'Offline reply')
+    models.Message.mark_as_read(replied)
+    models.Message.delete_message(deleted)
+
+    assert models.reconcile_journal(database) == 5
+    assert mongo.get_message(created)['status'] == 'read'
+    assert mongo.get_message(replied)['status'] == 'read'
+    assert texts(mongo.get_message(replied)) == ['Offline reply']
+    assert mongo.get_message(deleted) is None
+    assert models.journal_store.all() == []
+
+
+def test_stale_replay_keeps_newer_mongodb_state(database):
+    mongo = MongoBackend(database)
+    replied, marked, deleted = seed(mongo, 'Replied'), seed(mongo, 'Marked'), seed(mongo, 'Deleted')
+    # Written to MongoDB by other processes while this one could not reach it
+    mongo.add_reply(replied, reply('Online reply'))
+    mongo.add_reply(marked, reply('Online reply'))
+    mongo.delete_message(deleted)
+    # ... while this one wrote to its stale local copies
+    models.Message.add_reply(replied, 'Offline reply')
+    models.Message.mark_as_read(marked)
+    models.Message.add_reply(deleted, 'Offline reply')
+    models.Message.mark_as_read(deleted)
+
+    models.reconcile_journal(database)
+    assert texts(mongo.get_message(replied)) == ['Online reply', 'Offline reply']
+    # Marked read over 'unread', but MongoDB has replied since
+    assert mongo.get_message(marked)['status'] == 'replied'
+    assert texts(mongo.get_message(marked)) == ['Online reply']
+    # Neither restored by the reply nor by the status change
+    assert mongo.get_message(deleted) is None
+    assert mongo.insert_message(dict(models.local_storage.get_message(deleted))) is False
+
+
+def test_replaying_an_entry_twice_changes_nothing(database):
+    mongo = MongoBackend(database)
+    replied = seed(mongo, 'Replied')
+    created = models.Message.create_message('Sender', 'a@x.org', 'Offline', 'Body')
+    models.Message.add_reply(replied, 'Offline reply')
+    models.Message.mark_as_read(replied)
+    entries = models.journal_store.all()
+
+    models.reconcile_journal(database)
+    for entry in entries:
+        models._replay(database, entry)
+    assert texts(mongo.get_message(replied)) == ['Offline reply']
+    assert mongo.get_message(replied)['status'] == 'read'
+    assert len(mongo.query_messages()) == 2 and mongo.get_message(created)
+
+
+def test_offline_dashboard_never_replaces_a_newer_one(database):
+    mongo = MongoBackend(database)
+    models.Dashboard.save_dashboard({'energyData': [{'month': 'Jan', 'current': 1}]})
+    mongo.save_dashboard({'energyData': [{'month': 'Jan', 'current': 2}],
+                          'updated_at': datetime.now() + timedelta(seconds=1)})
+
+    models.reconcile_journal(database)
+    assert mongo.get_dashboard()['energyData'] == [{'month': 'Jan', 'current': 2}]
+
+
+def test_offline_dashboard_replaces_an_older_one(database):
+    mongo = MongoBackend(database)
+    mongo.save_dashboard({'energyData': [{'month': 'Jan', 'current': 2}],
+                          'updated_at': datetime.now() - timedelta(seconds=1)})
+    models.Dashboard.save_dashboard({'energyData': [{'month': 'Jan', 'current': 1}]})
+    entries = models.journal_store.all()
+
+    models.reconcile_journal(database)
+    assert mongo.get_dashboard()['energyData'] == [{'month': 'Jan', 'current': 1}]
+    # Replaying it again is a no-op
+    for entry in entries:
+        models._replay(database, entry)
+    assert mongo.get_dashboard()['energyData'] == [{'month': 'Jan', 'current': 1}]
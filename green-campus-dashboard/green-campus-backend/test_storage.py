@@ -0,0 +1,338 @@
+"""Contract tests run against every StorageBackend implementation.
+
+    python -m pytest test_storage.py
+
+MongoBackend runs on mongomock when it is installed and is skipped
+otherwise. Set MONGODB_TEST_URI to run it on a MongoDB server instead
+(a scratch database is created and dropped), which also runs the search
+tests mongomock cannot ($text).
+"""
+import os
+from datetime import datetime, timedelta
+from bson import ObjectId
+import pytest
+from pymongo import MongoClient
+from models import ensure_indexes
+from storage import FileBackend, MemoryBackend, SQLiteBackend, MongoBackend
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+START = datetime(2024, 1, 1, 9, 0)
+MONGODB_TEST_URI = os.getenv('MONGODB_TEST_URI', '')
+
+
+def make_backend(name, tmp_path):
+    if name == 'memory':
+        return MemoryBackend()
+    if name == 'file':
+        return FileBackend(str(tmp_path / 'users.json'), str(tmp_path / 'messages.json'),
+                           str(tmp_path / 'messages.log'), str(tmp_path / 'dashboard.json'),
+                           compact_every=3)
+    if name.startswith('sqlite'):
+        backend = SQLiteBackend(str(tmp_path / 'green_campus.db'))
+        if name == 'sqlite-scan':
+            # As on an SQLite build without FTS5
+            backend.full_text = False
+        return backend
+    if MONGODB_TEST_URI:
+        client = MongoClient(MONGODB_TEST_URI, serverSelectionTimeoutMS=5000)
+        database = client[f'storage_contract_{ObjectId()}']
+    elif mongomock is not None:
+        database = mongomock.MongoClient()['storage_contract']
+    else:
+        pytest.skip('mongomock is not installed and MONGODB_TEST_URI is not set')
+    ensure_indexes(database)
+    # No writes are in flight here, so changes need no settle window
+    return MongoBackend(database, settle_seconds=0)
+
+
+def close_backend(backend):
+    backend.close()
+    if isinstance(backend, MongoBackend) and MONGODB_TEST_URI:
+        backend.db.client.drop_database(backend.db.name)
+
+
+@pytest.fixture(params=['memory', 'file', 'sqlite', 'mongodb'])
+def backend(request, tmp_path):
+    backend = make_backend(request.param, tmp_path)
+    yield backend
+    close_backend(backend)
+
+
+@pytest.fixture(params=['memory', 'file', 'sqlite', 'sqlite-scan', 'mongodb'])
+def search_backend(request, tmp_path):
+    """``backend`` for each search implementation (SQLite with and without
+    FTS5); MongoDB's $text needs a server"""
+    if request.param == 'mongodb' and not MONGODB_TEST_URI:
+        pytest.skip('mongomock does not implement $text; set MONGODB_TEST_URI')
+    backend = make_backend(request.param, tmp_path)
+    yield backend
+    close_backend(backend)
+
+
+def message(i, user_email='a@x.org', status='unread'):
+    return {
+        'user_name': 'Sender',
+        'user_email': user_email,
+        'subject': f'Subject {i}',
+        'message': f'Body {i}',
+        'status': status,
+        'created_at': START + timedelta(minutes=i),
+        'replies': []
+    }
+
+
+def timestamp(value):
+    """created_at as the backend returns it (datetime or ISO string)"""
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+
+def subjects(messages):
+    return [m['subject'] for m in messages]
+
+
+def test_create_and_get(backend):
+    message_id = backend.create_message(message(1))
+    found = backend.get_message(message_id)
+    assert found['_id'] == message_id
+    assert found['subject'] == 'Subject 1'
+    assert found['status'] == 'unread'
+    assert timestamp(found['created_at']) == START + timedelta(minutes=1)
+    assert backend.get_message(str(ObjectId())) is None
+
+
+def test_create_messages_returns_ids_in_order(backend):
+    ids = backend.create_messages([message(i) for i in range(3)])
+    assert len(set(ids)) == 3
+    assert [backend.get_message(message_id)['subject'] for message_id in ids] == \
+        ['Subject 0', 'Subject 1', 'Subject 2']
+    assert set(backend.get_messages(ids + [str(ObjectId())])) == set(ids)
+
+
+def test_query_is_newest_first_and_filters(backend):
+    backend.create_messages([message(1), message(2, user_email='b@x.org'),
+                             message(3, status='read'), message(4, user_email='b@x.org')])
+    assert subjects(backend.query_messages()) == \
+        ['Subject 4', 'Subject 3', 'Subject 2', 'Subject 1']
+    assert subjects(backend.query_messages(user_email='b@x.org')) == ['Subject 4', 'Subject 2']
+    assert subjects(backend.query_messages(status='read')) == ['Subject 3']
+    assert subjects(backend.query_messages(since=START + timedelta(minutes=2),
+                                           until=START + timedelta(minutes=4))) == \
+        ['Subject 3', 'Subject 2']
+
+
+def test_keyset_pagination(backend):
+    backend.create_messages([message(i) for i in range(7)])
+    seen = []
+    before = None
+    while True:
+        page = backend.query_messages(limit=3, before=before)
+        seen.extend(subjects(page))
+        if len(page) < 3:
+            break
+        last = page[-1]
+        before = (timestamp(last['created_at']).isoformat(), last['_id'])
+    assert seen == [f'Subject {i}' for i in reversed(range(7))]
+
+
+def test_replies_mark_message_replied(backend):
+    message_id = backend.create_message(message(1))
+    reply = {'sender': 'Admin', 'text': 'Thanks', 'timestamp': START + timedelta(hours=1)}
+    assert backend.add_reply(message_id, reply)
+    assert backend.add_reply(message_id, dict(reply, text='Again'))
+    found = backend.get_message(message_id)
+    assert found['status'] == 'replied'
+    assert [r['text'] for r in found['replies']] == ['Thanks', 'Again']
+    assert backend.add_reply(str(ObjectId()), reply) is False
+
+
+def test_bulk_replies(backend):
+    ids = backend.create_messages([message(1), message(2)])
+    missing = str(ObjectId())
+    reply = {'sender': 'Admin', 'text': 'Bulk', 'timestamp': START}
+    assert backend.add_replies([(ids[0], reply), (missing, reply), (ids[1], reply)]) == \
+        [True, False, True]
+    assert all(backend.get_message(message_id)['status'] == 'replied' for message_id in ids)
+
+
+def test_status_sets(backend):
+    ids = backend.create_messages([message(1), message(2), message(3)])
+    assert backend.set_status(ids[0], 'read')
+    assert backend.set_status(str(ObjectId()), 'read') is False
+    assert backend.set_statuses([ids[1], str(ObjectId()), ids[2]], 'read') == [True, False, True]
+    assert {m['status'] for m in backend.query_messages()} == {'read'}
+
+
+def test_delete_leaves_tombstone(backend):
+    ids = backend.create_messages([message(1, user_email='b@x.org'), message(2), message(3)])
+    since = backend.message_revision()
+    assert backend.delete_message(ids[0])
+    assert backend.delete_message(ids[0]) is False
+    assert backend.get_message(ids[0]) is None
+    assert backend.delete_messages([ids[1], ids[1], str(ObjectId())]) == [True, False, False]
+    assert subjects(backend.query_messages()) == ['Subject 3']
+
+    tombstones = [c for c in backend.message_changes(since) if c.get('deleted')]
+    assert [(t['_id'], t['user_email']) for t in tombstones] == \
+        [(ids[0], 'b@x.org'), (ids[1], 'a@x.org')]
+    assert tombstones[0]['rev'] < tombstones[1]['rev'] <= backend.message_revision()
+
+
+def test_insert_message_never_replaces_or_restores(backend):
+    message_id = str(ObjectId())
+    assert backend.insert_message(dict(message(1), _id=message_id))
+    assert backend.get_message(message_id)['subject'] == 'Subject 1'
+    assert backend.insert_message(dict(message(1), _id=message_id, subject='Stale')) is False
+    assert backend.get_message(message_id)['subject'] == 'Subject 1'
+
+    backend.delete_message(message_id)
+    since = backend.message_revision()
+    assert backend.insert_message(dict(message(1), _id=message_id)) is False
+    assert backend.get_message(message_id) is None
+    assert backend.message_changes(since) == []
+
+
+def test_set_status_compare_and_set(backend):
+    message_id = backend.create_message(message(1))
+    assert backend.set_status(message_id, 'read', expected='replied') is False
+    assert backend.get_message(message_id)['status'] == 'unread'
+    assert backend.set_status(message_id, 'read', expected='unread')
+    assert backend.get_message(message_id)['status'] == 'read'
+    assert backend.set_status(str(ObjectId()), 'read', expected='unread') is False
+
+
+def test_every_write_stamps_a_higher_revision(backend):
+    assert backend.message_revision() == 0
+    message_id = backend.create_message(message(1))
+    revisions = [backend.get_message(message_id)['rev']]
+    backend.set_status(message_id, 'read')
+    revisions.append(backend.get_message(message_id)['rev'])
+    backend.add_reply(message_id, {'sender': 'Admin', 'text': 'Hi', 'timestamp': START})
+    revisions.append(backend.get_message(message_id)['rev'])
+    assert revisions == sorted(set(revisions))
+    assert backend.message_revision() == revisions[-1]
+
+
+def test_message_changes(backend):
+    ids = backend.create_messages([message(1), message(2, user_email='b@x.org'), message(3)])
+    since = backend.message_revision()
+    assert backend.message_changes(since) == []
+
+    backend.set_status(ids[0], 'read')
+    backend.add_reply(ids[1], {'sender': 'Admin', 'text': 'Hi', 'timestamp': START})
+    backend.delete_message(ids[2])
+    changes = backend.message_changes(since)
+    assert [(c['_id'], c.get('deleted', False)) for c in changes] == \
+        [(ids[0], False), (ids[1], False), (ids[2], True)]
+    revisions = [c['rev'] for c in changes]
+    assert revisions == sorted(revisions) and revisions[0] > since
+    # Changed messages come back in their current state
+    assert changes[1]['status'] == 'replied' and changes[1]['replies'][0]['text'] == 'Hi'
+
+    assert [c['_id'] for c in backend.message_changes(since, user_email='b@x.org')] == [ids[1]]
+    assert [c['_id'] for c in backend.message_changes(since, limit=2)] == ids[:2]
+    assert [c['_id'] for c in backend.message_changes(revisions[1])] == [ids[2]]
+    # A message written twice is listed once, at its latest revision
+    assert len(backend.message_changes(0)) == 3
+
+
+def test_users(backend):
+    user_id = backend.create_user({'email': 'u@x.org', 'password': 'hash', 'role': 'user'})
+    assert user_id
+    assert backend.create_user({'email': 'u@x.org', 'password': 'other', 'role': 'user'}) is None
+    assert backend.find_user('u@x.org')['password'] == 'hash'
+    assert backend.update_user('u@x.org', {'password': 'rehashed'})
+    assert backend.find_user('u@x.org')['password'] == 'rehashed'
+    assert backend.update_user('missing@x.org', {'password': 'x'}) is False
+
+
+def test_dashboard(backend):
+    assert backend.get_dashboard() is None
+    backend.save_dashboard({'energyData': [{'month': 'Jan', 'usage': 1}]})
+    assert backend.get_dashboard()['energyData'] == [{'month': 'Jan', 'usage': 1}]
+
+
+def found(backend, query, **kwargs):
+    return sorted(m['subject'] for m, _ in backend.search_messages(query, **kwargs))
+
+
+def seed_search(backend):
+    ids = backend.create_messages([
+        dict(message(1), subject='Solar panels', message='The roof needs new panels'),
+        dict(message(2, user_email='b@x.org'), subject='Water leak',
+             message='A leak near the solar roof'),
+        dict(message(3), subject='Recycling', message='More bins please')
+    ])
+    backend.add_reply(ids[2], {'sender': 'Admin', 'text': 'Bins ordered for the roof garden',
+                               'timestamp': START})
+    return ids
+
+
+def test_search_requires_every_word(search_backend):
+    seed_search(search_backend)
+    assert found(search_backend, 'roof ') == ['Recycling', 'Solar panels', 'Water leak']
+    assert found(search_backend, 'solar roof ') == ['Solar panels', 'Water leak']
+    # Words may come from the subject, the body or a reply
+    assert found(search_backend, 'recycling garden ') == ['Recycling']
+    assert found(search_backend, 'solar garden ') == []
+    assert found(search_backend, 'solar roof', limit=1) in (['Solar panels'], ['Water leak'])
+    results = search_backend.search_messages('solar roof ')
+    assert all(score > 0 for _, score in results)
+
+
+def test_search_matches_a_final_prefix(search_backend):
+    if isinstance(search_backend, MongoBackend):
+        pytest.skip('the MongoDB text index matches stemmed words, not prefixes')
+    seed_search(search_backend)
+    assert found(search_backend, 'pan') == ['Solar panels']
+    assert found(search_backend, 'roof gard') == ['Recycling']
+    # A trailing space completes the word
+    assert found(search_backend, 'pan ') == []
+    assert found(search_backend, 'sol roof') == []
+
+
+def test_search_scoped_to_a_user(search_backend):
+    seed_search(search_backend)
+    assert found(search_backend, 'solar ', user_email='a@x.org') == ['Solar panels']
+    assert found(search_backend, 'solar ', user_email='b@x.org') == ['Water leak']
+    assert found(search_backend, 'solar ', user_email='c@x.org') == []
+
+
+def test_search_drops_deleted_messages(search_backend):
+    ids = seed_search(search_backend)
+    search_backend.delete_message(ids[0])
+    assert found(search_backend, 'solar ') == ['Water leak']
+    search_backend.delete_messages([ids[1], ids[2]])
+    assert found(search_backend, 'roof ') == []
+
+
+class FindRecorder:
+    """Stands in for a collection, recording the queries it is given"""
+
+    def __init__(self):
+        self.queries = []
+
+    def find(self, query, projection=None):
+        self.queries.append(query)
+        return self
+
+    def sort(self, keys):
+        return self
+
+    def limit(self, count):
+        return self
+
+    def __iter__(self):
+        return iter(())
+
+
+def test_mongodb_search_quotes_every_word():
+    """Unquoted, $text matches any of the words; quoted, all of them"""
+    messages = FindRecorder()
+    backend = MongoBackend({'messages': messages})
+    assert backend.search_messages('Solar  roof!', user_email='a@x.org', limit=5) == []
+    assert backend.search_messages('  ') == []
+    assert messages.queries == [{'$text': {'$search': '"solar" "roof"'}, 'user_email': 'a@x.org'}]
@@ -0,0 +1,82 @@
+"""Group commit (write_batcher.WriteBatcher).
+
+    python -m pytest test_write_batcher.py
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from write_batcher import WriteBatcher
+
+
+class Recorder:
+    """A flush that records its batches and doubles each item"""
+
+    def __init__(self, error=None):
+        self.batches = []
+        self.error = error
+
+    def __call__(self, items):
+        self.batches.append(list(items))
+        if self.error is not None:
+            raise self.error
+        return [item * 2 for item in items]
+
+
+def submit_all(batcher, items):
+    with ThreadPoolExecutor(len(items)) as pool:
+        futures = [pool.submit(batcher.submit, item) for item in items]
+        return [future.exception(timeout=10) or future.result() for future in futures]
+
+
+def test_full_batch_is_flushed_without_waiting_for_the_window():
+    flush = Recorder()
+    batcher = WriteBatcher(flush, max_batch=4, window=30)
+    started = time.monotonic()
+    assert submit_all(batcher, [1, 2, 3, 4]) == [2, 4, 6, 8]
+    assert time.monotonic() - started < 10
+    assert len(flush.batches) == 1 and sorted(flush.batches[0]) == [1, 2, 3, 4]
+
+
+def test_partial_batch_is_flushed_when_the_window_ends():
+    flush = Recorder()
+    batcher = WriteBatcher(flush, max_batch=100, window=0.2)
+    started = time.monotonic()
+    assert batcher.submit(5) == 10
+    assert time.monotonic() - started >= 0.2
+    assert flush.batches == [[5]]
+
+
+def test_burst_larger_than_max_batch_is_split():
+    flush = Recorder()
+    batcher = WriteBatcher(flush, max_batch=3, window=30)
+    assert submit_all(batcher, list(range(6))) == [0, 2, 4, 6, 8, 10]
+    assert sorted(len(batch) for batch in flush.batches) == [3, 3]
+
+
+def test_flush_error_reaches_every_waiter():
+    error = OSError('disk full')
+    flush = Recorder(error)
+    batcher = WriteBatcher(flush, max_batch=3, window=30)
+    assert submit_all(batcher, [1, 2, 3]) == [error] * 3
+    assert len(flush.batches) == 1
+
+    # The flushing thread survives and serves the next batch
+    flush.error = None
+    assert submit_all(batcher, [4, 5, 6]) == [8, 10, 12]
+
+
+def test_submit_blocks_until_the_batch_is_durable():
+    release = threading.Event()
+
+    def slow_flush(items):
+        release.wait(10)
+        return items
+
+    batcher = WriteBatcher(slow_flush, window=0)
+    with ThreadPoolExecutor(1) as pool:
+        future = pool.submit(batcher.submit, 'item')
+        with pytest.raises(TimeoutError):
+            future.result(timeout=0.2)
+        release.set()
+        assert future.result(timeout=10) == 'item'
@@ -0,0 +1,78 @@
+import threading
+from collections import deque
+
+
+class _Pending:
+    __slots__ = ('item', 'done', 'result', 'error')
+
+    def __init__(self, item):
+        self.item = item
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class WriteBatcher:
+    """Group commit: coalesce concurrent writes into one durable write.
+
+    ``submit(item)`` queues ``item`` and blocks until ``flush(items)`` has
+    persisted the batch containing it, then returns that item's entry of
+    the list ``flush`` returns (or raises what ``flush`` raised). A single
+    daemon thread does the flushing: it takes the first queued item,
+    gathers whatever else arrives within ``window`` seconds (up to
+    ``max_batch`` items) and flushes them together. While one batch is
+    being written the next one accumulates, so bursts are written in ever
+    larger batches and an idle writer adds at most ``window`` of latency.
+    """
+
+    def __init__(self, flush, max_batch=256, window=0.002, name='write-batcher'):
+        self.flush = flush
+        self.max_batch = max(1, max_batch)
+        self.window = window
+        self.name = name
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    @property
+    def pending(self):
+        """Items queued and not yet taken into a batch"""
+        return len(self._queue)
+
+    def submit(self, item):
+        """Queue ``item`` and wait until its batch is durable"""
+        pending = _Pending(item)
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                # (Re)started lazily, so a forked worker gets its own thread
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+            self._queue.append(pending)
+            self._cond.notify()
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            if self.window and len(self._queue) < self.max_batch:
+                self._cond.wait_for(lambda: len(self._queue) >= self.max_batch, self.window)
+            count = min(len(self._queue), self.max_batch)
+            return [self._queue.popleft() for _ in range(count)]
+
+    def _loop(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                results = self.flush([pending.item for pending in batch])
+            except Exception as e:
+                for pending in batch:
+                    pending.error = e
+                    pending.done.set()
+                continue
+            for pending, result in zip(batch, results):
+                pending.result = result
+                pending.done.set()
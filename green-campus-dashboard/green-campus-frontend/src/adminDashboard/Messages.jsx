@@ -1,19 +1,55 @@
 import React, { useState, useContext, useEffect } from "react";
 import { MessagesContext } from "../context/MessagesContext";
+import { searchMessages } from "../api/apiService";
 import "./Messages.css";
 
 const Messages = () => {
-  const { messages, loading, addReply, deleteMessage, markAsRead, fetchMessages } =
-    useContext(MessagesContext);
+  const {
+    messages,
+    loading,
+    addReply,
+    deleteMessage,
+    markAsRead,
+    markManyAsRead,
+    fetchMessages,
+    loadMoreMessages,
+    hasMoreMessages,
+  } = useContext(MessagesContext);
   const [selectedMessage, setSelectedMessage] = useState(null);
   const [replyText, setReplyText] = useState("");
   const [replying, setReplying] = useState(false);
+  const [searchQuery, setSearchQuery] = useState("");
+  // Matches of searchQuery from the server, or null when not searching
+  const [searchResults, setSearchResults] = useState(null);
 
   // Fetch messages when component mounts
   useEffect(() => {
     fetchMessages();
   }, []);
 
+  // Search as the admin types, once they pause
+  useEffect(() => {
+    if (!searchQuery.trim()) {
+      setSearchResults(null);
+      return;
+    }
+    let cancelled = false;
+    const timer = setTimeout(async () => {
+      const result = await searchMessages(searchQuery);
+      if (!cancelled && result.success) setSearchResults(result.data);
+    }, 250);
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
+  }, [searchQuery]);
+
+  // Search hits in their latest state (the inbox follows live updates)
+  const loaded = new Map(messages.map((m) => [m._id, m]));
+  const listed = searchResults
+    ? searchResults.map((m) => loaded.get(m._id) || m)
+    : messages;
+
   const handleSelectMessage = async (message) => {
     if (message.status === "unread") {
       await markAsRead(message._id);
@@ -36,6 +72,12 @@ const Messages = () => {
     }
   };
 
+  const unreadIds = messages.filter((m) => m.status === "unread").map((m) => m._id);
+
+  const handleMarkAllRead = async () => {
+    await markManyAsRead(unreadIds);
+  };
+
   const handleDelete = async (messageId) => {
     if (window.confirm("Are you sure you want to delete this message?")) {
       const success = await deleteMessage(messageId);
@@ -64,11 +106,23 @@ const Messages = () => {
         {/* Messages List */}
         <div className="messages-list">
           <h2>Messages ({messages.length})</h2>
-          {messages.length === 0 ? (
-            <p className="no-messages">No messages yet</p>
+          <input
+            className="message-search"
+            type="search"
+            value={searchQuery}
+            onChange={(e) => setSearchQuery(e.target.value)}
+            placeholder="Search messages..."
+          />
+          {unreadIds.length > 0 && (
+            <button className="mark-all-btn" onClick={handleMarkAllRead}>
+              Mark {unreadIds.length} as read
+            </button>
+          )}
+          {listed.length === 0 ? (
+            <p className="no-messages">{searchResults ? "No matching messages" : "No messages yet"}</p>
           ) : (
             <ul>
-              {messages.map((message) => (
+              {listed.map((message) => (
                 <li
                   key={message._id}
                   className={`message-item ${message.status} ${
@@ -91,6 +145,11 @@ const Messages = () => {
               ))}
             </ul>
           )}
+          {hasMoreMessages && !searchResults && (
+            <button className="load-more-btn" onClick={loadMoreMessages}>
+              Load older messages
+            </button>
+          )}
         </div>
 
         {/* Message Detail */}
@@ -7,6 +7,12 @@ export const setAuthToken = (token) => {
   } else {
     localStorage.removeItem('authToken');
   }
+  // The live update stream is authenticated with the token it opened with
+  if (eventSource) {
+    closeStream();
+    openStream();
+    notifyStream('resync', {});
+  }
 };
 
 export const getAuthToken = () => {
@@ -115,6 +121,82 @@ export const getAllMessages = async () => {
   }
 };
 
+// Fetch one page of messages, newest first. Pass the returned nextCursor
+// back as `cursor` to get the following page.
+export const getMessagesPage = async ({ limit = 50, cursor, status, userEmail } = {}) => {
+  try {
+    const params = new URLSearchParams({ limit: String(limit) });
+    if (cursor) params.set('cursor', cursor);
+    if (status) params.set('status', status);
+    if (userEmail) params.set('user_email', userEmail);
+
+    const response = await fetch(`${API_BASE_URL}/messages?${params}`, {
+      method: 'GET',
+      headers: getAuthHeaders(),
+    });
+
+    const data = await response.json();
+
+    if (response.ok) {
+      return {
+        success: true,
+        data: data.messages,
+        nextCursor: data.next_cursor,
+        syncToken: data.sync_token,
+      };
+    } else {
+      return { success: false, error: data.message };
+    }
+  } catch (error) {
+    return { success: false, error: error.message };
+  }
+};
+
+// Fetch what changed since a sync token (from getMessagesPage or a
+// previous call): changed messages, deleted ids and the next token.
+// `expired` means the token can no longer be answered; reload instead.
+export const getMessageChanges = async (syncToken) => {
+  try {
+    const params = new URLSearchParams({ since: syncToken });
+    const response = await fetch(`${API_BASE_URL}/messages/changes?${params}`, {
+      method: 'GET',
+      headers: getAuthHeaders(),
+    });
+
+    const data = await response.json();
+
+    if (response.ok) {
+      return { success: true, data };
+    } else {
+      return { success: false, expired: response.status === 410, error: data.message };
+    }
+  } catch (error) {
+    return { success: false, error: error.message };
+  }
+};
+
+// Full-text search of subjects, bodies and replies, best match first.
+// The last word may be unfinished, so this works while typing.
+export const searchMessages = async (query, limit = 20) => {
+  try {
+    const params = new URLSearchParams({ q: query, limit });
+    const response = await fetch(`${API_BASE_URL}/messages/search?${params}`, {
+      method: 'GET',
+      headers: getAuthHeaders(),
+    });
+
+    const data = await response.json();
+
+    if (response.ok) {
+      return { success: true, data: data.messages };
+    } else {
+      return { success: false, error: data.message };
+    }
+  } catch (error) {
+    return { success: false, error: error.message };
+  }
+};
+
 export const getMessageById = async (messageId) => {
   try {
     const response = await fetch(`${API_BASE_URL}/messages/${messageId}`, {
@@ -193,6 +275,25 @@ export const updateDashboard = async (dashboard) => {
   }
 };
 
+export const getGreenScore = async () => {
+  try {
+    const response = await fetch(`${API_BASE_URL}/greenscore`, {
+      method: 'GET',
+      headers: { 'Content-Type': 'application/json' },
+    });
+
+    const data = await response.json();
+
+    if (response.ok) {
+      return { success: true, data };
+    } else {
+      return { success: false, error: data.message };
+    }
+  } catch (error) {
+    return { success: false, error: error.message };
+  }
+};
+
 export const deleteMessage = async (messageId) => {
   try {
     const response = await fetch(`${API_BASE_URL}/messages/${messageId}`, {
@@ -230,3 +331,76 @@ export const markMessageAsRead = async (messageId) => {
     return { success: false, error: error.message };
   }
 };
+
+// Apply one operation ('mark_read', 'delete' or 'reply') to many messages
+// in a single request; data.results holds { _id, ok } per id
+export const bulkUpdateMessages = async (operation, messageIds, replyText) => {
+  try {
+    const response = await fetch(`${API_BASE_URL}/messages/bulk`, {
+      method: 'POST',
+      headers: getAuthHeaders(),
+      body: JSON.stringify({ operation, ids: messageIds, reply_text: replyText }),
+    });
+
+    const data = await response.json();
+
+    if (response.ok) {
+      return { success: true, data };
+    } else {
+      return { success: false, error: data.message };
+    }
+  } catch (error) {
+    return { success: false, error: error.message };
+  }
+};
+
+// ==================== Live Updates ====================
+
+// One EventSource per tab on /api/stream, shared by every subscriber.
+// EventSource cannot send headers, so the token is passed as ?token=
+const STREAM_EVENTS = ['message', 'message_status', 'message_reply', 'message_deleted', 'dashboard', 'resync'];
+const streamListeners = new Set();
+let eventSource = null;
+
+const notifyStream = (type, data) => {
+  streamListeners.forEach((listener) => listener(type, data));
+};
+
+const closeStream = () => {
+  eventSource.close();
+  eventSource = null;
+};
+
+const openStream = () => {
+  const token = getAuthToken();
+  const query = token ? `?token=${encodeURIComponent(token)}` : '';
+  const source = new EventSource(`${API_BASE_URL}/stream${query}`);
+  STREAM_EVENTS.forEach((type) => {
+    source.addEventListener(type, (event) => notifyStream(type, JSON.parse(event.data)));
+  });
+  source.onerror = () => {
+    // The browser reconnects (resuming after the last event) by itself,
+    // unless the server refused the stream, e.g. once the token expired:
+    // then open a new one after a pause and refetch what was missed
+    if (source.readyState !== EventSource.CLOSED || eventSource !== source) return;
+    eventSource = null;
+    setTimeout(() => {
+      if (streamListeners.size && !eventSource) {
+        openStream();
+        notifyStream('resync', {});
+      }
+    }, 5000);
+  };
+  eventSource = source;
+};
+
+// Call listener(type, data) for each change pushed by the server; returns
+// a function that unsubscribes (the stream closes with the last listener)
+export const subscribeToStream = (listener) => {
+  streamListeners.add(listener);
+  if (!eventSource) openStream();
+  return () => {
+    streamListeners.delete(listener);
+    if (!streamListeners.size && eventSource) closeStream();
+  };
+};
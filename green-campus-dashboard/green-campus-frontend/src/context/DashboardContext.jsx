@@ -52,7 +52,17 @@ export const DashboardProvider = ({ children }) => {
     return Math.min(100, Math.max(0, avgScore));
   };
 
-  const greenScore = calculateGreenScore();
+  // Scores computed by the backend (/api/greenscore), so every client
+  // shows the same numbers; the local calculation is only a fallback
+  const [scores, setScores] = useState(null);
+
+  const loadGreenScore = async () => {
+    const res = await apiService.getGreenScore();
+    if (res.success) setScores(res.data);
+  };
+
+  const greenScore = scores && scores.campus ? scores.campus.score : calculateGreenScore();
+  const buildingScores = scores ? scores.buildings : [];
 
   const value = {
     // Energy
@@ -78,22 +88,45 @@ export const DashboardProvider = ({ children }) => {
 
     // Overall
     greenScore,
+    buildingScores,
   };
 
-  // Load persisted dashboard from backend on mount
+  // Set while applying data loaded from the backend, so it is not
+  // persisted straight back (and announced to every client again)
+  const fromServerRef = useRef(false);
+
+  // Load persisted dashboard from backend on mount, and again whenever
+  // the stream announces a change
   useEffect(() => {
     let mounted = true;
+    let reloadTimer = null;
     const load = async () => {
       const res = await apiService.getDashboard();
       if (res.success && res.data && mounted) {
         const data = res.data;
-        if (Array.isArray(data.energyData) && data.energyData.length) setEnergyData(data.energyData);
-        if (Array.isArray(data.waterData) && data.waterData.length) setWaterData(data.waterData);
-        if (Array.isArray(data.wasteData) && data.wasteData.length) setWasteData(data.wasteData);
+        const loaded = ['energyData', 'waterData', 'wasteData'].filter(
+          (key) => Array.isArray(data[key]) && data[key].length
+        );
+        if (loaded.length) fromServerRef.current = true;
+        if (loaded.includes('energyData')) setEnergyData(data.energyData);
+        if (loaded.includes('waterData')) setWaterData(data.waterData);
+        if (loaded.includes('wasteData')) setWasteData(data.wasteData);
       }
+      if (mounted) await loadGreenScore();
     };
     load();
-    return () => { mounted = false; };
+    const unsubscribe = apiService.subscribeToStream((type) => {
+      if (type !== 'dashboard' && type !== 'resync') return;
+      // Readings can arrive in bursts; reload once they settle
+      clearTimeout(reloadTimer);
+      reloadTimer = setTimeout(load, 500);
+    });
+    return () => {
+      mounted = false;
+      clearTimeout(reloadTimer);
+      unsubscribe();
+    };
+    // eslint-disable-next-line react-hooks/exhaustive-deps
   }, []);
 
   // Persist dashboard when admin updates values
@@ -104,6 +137,10 @@ export const DashboardProvider = ({ children }) => {
       didInitRef.current = true;
       return;
     }
+    if (fromServerRef.current) {
+      fromServerRef.current = false;
+      return;
+    }
 
     const persist = async () => {
       try {
@@ -112,6 +149,7 @@ export const DashboardProvider = ({ children }) => {
         const user = JSON.parse(userInfo);
         if (user.role && user.role.toLowerCase() === 'admin') {
           await apiService.updateDashboard({ energyData, waterData, wasteData });
+          await loadGreenScore();
         }
       } catch (e) {
         console.error('Error persisting dashboard:', e);
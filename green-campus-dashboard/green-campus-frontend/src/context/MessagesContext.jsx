@@ -1,4 +1,4 @@
-import React, { useState, createContext, useEffect } from "react";
+import React, { useState, createContext, useEffect, useRef } from "react";
 import * as apiService from "../api/apiService";
 
 export const MessagesContext = createContext();
@@ -6,17 +6,72 @@ export const MessagesContext = createContext();
 export const MessagesProvider = ({ children }) => {
   const [messages, setMessages] = useState([]);
   const [loading, setLoading] = useState(false);
+  const [nextCursor, setNextCursor] = useState(null);
+  // Where /api/messages/changes picks up after the last load or sync
+  const syncTokenRef = useRef(null);
+  // nextCursor for callbacks registered once (the stream listener)
+  const nextCursorRef = useRef(null);
 
-  // Fetch messages from backend
+  // Fetch the first page of messages from backend
   const fetchMessages = async () => {
     setLoading(true);
-    const result = await apiService.getAllMessages();
+    const result = await apiService.getMessagesPage();
     if (result.success) {
       setMessages(result.data || []);
+      setNextCursor(result.nextCursor);
+      nextCursorRef.current = result.nextCursor;
+      syncTokenRef.current = result.syncToken;
     }
     setLoading(false);
   };
 
+  // Fold changed and deleted messages into the loaded ones. Changed
+  // messages not loaded yet are added unless they belong on a later page.
+  const mergeChanges = (prev, changed, deleted, hasMorePages) => {
+    const gone = new Set(deleted);
+    const updates = new Map(changed.map((msg) => [msg._id, msg]));
+    const merged = prev
+      .filter((msg) => !gone.has(msg._id))
+      .map((msg) => updates.get(msg._id) || msg);
+    const loaded = new Set(merged.map((msg) => msg._id));
+    const oldest = merged.length ? new Date(merged[merged.length - 1].created_at) : null;
+    const added = changed.filter(
+      (msg) =>
+        !loaded.has(msg._id) &&
+        (!hasMorePages || !oldest || new Date(msg.created_at) >= oldest)
+    );
+    if (!added.length) return merged;
+    return [...added, ...merged].sort((a, b) => new Date(b.created_at) - new Date(a.created_at));
+  };
+
+  // Catch up on what changed since the last load instead of re-fetching
+  const syncMessages = async () => {
+    if (!syncTokenRef.current) return fetchMessages();
+    let hasMore = true;
+    while (hasMore) {
+      const result = await apiService.getMessageChanges(syncTokenRef.current);
+      if (!result.success) {
+        if (result.expired) await fetchMessages();
+        return;
+      }
+      const { messages: changed, deleted, sync_token: syncToken, has_more: more } = result.data;
+      setMessages((prev) => mergeChanges(prev, changed, deleted, Boolean(nextCursorRef.current)));
+      syncTokenRef.current = syncToken;
+      hasMore = more;
+    }
+  };
+
+  // Append the next page of older messages
+  const loadMoreMessages = async () => {
+    if (!nextCursor) return;
+    const result = await apiService.getMessagesPage({ cursor: nextCursor });
+    if (result.success) {
+      setMessages((prev) => [...prev, ...(result.data || [])]);
+      setNextCursor(result.nextCursor);
+      nextCursorRef.current = result.nextCursor;
+    }
+  };
+
   // Send message to backend
   const sendMessage = async (name, email, subject, message) => {
     const result = await apiService.sendMessage(name, email, subject, message);
@@ -27,28 +82,25 @@ export const MessagesProvider = ({ children }) => {
     return false;
   };
 
+  // Append a reply unless it is already there (the stream echoes ours)
+  const withReply = (msg, reply) =>
+    reply.delivery_id && msg.replies.some((r) => r.delivery_id === reply.delivery_id)
+      ? msg
+      : { ...msg, replies: [...msg.replies, reply], status: "replied" };
+
   // Add reply to backend
   const addReply = async (messageId, adminReply) => {
     const result = await apiService.replyToMessage(messageId, adminReply);
     if (result.success) {
       // Update local state
-      setMessages(
-        messages.map((msg) =>
-          msg._id === messageId
-            ? {
-                ...msg,
-                replies: [
-                  ...msg.replies,
-                  {
-                    sender: "Admin",
-                    text: adminReply,
-                    timestamp: new Date().toLocaleString(),
-                  },
-                ],
-                status: "replied",
-              }
-            : msg
-        )
+      const reply = {
+        sender: "Admin",
+        text: adminReply,
+        timestamp: new Date().toLocaleString(),
+        delivery_id: result.data.delivery_id,
+      };
+      setMessages((prev) =>
+        prev.map((msg) => (msg._id === messageId ? withReply(msg, reply) : msg))
       );
       return true;
     }
@@ -59,7 +111,7 @@ export const MessagesProvider = ({ children }) => {
   const deleteMessage = async (messageId) => {
     const result = await apiService.deleteMessage(messageId);
     if (result.success) {
-      setMessages(messages.filter((msg) => msg._id !== messageId));
+      setMessages((prev) => prev.filter((msg) => msg._id !== messageId));
       return true;
     }
     return false;
@@ -69,23 +121,82 @@ export const MessagesProvider = ({ children }) => {
   const markAsRead = async (messageId) => {
     const result = await apiService.markMessageAsRead(messageId);
     if (result.success) {
-      setMessages(
-        messages.map((msg) =>
+      setMessages((prev) =>
+        prev.map((msg) =>
           msg._id === messageId ? { ...msg, status: "read" } : msg
         )
       );
     }
   };
 
-  // Fetch messages on component mount if user is admin
+  // Mark several messages as read in one request
+  const markManyAsRead = async (messageIds) => {
+    const result = await apiService.bulkUpdateMessages("mark_read", messageIds);
+    if (result.success) {
+      const done = new Set(result.data.results.filter((r) => r.ok).map((r) => r._id));
+      setMessages((prev) =>
+        prev.map((msg) => (done.has(msg._id) ? { ...msg, status: "read" } : msg))
+      );
+      return true;
+    }
+    return false;
+  };
+
+  // Delete several messages in one request
+  const deleteMessages = async (messageIds) => {
+    const result = await apiService.bulkUpdateMessages("delete", messageIds);
+    if (result.success) {
+      const done = new Set(result.data.results.filter((r) => r.ok).map((r) => r._id));
+      setMessages((prev) => prev.filter((msg) => !done.has(msg._id)));
+      return true;
+    }
+    return false;
+  };
+
+  // Apply a change pushed on the live update stream
+  const applyChange = (type, data) => {
+    switch (type) {
+      case "message":
+        setMessages((prev) =>
+          prev.some((msg) => msg._id === data.message._id)
+            ? prev.map((msg) => (msg._id === data.message._id ? data.message : msg))
+            : [data.message, ...prev]
+        );
+        break;
+      case "message_status":
+        setMessages((prev) =>
+          prev.map((msg) => (msg._id === data._id ? { ...msg, status: data.status } : msg))
+        );
+        break;
+      case "message_reply":
+        setMessages((prev) =>
+          prev.map((msg) => (msg._id === data._id ? withReply(msg, data.reply) : msg))
+        );
+        break;
+      case "message_deleted":
+        setMessages((prev) => prev.filter((msg) => msg._id !== data._id));
+        break;
+      case "resync":
+        // Events were missed; fetch only what changed meanwhile
+        syncMessages();
+        break;
+      default:
+        break;
+    }
+  };
+
+  // Fetch messages on component mount if user is admin, then follow
+  // changes on the stream instead of re-fetching
   useEffect(() => {
     const userInfo = localStorage.getItem('userInfo');
     if (userInfo) {
       const user = JSON.parse(userInfo);
       if (user.role === 'admin') {
         fetchMessages();
+        return apiService.subscribeToStream(applyChange);
       }
     }
+    // eslint-disable-next-line react-hooks/exhaustive-deps
   }, []);
 
   return (
@@ -97,7 +208,12 @@ export const MessagesProvider = ({ children }) => {
         addReply,
         deleteMessage,
         markAsRead,
+        deleteMessages,
+        markManyAsRead,
         fetchMessages,
+        syncMessages,
+        loadMoreMessages,
+        hasMoreMessages: Boolean(nextCursor),
       }}
     >
       {children}